@@ -0,0 +1,316 @@
+"""Benchmarks for the ensemble pipeline itself (database creation, claiming, decoding, dispatch
+overhead, model step rate and command startup).
+
+    python benchmarks/bench.py [--quick] [-o results.json] [--baseline baseline.json] [--tolerance 0.25]
+
+Results are written as json with sorted keys.  With --baseline every benchmark is compared with
+the saved results and the script exits with status 1 if any got worse by more than the tolerance.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO)
+
+from landlab_ensemble.generate_ensembles import create_model_db
+import landlab_ensemble.construct_model as cm
+from model_base import LandlabModel
+
+SIZES = {"full": {"create_db": [10, 22, 46],  # parameter values per axis, so 1000, 10648 and 97336 rows
+                  "claim": [1000, 10000, 100000],
+                  "decode": 20000,
+                  "dispatch": 50,
+                  "simple_lem": [(41, 5), (100, 100), (400, 400)],
+                  "simple_lem_batch": 32},
+         "quick": {"create_db": [5, 10],
+                   "claim": [200, 2000],
+                   "decode": 2000,
+                   "dispatch": 10,
+                   "simple_lem": [(41, 5), (100, 100)],
+                   "simple_lem_batch": 8}}
+CLAIM_ROWS = 500  # rows claimed when measuring claim throughput
+CLAIM_BATCH = 50
+SIMPLE_LEM_STEPS = 20
+SIMPLE_LEM_BATCH_STEPS = 100
+
+def sweep_params(values_per_axis, **runtime):
+    """Parameters for a sweep of values_per_axis**3 runs of a small grid."""
+    sweep = "ITERATIVE linspace {\"start\": 0.01, \"stop\": 0.1, \"num\": %d}" % values_per_axis
+    clock = runtime.get("clock", {"start": 0.0, "stop": 1000000, "step": 1250})
+    return {"grid": {"source": "create",
+                     "create_grid": {"RasterModelGrid": [[41, 5], {"xy_spacing": 5}]}},
+            "seed": 12,
+            "runtime": {"clock": clock,
+                        "steady_state": {"steady_state": False, "steady_state_type": "mean",
+                                         "steady_state_threshold": 0.01,
+                                         "steady_state_interval": runtime.get("steady_state_interval", 1000)}},
+            "output_fields": ["output.model.endtime", "output.topography.max"],
+            "baselevel": {"uplift_rate": sweep},
+            "diffuser": {"D": sweep},
+            "streampower": {"k": sweep, "m": 0, "n": 2, "threshold": 2}}
+
+def make_db(directory, name, params):
+    """Creates a parameter database for params, returning its path and number of rows."""
+    param_path = os.path.join(directory, name + ".json")
+    with open(param_path, 'w') as param_file:
+        json.dump(params, param_file)
+    db_path = os.path.join(directory, name + ".db")
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    rows = create_model_db(db_path, param_path, report=False)
+    return db_path, rows
+
+def best_of(repeat, function):
+    """Runs function repeat times, returning the shortest duration and the last result."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+def result(value, unit, higher_is_better=True):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+def bench_create_db(directory, sizes, repeat):
+    results = {}
+    for values_per_axis in sizes:
+        params = sweep_params(values_per_axis)
+        duration, (_, rows) = best_of(repeat, lambda: make_db(directory, "create", params))
+        results["create_db.rows_per_sec.%d" % rows] = result(rows / duration, "rows/s")
+    return results
+
+def bench_claim(directory, sizes, repeat):
+    results = {}
+    for rows in sizes:
+        values_per_axis = int(round(rows ** (1 / 3)))
+        db_path, n_rows = make_db(directory, "claim", sweep_params(values_per_axis))
+
+        def claim_rows():
+            # claims up to CLAIM_ROWS rows of a fresh copy of the table, decoding each into a parameter dictionary
+            connection = cm.sqlite3.connect(db_path)
+            connection.execute("UPDATE model_run_params SET model_run_id = NULL, model_batch_id = NULL")
+            connection.execute("DELETE FROM model_run_metadata")
+            connection.commit()
+            connection.close()
+            selector = cm.ModelSelector(db_path)
+            start = time.perf_counter()
+            claimed = 0
+            while claimed < to_claim:
+                claimed += len(selector.claim(CLAIM_BATCH, "bench"))
+            duration = time.perf_counter() - start
+            selector.connection.close()
+            return duration
+        to_claim = min(CLAIM_ROWS, n_rows)
+        durations = [claim_rows() for _ in range(repeat)]
+        results["claim.rows_per_sec.%d" % n_rows] = result(to_claim / min(durations), "rows/s")
+    return results
+
+def bench_decode(directory, n_rows, repeat):
+    db_path, _ = make_db(directory, "decode", sweep_params(5))
+    connection = cm.sqlite3.connect(db_path)
+    cursor = connection.execute("SELECT * FROM model_run_params")
+    columns = [c[0] for c in cursor.description]
+    rows = cursor.fetchall()
+    types = cm.get_param_types(connection)
+    connection.close()
+    rows = (rows * (n_rows // len(rows) + 1))[:n_rows]
+    duration, _ = best_of(repeat, lambda: [cm.row_to_params(row, columns, types) for row in rows])
+    decoder = cm.RowDecoder(columns, types)
+    decoder_duration, _ = best_of(repeat, lambda: [decoder.decode(row) for row in rows])
+    return {"row_to_params.rows_per_sec": result(n_rows / duration, "rows/s"),
+            "row_decoder.rows_per_sec": result(n_rows / decoder_duration, "rows/s")}
+
+class NoOpModel(LandlabModel):
+    """A model whose update does nothing, so a run costs only the pipeline around it."""
+    grid_fields_to_save = ["topographic__elevation"]
+
+    def __init__(self, params={}):
+        super().__init__(params)
+        self.grid.add_zeros("topographic__elevation", at="node")
+
+def bench_dispatch(directory, n_runs, repeat):
+    params = sweep_params(int(np.ceil(n_runs ** (1 / 3))), clock={"start": 0.0, "stop": 1.0, "step": 1.0},
+                          steady_state_interval=1.0)
+    out_dir = os.path.join(directory, "dispatch") + os.sep
+    os.makedirs(out_dir, exist_ok=True)
+
+    def dispatch():
+        db_path, _ = make_db(directory, "dispatch", params)
+        dispatcher = cm.ModelDispatcher(db_path, NoOpModel, out_dir, limit=n_runs)
+        start = time.perf_counter()
+        dispatcher.run_all()
+        duration = time.perf_counter() - start
+        dispatcher.close()
+        return duration
+    durations = [dispatch() for _ in range(repeat)]
+    return {"dispatch.seconds_per_run": result(min(durations) / n_runs, "s", higher_is_better=False)}
+
+def bench_simple_lem(shapes, repeat):
+    from diffusion_streampower_lem import SimpleLem
+    results = {}
+    for shape in shapes:
+        params = sweep_params(1, clock={"start": 1.0, "stop": 1e9, "step": 1250})
+        params["grid"]["create_grid"]["RasterModelGrid"][0] = list(shape)
+        params["baselevel"]["uplift_rate"] = 0.001
+        params["diffuser"]["D"] = 0.01
+        params["streampower"]["k"] = 0.001
+        model = SimpleLem(params)
+        model.run_id = "bench"
+        model.update(model.dt)
+
+        def steps():
+            for _ in range(SIMPLE_LEM_STEPS):
+                model.update(model.dt)
+        duration, _ = best_of(repeat, steps)
+        results["simple_lem.steps_per_sec.%dx%d" % tuple(shape)] = result(SIMPLE_LEM_STEPS / duration, "steps/s")
+    return results
+
+def simple_lem_batch_models(runs, steps=SIMPLE_LEM_BATCH_STEPS):
+    """SimpleLem models on the 41x5 grid with a few different uplift rates and diffusivities."""
+    from diffusion_streampower_lem import SimpleLem
+    models = []
+    for i in range(runs):
+        params = sweep_params(1, clock={"start": 0.0, "stop": 1250 * steps, "step": 1250},
+                              steady_state_interval=1250 * steps)
+        params["baselevel"]["uplift_rate"] = 0.001 * (1 + i % 4)
+        params["diffuser"]["D"] = 0.01 * (1 + i % 3)
+        params["streampower"]["k"] = 0.001
+        model = SimpleLem(params)
+        model.run_id = "bench"
+        models.append(model)
+    return models
+
+def bench_simple_lem_batch(runs, repeat):
+    """SimpleLem run-steps/sec on the 41x5 grid, for runs stepped one by one and as a LandlabModelBatch."""
+    from model_base import LandlabModelBatch
+
+    def run_singles(models):
+        for model in models:
+            model.run()
+
+    results = {}
+    for name, run in (("single", run_singles), ("batched", lambda models: LandlabModelBatch(models).run())):
+        best = None
+        for _ in range(repeat):
+            models = simple_lem_batch_models(runs)
+            start = time.perf_counter()
+            run(models)
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        results["simple_lem_batch.run_steps_per_sec.%s" % name] = result(runs * SIMPLE_LEM_BATCH_STEPS / best, "steps/s")
+    return results
+
+def run_command(*args):
+    """Runs a command line of the repo in a new interpreter, as a SLURM task or script would."""
+    subprocess.run([sys.executable] + list(args), cwd=REPO, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def bench_startup(directory, repeat):
+    """Wall time of small createdb, updatedb and tocsv commands, which is mostly interpreter and import time."""
+    params = sweep_params(2)
+    param_path = os.path.join(directory, "startup.json")
+    with open(param_path, 'w') as param_file:
+        json.dump(params, param_file)
+    db_path = os.path.join(directory, "startup.db")
+    outputs_path = os.path.join(directory, "startup_outputs.jsonl")
+    open(outputs_path, 'w').close()
+    csv_path = os.path.join(directory, "startup.csv")
+
+    def createdb():
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        run_command("model_control.py", "createdb", "-t", param_path, "-o", db_path)
+    commands = {"createdb": createdb,
+                "updatedb": lambda: run_command("model_control.py", "updatedb", "-d", db_path, "-o", outputs_path),
+                "tocsv": lambda: run_command(os.path.join("tools", "model_processing.py"), "-d", db_path,
+                                             "-t", "model_run_params", "tocsv", "-o", csv_path, "-c", "run_param_id", "model_run_id")}
+    results = {}
+    for name, command in commands.items():
+        duration, _ = best_of(repeat, command)
+        results["startup.%s.seconds" % name] = result(duration, "s", higher_is_better=False)
+    return results
+
+BENCHMARKS = ("create_db", "claim", "decode", "dispatch", "simple_lem", "simple_lem_batch", "startup")
+
+def run_benchmarks(quick=False, repeat=3, only=None):
+    """Runs the benchmarks, returning the results dictionary that is saved as json."""
+    sizes = SIZES["quick" if quick else "full"]
+    results = {}
+    # the pipeline's progress messages go to stderr so the json on stdout stays clean
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(sys.stderr):
+        for name in only or BENCHMARKS:
+            print("running %s" % name, file=sys.stderr)
+            if name == "create_db":
+                results.update(bench_create_db(directory, sizes["create_db"], repeat))
+            elif name == "claim":
+                results.update(bench_claim(directory, sizes["claim"], repeat))
+            elif name == "decode":
+                results.update(bench_decode(directory, sizes["decode"], repeat))
+            elif name == "dispatch":
+                results.update(bench_dispatch(directory, sizes["dispatch"], repeat))
+            elif name == "simple_lem":
+                results.update(bench_simple_lem(sizes["simple_lem"], repeat))
+            elif name == "simple_lem_batch":
+                results.update(bench_simple_lem_batch(sizes["simple_lem_batch"], repeat))
+            elif name == "startup":
+                results.update(bench_startup(directory, repeat))
+    return {"environment": {"python": platform.python_version(),
+                            "numpy": np.__version__,
+                            "platform": platform.platform(),
+                            "quick": quick},
+            "benchmarks": results}
+
+def compare(results, baseline, tolerance):
+    """Compares results with a baseline, returning the names of the benchmarks that regressed.
+
+    A benchmark regresses when it is worse than the baseline by more than the tolerance
+    (a fraction).  Benchmarks missing from either side are skipped.
+    """
+    regressions = []
+    for name, current in sorted(results["benchmarks"].items()):
+        if name not in baseline["benchmarks"]:
+            continue
+        base = baseline["benchmarks"][name]["value"]
+        ratio = current["value"] / base if current["higher_is_better"] else base / current["value"]
+        status = "ok"
+        if ratio < 1 - tolerance:
+            status = "REGRESSION"
+            regressions.append(name)
+        print("%-45s %12.4g %12.4g %-8s %6.2fx %s" % (name, base, current["value"], current["unit"], ratio, status))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmarks for the ensemble pipeline")
+    parser.add_argument("--quick", action="store_true", help="small sizes, for CI")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs='+', choices=BENCHMARKS)
+    parser.add_argument("-o", "--output", help="json file to save the results to")
+    parser.add_argument("--baseline", help="json results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    results = run_benchmarks(args.quick, args.repeat, args.only)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
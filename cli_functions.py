@@ -1,7 +1,9 @@
-from landlab_ensemble import generate_ensembles as ge
-from landlab_ensemble import construct_model as cm
+# the landlab_ensemble modules are imported by the commands that use them, so that
+# starting a command does not pay for the imports of every other one
 import argparse
+import csv
 import os
+import sys
 import importlib
 
 def create(args):
@@ -10,14 +12,17 @@ def create(args):
     Arguments:
     template -- the path for the json file  to create the databse from
     output -- the path for the output database file
+    chunk_size -- the number of rows to insert at a time
+    normalized -- store constant parameters once in a template table
     """
+    from landlab_ensemble import generate_ensembles as ge
     input_template = args.template
     output_db = args.output
     if not os.path.exists(input_template):
         raise argparse.ArgumentTypeError(f"The provided template file, '{input_template}' could not be found.")
     if os.path.exists(output_db):
         raise argparse.ArgumentTypeError(f"The provided output database file, '{output_db}' already exists.")
-    ge.create_model_db(output_db, input_template)
+    ge.create_model_db(output_db, input_template, args.chunk_size, normalized=args.normalized)
 
 def dispatch(args):
     """Create and run models from a parameter database.
@@ -29,18 +34,65 @@ def dispatch(args):
     n -- number of maximum runs
     processes -- the number of processes (dask workers) to create for running models
     clean -- a boolean flag to remove unfinished runs from tables so they can be rerun
+    resume -- a boolean flag to run unfinished runs again first, continuing from their checkpoints
+    tasks_per_worker -- the number of runs kept queued on each worker
+    backend -- the executor used for multiprocessing ("auto", "dask" or "process")
+    max_tasks_per_child -- the number of runs after which a process pool worker is replaced
+    batch_size -- the number of runs with the same grid advanced together in lock step
+    output_store -- a boolean flag to append all runs to one batch netcdf store instead of a file per run
+    warm_start -- a boolean flag to start every run from the final fields of the nearest finished run
+    async_writes -- a boolean flag to write each run's netcdf in the background while the next runs go on
+    wait -- seconds to wait for new rows (e.g. from refine) once every row is claimed
     """
     if not os.path.exists(args.database):
         raise argparse.ArgumentTypeError(f"The provided database file, `{args.database}` could not be found.")
+    from landlab_ensemble import construct_model as cm
     module, model = args.model.rsplit('.',1)
     model = getattr(importlib.import_module(module), model)
     if args.one:
         cm.run_model(args.database, model, args.batch_id, args.model_id, args.od)
         return
-    dispatcher = cm.ModelDispatcher(args.database, model, args.od, args.filter, args.n, args.processes)
+    dispatcher = cm.ModelDispatcher(args.database, model, args.od, args.filter, args.n, args.processes,
+                                    tasks_per_worker=args.tasks_per_worker, backend=args.backend,
+                                    max_tasks_per_child=args.max_tasks_per_child, batch_size=args.batch_size,
+                                    output_store=args.output_store, warm_start=args.warm_start,
+                                    async_writes=args.async_writes, wait_for_rows=args.wait)
     if args.clean:
         dispatcher.clean_unfinished_runs()
+    elif args.resume:
+        dispatcher.resume_unfinished_runs()
     dispatcher.run_all()
+    dispatcher.close()
+
+def pilot(args):
+    """Run models as a pilot job: keep claiming runs until there are none left or the walltime is nearly up.
+
+    Arguments:
+    database -- the path of the database to pull parameters from
+    model -- the model class, e.g. diffusion_streampower_lem.SimpleLem
+    od -- a directory/other prefix for output model runs to be saved in
+    filter -- some sort of sqlite condition for pulling runs from the database
+    walltime -- the time limit of the pilot, in SLURM's format (e.g. 04:00:00)
+    margin -- the seconds before the walltime after which no more runs are started
+    processes -- the number of processes to run models on
+    batch_size -- the number of runs with the same grid advanced together in lock step
+    output_store -- a boolean flag to append all runs to one batch netcdf store instead of a file per run
+    warm_start -- a boolean flag to start every run from the final fields of the nearest finished run
+    async_writes -- a boolean flag to write each run's netcdf in the background while the next runs go on
+    wait -- seconds to wait for new rows (e.g. from refine) once every row is claimed
+    """
+    if not os.path.exists(args.database):
+        raise argparse.ArgumentTypeError(f"The provided database file, `{args.database}` could not be found.")
+    from landlab_ensemble import construct_model as cm
+    module, model = args.model.rsplit('.',1)
+    model = getattr(importlib.import_module(module), model)
+    walltime = cm.parse_slurm_time(args.walltime) if args.walltime is not None else None
+    dispatcher = cm.ModelDispatcher(args.database, model, args.od, args.filter, processes=args.processes,
+                                    batch_size=args.batch_size, output_store=args.output_store,
+                                    walltime=walltime, walltime_margin=args.margin, warm_start=args.warm_start,
+                                    async_writes=args.async_writes, wait_for_rows=args.wait)
+    dispatcher.run_all()
+    dispatcher.close()
 
 def update_db(args):
     """Update the database with model outputs.
@@ -53,12 +105,62 @@ def update_db(args):
         raise argparse.ArgumentTypeError(f"The provided database file, `{args.database}` could not be found.")
     if not os.path.exists(args.outputs):
         raise argparse.ArgumentTypeError(f"The provided output directory, `{args.outputs}` could not be found.")
+    from landlab_ensemble import construct_model as cm
     cm.update_db_from_file(args.outputs, args.database)
 
 def slurm_config(args):
+    """Write the sbatch file (and run configuration) for running a database on SLURM.
+
+    With pilots, that many long lived pilot jobs (see pilot) share the database instead of
+    one array task being made for each of n runs.
+    """
     if not os.path.exists(args.database):
         raise argparse.ArgumentTypeError(f"The provided database file, `{args.database}` could not be found.")
+    from landlab_ensemble import construct_model as cm
+    if args.pilots is not None:
+        if args.walltime is None:
+            raise argparse.ArgumentTypeError("Pilot jobs need a --walltime.")
+        cm.generate_pilot_sbatch_file("Landlab_Pilots", args.pilots, args.walltime, args.database, args.model,
+                                      args.od, args.filter, args.cpus, args.batch_size,
+                                      slurm_path=args.sbatch_file or "landlab_pilots_for_slurm.sh")
+        return
     cm.generate_config_file_for_slurm(args.database, args.model, args.od,
                                       args.n, args.filter, args.slurm_csv,
                                       args.checkout_models)
     cm.generate_sbatch_file("Landlab_Batch", args.n, args.num_tasks, args.cpus, args.slurm_csv, args.sbatch_file)
+
+def cost(args):
+    """Print the cost of finished runs for each combination of the varying parameters as csv.
+
+    Arguments:
+    database -- the path of the parameter database
+    parameters -- the model_param columns to group by (default: every parameter that varies)
+    cost -- an sql expression over the metadata table (m) to summarise
+    """
+    if not os.path.exists(args.database):
+        raise argparse.ArgumentTypeError(f"The provided database file, `{args.database}` could not be found.")
+    from landlab_ensemble import resources
+    columns, rows = resources.cost_by_parameters(args.database, args.parameters, args.cost)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(columns)
+    writer.writerows(rows)
+
+def refine(args):
+    """Add unrun rows where the outputs of finished runs change fastest, in rounds alongside a dispatcher.
+
+    Arguments:
+    database -- the path of the parameter database
+    outputs -- the model_run_outputs columns to refine
+    parameters -- the model_param columns to refine over (default: every numeric parameter that varies)
+    n -- the maximum number of rows added per round
+    rounds -- the number of rounds
+    neighbours -- the number of neighbours of each finished run compared
+    min_distance -- the smallest distance, as a fraction of each parameter's range, to refine down to
+    poll -- seconds between checks for the previous round's runs having finished
+    min_results -- the number of the previous round's runs to wait for (default: all of them)
+    """
+    if not os.path.exists(args.database):
+        raise argparse.ArgumentTypeError(f"The provided database file, `{args.database}` could not be found.")
+    from landlab_ensemble import refinement
+    refinement.refine_in_rounds(args.database, args.outputs, args.n, args.rounds, args.parameters,
+                                args.neighbours, args.min_distance, args.poll, args.min_results)
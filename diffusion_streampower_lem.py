@@ -1,10 +1,21 @@
+from landlab import RasterModelGrid
 from landlab.core import load_params
 from landlab.components import LinearDiffuser, FlowAccumulator, FastscapeEroder
+from landlab.grid.linkstatus import LinkStatus
 from model_base import LandlabModel
+from scipy import sparse
 import numpy as np
 
+CFL_FACTOR = 0.15  # LinearDiffuser's time-step stability factor
+EROSION_TOLERANCE = 1e-12  # tolerance on the normalized elevation solved for by the eroder, as in FastscapeEroder
+EROSION_ITERATIONS = 100
+
 class SimpleLem(LandlabModel):
 
+    # parameters a pooled model is rebound to, see reset
+    resettable_params = ("seed", "baselevel.uplift_rate", "diffuser.D",
+                         "streampower.k", "streampower.m", "streampower.n", "streampower.threshold")
+
     DEFAULT_PARAMS = {
         "grid": {
             "source": "create",
@@ -37,31 +48,291 @@ class SimpleLem(LandlabModel):
 
         if not ("topographic__elevation" in self.grid.at_node.keys()):
             self.grid.add_zeros("topographic__elevation", at="node")
-        rng = np.random.default_rng(seed=int(params["seed"]))
-        grid_noise= rng.random(self.grid.number_of_nodes)/10
-        self.grid.at_node["topographic__elevation"] += grid_noise
         self.topo = self.grid.at_node["topographic__elevation"]
+        self.initial_topography = self.topo.copy()
+        self.topo += self.grid_noise(params["seed"])
+
+        self.accumulator = FlowAccumulator(self.grid, flow_director="D8")
+        self.setup_processes(params)
+        self.initial_fields = self.snapshot_fields()
+
+    def grid_noise(self, seed):
+        """The random noise added to the initial topography."""
+        rng = np.random.default_rng(seed=int(seed))
+        return rng.random(self.grid.number_of_nodes)/10
 
+    def setup_processes(self, params):
+        """Set the uplift rate and create the diffuser and eroder from params."""
         self.uplift_rate = params["baselevel"]["uplift_rate"]
+        self.diffusivity = params["diffuser"]["D"]
+        self.erodibility = params["streampower"]["k"]
+        self.m_sp = params["streampower"]["m"]
+        self.n_sp = params["streampower"]["n"]
+        self.threshold_sp = params["streampower"]["threshold"]
         self.diffuser = LinearDiffuser(
             self.grid,
             linear_diffusivity = params["diffuser"]["D"]
             )
-        self.accumulator = FlowAccumulator(self.grid, flow_director="D8")
         self.eroder = FastscapeEroder(self.grid,
                                       K_sp=params["streampower"]["k"],
                                       m_sp=params["streampower"]["m"],
                                       n_sp=params["streampower"]["n"],
                                       threshold_sp=params["streampower"]["threshold"])
 
+    def reset(self, params):
+        """Reuse the grid and flow accumulator for a new run (see LandlabModel.reset).
+
+        The fields go back to how they were when the model was built, with the
+        noise of the new seed, and the (cheap) diffuser and eroder are made
+        again for the new parameters.
+        """
+        self.reset_run_control(params)
+        self.restore_fields(self.initial_fields)
+        self.rebind_fields()
+        np.add(self.initial_topography, self.grid_noise(params["seed"]), out=self.topo)
+        self.setup_processes(params)
+        return True
+
 
     def update(self, dt):
         """Advance the model by one time step of duration dt."""
         if self.current_time % 10000 == 0:
             print("Model %s on year %d" % (self.run_id, self.current_time))
-        self.topo[self.grid.core_nodes] += self.uplift_rate * dt
-        self.diffuser.run_one_step(dt)
-        self.accumulator.run_one_step()
-        self.eroder.run_one_step(dt)
+        timer = self.timer
+        with timer.time("uplift"):
+            self.topo[self.grid.core_nodes] += self.uplift_rate * dt
+        with timer.time("diffuser"):
+            self.diffuser.run_one_step(dt)
+        with timer.time("accumulator"):
+            self.accumulator.run_one_step()
+        with timer.time("eroder"):
+            self.eroder.run_one_step(dt)
         self.current_time += dt
 
+    def rebind_fields(self):
+        """Refresh the handle to the elevation field."""
+        self.topo = self.grid.at_node["topographic__elevation"]
+
+    @classmethod
+    def batch_update(cls, batch, dt):
+        """Advance a batch of models by one time step of duration dt.
+
+        Uplift, diffusion, flow routing and erosion are applied to all runs at
+        once by BatchProcesses, with each run's own parameters.  Grids it does
+        not support fall back to the landlab components, grid by grid.
+        """
+        if not hasattr(batch, "processes"):
+            batch.processes = BatchProcesses.for_models(batch.active)
+        processes = batch.processes
+        core_nodes = batch.active[0].grid.core_nodes
+        batch.state[:, core_nodes] += batch.parameter("uplift_rate")[:, np.newaxis] * dt
+        if processes is None:
+            for model in batch.active:
+                model.diffuser.run_one_step(dt)
+                model.accumulator.run_one_step()
+                model.eroder.run_one_step(dt)
+                model.current_time += dt
+            return
+        processes.diffuse(batch.state, batch.parameter("diffusivity"), dt)
+        # leave_batch needs the topography flow was routed over, and runs only drop
+        # out after the last step before a steady state check
+        routed_topography = batch.state.copy() if batch.last_step else [None] * len(batch.active)
+        receivers, link_lengths, levels = processes.route_flow(batch.state)
+        drainage_area = processes.accumulate(receivers, levels)
+        processes.erode(batch.state, receivers, link_lengths, levels, drainage_area,
+                        batch.parameter("erodibility"), batch.parameter("m_sp"),
+                        batch.parameter("n_sp"), batch.parameter("threshold_sp"), dt)
+        for model, routed in zip(batch.active, routed_topography):
+            model.current_time += dt
+            model.routed_topography = routed  # see leave_batch
+
+    def leave_batch(self):
+        """Route flow on the model's own grid over the topography of its last batched step.
+
+        BatchProcesses does not fill in the fields of the flow accumulator, so
+        they are computed here, as the last update of a run on its own leaves them.
+        """
+        routed = getattr(self, "routed_topography", None)
+        if routed is None:
+            return
+        finished = self.topo.copy()
+        self.topo[:] = routed
+        self.accumulator.run_one_step()
+        self.topo[:] = finished
+        self.routed_topography = None
+
+
+class BatchProcesses:
+    """SimpleLem's diffusion, D8 flow routing and stream power erosion for many runs at once.
+
+    Array versions of LinearDiffuser, FlowAccumulator (D8) and FastscapeEroder
+    working on the ``(n_runs, n_nodes)`` state of a LandlabModelBatch, with one
+    diffusivity, erodibility, m, n and threshold per run.  The runs are routed
+    together as one forest of receiver trees over the flattened state, and
+    drainage area and erosion are computed level by level (a node's level is the
+    number of nodes downstream of it), over the nodes of all runs at that level.
+
+    Only raster grids whose nodes are core, fixed value or closed are supported,
+    see for_models.
+    """
+    def __init__(self, grid):
+        self.n_nodes = grid.number_of_nodes
+        self.core_nodes = grid.core_nodes
+        nodes = np.arange(self.n_nodes)
+
+        # diffusion: dz/dt = D * div(grad z) at core nodes, over the active links
+        active_links = grid.active_links
+        n_active = len(active_links)
+        link_length = grid.length_of_link[active_links]
+        rows = np.arange(n_active)
+        gradient = sparse.csr_matrix(
+            (np.concatenate([1.0 / link_length, -1.0 / link_length]),
+             (np.concatenate([rows, rows]),
+              np.concatenate([grid.node_at_link_head[active_links], grid.node_at_link_tail[active_links]]))),
+            shape=(n_active, self.n_nodes))
+        active_index = np.full(grid.number_of_links, -1)
+        active_index[active_links] = rows
+        links = grid.links_at_node[self.core_nodes]
+        directions = grid.link_dirs_at_node[self.core_nodes]
+        present = (directions != 0) & (active_index[links] >= 0)
+        core_rows = np.broadcast_to(np.arange(len(self.core_nodes))[:, np.newaxis], links.shape)
+        face_width = grid.length_of_face[grid.face_at_link[links[present]]]
+        cell_area = grid.cell_area_at_node[self.core_nodes]
+        divergence = sparse.csr_matrix(
+            (-directions[present] * face_width / cell_area[core_rows[present]],
+             (core_rows[present], active_index[links[present]])),
+            shape=(len(self.core_nodes), n_active))
+        self.laplacian_t = (divergence @ gradient).T.tocsr()
+        self.cfl_prefactor = CFL_FACTOR * np.min(link_length ** 2)
+
+        # D8 neighbours of each node, in increasing link order so ties go to the
+        # lower link as in FlowDirectorD8, and pointing at the node itself
+        # where there is no active link
+        d8s = grid.d8s_at_node
+        neighbours = np.where(d8s >= 0, grid.nodes_at_d8[d8s].sum(axis=2) - nodes[:, np.newaxis], nodes[:, np.newaxis])
+        usable = (d8s >= 0) & (grid.status_at_d8[d8s] == LinkStatus.ACTIVE)
+        neighbours[~usable] = np.broadcast_to(nodes[:, np.newaxis], neighbours.shape)[~usable]
+        lengths = np.where(usable, grid.length_of_d8[d8s], 1.0)
+        order = np.argsort(np.where(d8s >= 0, d8s, np.iinfo(d8s.dtype).max), axis=1, kind="stable")
+        self.neighbours = np.take_along_axis(neighbours, order, axis=1)
+        self.neighbour_lengths = np.take_along_axis(lengths, order, axis=1)
+        self.baselevel_nodes = grid.status_at_node == grid.BC_NODE_IS_FIXED_VALUE
+        self.cell_area = grid.cell_area_at_node.copy()
+        self.cell_area[grid.closed_boundary_nodes] = 0.0
+
+    @classmethod
+    def for_models(cls, models):
+        """BatchProcesses for the grid the models share, or None if it is not supported."""
+        grid = models[0].grid
+        if not isinstance(grid, RasterModelGrid) or (grid.status_at_node == grid.BC_NODE_IS_FIXED_GRADIENT).any():
+            return None
+        for model in models[1:]:
+            if (not isinstance(model.grid, RasterModelGrid) or model.grid.shape != grid.shape
+                    or model.grid.spacing != grid.spacing
+                    or not np.array_equal(model.grid.status_at_node, grid.status_at_node)):
+                return None
+        return cls(grid)
+
+    def diffuse(self, z, diffusivity, dt):
+        """Linear diffusion of every row of z with its own diffusivity.
+
+        Like LinearDiffuser, a run takes as many steps of its largest stable
+        time step as fit in dt, then one step for the rest.
+        """
+        with np.errstate(divide="ignore"):
+            stable_dt = self.cfl_prefactor / diffusivity
+        ratio = dt / stable_dt
+        repeats = np.floor(ratio)
+        loops = np.where(np.isfinite(stable_dt), repeats + 1, 0)
+        for i in range(int(loops.max(initial=0))):
+            rows = np.flatnonzero(loops > i)
+            timestep = np.where(i == repeats[rows], stable_dt[rows] * (ratio[rows] - repeats[rows]), stable_dt[rows])
+            rate = (diffusivity[rows] * timestep)[:, np.newaxis]
+            if len(rows) == len(z):
+                z[:, self.core_nodes] += rate * (z @ self.laplacian_t)
+            else:
+                z[np.ix_(rows, self.core_nodes)] += rate * (z[rows] @ self.laplacian_t)
+
+    def route_flow(self, z):
+        """D8 receivers of the flattened nodes of all runs.
+
+        Returns the receiver of each node (as an index into ``z.ravel()``), the
+        length of the link to it, and the nodes of each level, from the outlets
+        (level 0) up.
+        """
+        n_runs = len(z)
+        slopes = (z[:, :, np.newaxis] - z[:, self.neighbours]) / self.neighbour_lengths
+        steepest = np.argmax(slopes, axis=2)[:, :, np.newaxis]
+        downhill = np.take_along_axis(slopes, steepest, axis=2)[:, :, 0] > 0
+        downhill[:, self.baselevel_nodes] = False
+        nodes = np.broadcast_to(np.arange(self.n_nodes), z.shape)
+        receivers = np.where(downhill, self.neighbours[nodes, steepest[:, :, 0]], nodes)
+        link_lengths = np.where(downhill, self.neighbour_lengths[nodes, steepest[:, :, 0]], 0.0)
+        receivers = (receivers + self.n_nodes * np.arange(n_runs)[:, np.newaxis]).ravel()
+
+        # the level of each node, by pointer jumping up the receiver trees
+        ancestors = receivers
+        level = (receivers != np.arange(len(receivers))).astype(np.intp)
+        while True:
+            next_ancestors = ancestors[ancestors]
+            if np.array_equal(next_ancestors, ancestors):
+                break
+            level = level + level[ancestors]
+            ancestors = next_ancestors
+        by_level = np.argsort(level, kind="stable")
+        levels = np.split(by_level, np.cumsum(np.bincount(level))[:-1])
+        return receivers, link_lengths.ravel(), levels
+
+    def accumulate(self, receivers, levels):
+        """Drainage area of the flattened nodes, summed from the highest level down."""
+        area = np.tile(self.cell_area, len(receivers) // self.n_nodes)
+        for nodes in reversed(levels[1:]):
+            np.add.at(area, receivers[nodes], area[nodes])
+        return area
+
+    def erode(self, z, receivers, link_lengths, levels, drainage_area, erodibility, m, n, threshold, dt):
+        """Implicit stream power erosion (Braun and Willett, 2013) with a threshold, as FastscapeEroder.
+
+        Every node is solved after its receiver, one level at a time.
+        """
+        flat = z.reshape(-1)
+        per_node = lambda values: np.repeat(values, self.n_nodes)
+        n = per_node(n)
+        threshold = per_node(threshold) * dt
+        with np.errstate(divide="ignore", invalid="ignore"):  # outlets have no link to a receiver
+            alpha = per_node(erodibility) * dt * drainage_area ** per_node(m) / link_lengths ** n
+        for nodes in levels[1:]:
+            downstream = flat[receivers[nodes]]
+            difference = flat[nodes] - downstream
+            above = difference > 0
+            nodes, downstream, difference = nodes[above], downstream[above], difference[above]
+            a = alpha[nodes] * difference ** (n[nodes] - 1.0)
+            b = threshold[nodes] / difference
+            eroding = a - b > 0
+            if not eroding.any():
+                continue
+            nodes, downstream, difference = nodes[eroding], downstream[eroding], difference[eroding]
+            x = solve_erosion(a[eroding], b[eroding], n[nodes])
+            flat[nodes] = np.where(x > 0, downstream + x * difference, downstream + 1.0e-15)
+
+
+def solve_erosion(a, b, n):
+    """The root in (0, 1) of ``x - 1 + a * x**n - b``, elementwise.
+
+    Newton's method from x = 1, falling back to bisection when a step leaves
+    the bracket around the root; exact in one step when n is 1.
+    """
+    low = np.zeros_like(a)
+    high = np.ones_like(a)
+    x = high.copy()
+    for _ in range(EROSION_ITERATIONS):
+        f = x - 1.0 + a * x ** n - b
+        low = np.where(f < 0, x, low)
+        high = np.where(f > 0, x, high)
+        step = x - f / (1.0 + a * n * x ** (n - 1.0))
+        step = np.where((step <= low) | (step >= high), 0.5 * (low + high), step)
+        converged = np.abs(step - x) < EROSION_TOLERANCE
+        x = step
+        if converged.all():
+            break
+    return x
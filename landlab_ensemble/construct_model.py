@@ -6,6 +6,15 @@ import uuid
 import time
 import os
 import csv
+import shlex
+from .generate_ensembles import create_model_run_indexes, create_model_run_timing_table
+from .db_writer import DatabaseWriter, connect_wal, DEFAULT_MAX_DELAY
+from .executors import get_executor
+from .output_store import (OutputStore, AsyncRunWriter, grid_topology, model_run_fields, read_node_fields, write_model_run,
+                           output_encodings)
+from .resources import ResourceUsage, add_resource_columns, resource_update_sql, resource_values
+from .warm_start import WarmStarter, add_warm_start_column, WARM_START_UPDATE_SQL
+from .model_pool import MODEL_POOL
 
 def _resolve_type(type_str):
     """This function returns the python class for a type string.
@@ -63,19 +72,95 @@ def expand_dict(flat_dict):
         _expand_key_into_dict(key, value, expanded_dict)
     return expanded_dict
 
-def row_to_params(row, columns, types):
+def _none(value):
+    return None
+
+def _json(value):
+    return json.loads(value.replace("'", "\""))
+
+def _caster(ideal_type):
+    """The function _ensure_type uses to cast a value to ideal_type."""
+    if ideal_type == type(None):
+        return _none
+    elif ideal_type in (type([]), type({})):
+        return _json
+    return ideal_type
+
+class RowDecoder:
+    """Turns parameter table rows into nested parameter dictionaries with a plan compiled once.
+
+    The column names are split into key paths, a caster is picked for every model_param
+    column and the nested dictionaries every row needs are listed, all when the decoder is
+    made.  Decoding a row is then one loop over the plan with no string handling besides
+    parsing list and dictionary values.  The result, down to the order of the keys, is the
+    same as the constants updated with the row's values and expanded with expand_dict.
+
+    Attributes:
+        plan -- a list of (parent, key, index, value) steps that each set a key of the parent'th
+                dictionary made so far (0 is the result): to a new dictionary if index is
+                NEW_DICT, to the constant value if index is None, and otherwise to the row's
+                value at index cast with value
+    """
+    NEW_DICT = -1
+
+    def __init__(self, columns, types, constants=None):
+        """Compiles the plan.
+
+        Args:
+            columns -- the column names of the rows to decode
+            types -- a dictionary of model_param column name to python type (see get_param_types)
+            constants -- a flat dictionary of already typed constant parameters (see get_constant_params)
+        """
+        self.plan = []
+        dict_index = {(): 0}
+
+        def add_step(key, index, value):
+            path = tuple(key.split('.'))
+            for depth in range(1, len(path)):
+                if path[:depth] not in dict_index:
+                    dict_index[path[:depth]] = len(dict_index)
+                    self.plan.append((dict_index[path[:depth - 1]], path[depth - 1], self.NEW_DICT, None))
+            self.plan.append((dict_index[path[:-1]], path[-1], index, value))
+
+        for key, value in (constants or {}).items():
+            add_step(key, None, value)
+        for index, column in enumerate(columns):
+            if column.split('.')[0] == "model_param":
+                add_step(column.split('.', 1)[1], index, _caster(types[column]))
+
+    @classmethod
+    def from_connection(cls, connection, columns):
+        """Compiles a decoder for rows with the given columns of a parameter database."""
+        types = get_param_types(connection)
+        return cls(columns, types, get_constant_params(connection, types))
+
+    def decode(self, row):
+        """Returns the nested parameter dictionary of a row."""
+        dicts = [{}]
+        new_dict_step = self.NEW_DICT
+        for parent, key, index, value in self.plan:
+            if index is None:
+                dicts[parent][key] = value
+            elif index == new_dict_step:
+                dicts[parent][key] = new_dict = {}
+                dicts.append(new_dict)
+            else:
+                dicts[parent][key] = value(row[index])
+        return dicts[0]
+
+def row_to_params(row, columns, types, constants=None):
     """Given a list of values from a table row, corresponding column names, and ideal types, return an associated dictionary.
 
     This is not agnostic, as it expect column names of interest to start with "model_param" and heirarchy to be '.'
-    seperated.
+    seperated.  To decode many rows with the same columns make a RowDecoder once instead.
     Args:
         row -- a list of values
         columns -- a list of names
         types -- a list of ideal types for each value
+        constants -- a flat dictionary of already typed constant parameters (see get_constant_params) that
+                     the row values are merged into
     """
-    row_dict = dict(zip(columns, row))
-    parameter_dictionary = {k.split('.', 1)[1]: _ensure_type(v, types[k]) for k,v in row_dict.items() if k.split('.')[0]=="model_param"}
-    return expand_dict(parameter_dictionary)
+    return RowDecoder(columns, types, constants).decode(row)
 
 def get_param_types(connection):
     """Pull parameter names and associated python type from the dimension table of a database connection."""
@@ -84,6 +169,48 @@ def get_param_types(connection):
     cursor.close()
     return {k: _resolve_type(v) for k,v in param_and_type}
 
+def has_table(connection, table):
+    """Returns True if the database connection has a table with the given name."""
+    cursor = connection.cursor()
+    result = cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name = ?", (table,)).fetchone()
+    cursor.close()
+    return result is not None
+
+def get_constant_params(connection, types):
+    """Pull the constant parameters from the template table of a normalized database.
+
+    Returns a flat dictionary (keys without the "model_param" prefix) of typed values, which
+    is empty for databases that store every parameter on every row.
+    """
+    if not has_table(connection, "model_param_template"):
+        return {}
+    cursor = connection.cursor()
+    row = cursor.execute("SELECT * FROM model_param_template ORDER BY template_id LIMIT 1").fetchone()
+    columns = [c[0] for c in cursor.description]
+    cursor.close()
+    return {k.split('.', 1)[1]: _ensure_type(v, types[k]) for k, v in zip(columns, row) if k.split('.')[0]=="model_param"}
+
+TIMING_INSERT_SQL = "INSERT INTO model_run_timing (model_run_id, timer, calls, total, mean, p50, p95, max) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+CLAIM_TIMEOUT = 60.0  # seconds to wait on another dispatcher holding the write lock
+DEFAULT_WALLTIME_MARGIN = 60.0  # seconds of a pilot's walltime kept free for saving and flushing
+ROW_POLL_INTERVAL = 5.0  # seconds between checks for new rows while a dispatcher waits for them
+STORE_SYNC_RUNS = 32  # runs appended to an OutputStore before it is synced and they are marked as finished
+STORE_SYNC_DELAY = DEFAULT_MAX_DELAY  # seconds an appended run may wait for the OutputStore to be synced
+
+def upgrade_db_for_dispatch(connection):
+    """Adds what dispatching needs to a database made before it existed.
+
+    These are the claim indexes, the timing table and the resource columns.
+    Each step is a no-op if it is already there.  This needs the write lock, so
+    only dispatchers call it; readers (ModelSelector, reports) never change the schema.
+    """
+    cursor = connection.cursor()
+    create_model_run_indexes(cursor)
+    create_model_run_timing_table(cursor)
+    add_resource_columns(cursor)
+    connection.commit()
+    cursor.close()
+
 class ModelSelector:
     """An object that iterates over runrun parameters in a parameter database.
 
@@ -92,11 +219,15 @@ class ModelSelector:
 
     Attributes:
         database -- the database path to grab parameters from
+        filter -- the sql condition to filter by
         filter_statement -- an additional filter for queries
         select_statement -- the statement that selects from the database
         columns -- the columns of the model parameter database
+        constant_params -- constant parameters stored once in a normalized database
+        decoder -- the RowDecoder that turns the selected rows into parameter dictionaries
         limit -- the maximum ammount of parameters to return
         current -- the current number of parameters returend
+        unfinished -- claimed but unfinished rows queued to be handed out again (see queue_unfinished)
     """
     def __init__(self, database, filter=None, limit=None):
         """Initializes the ModelSelector with a specific database.
@@ -107,19 +238,24 @@ class ModelSelector:
             limit -- the maximum number of rows to return
         """
         self.database = database
+        self.filter = filter
         if filter:
-            self.filter_statement = "%s AND model_run_id IS NULL"
+            self.filter_statement = "(%s) AND model_run_id IS NULL" % filter
         else:
             self.filter_statement = "model_run_id IS NULL"
-        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.connection = sqlite3.connect(database, check_same_thread=False, timeout=CLAIM_TIMEOUT)
         self.parameter_types = get_param_types(self.connection)
+        self.constant_params = get_constant_params(self.connection, self.parameter_types)
         cursor = self.connection.cursor()
         self.select_statement = "SELECT run_param_id, * FROM model_run_params WHERE %s" % (self.filter_statement)#, limit_statement))
+        self.claim_statement = "%s ORDER BY run_param_id LIMIT ?" % self.select_statement
         cursor.execute(self.select_statement)
         self.columns = [c[0] for c in cursor.description[1:]]
         cursor.close()
+        self.decoder = RowDecoder(self.columns, self.parameter_types, self.constant_params)
         self.limit = limit
         self.current = 0
+        self.unfinished = []
 
     def __iter__(self):
         """Returns the object as it is an iterator."""
@@ -140,10 +276,74 @@ class ModelSelector:
             raise StopIteration
         run_id = results[0]
         model_parameters = results[1:]
-        param_dict = row_to_params(model_parameters, self.columns, self.parameter_types)
+        param_dict = self.decoder.decode(model_parameters)
         self.current += 1
         return run_id, param_dict
 
+    def queue_unfinished(self):
+        """Queues the rows that were claimed but never finished to be handed out again by claim().
+
+        They keep their model run id and metadata row, so their runs can continue from a
+        checkpoint.  Only use this when no other dispatcher is still running them.
+        Returns the number of queued rows.
+        """
+        statement = ("SELECT run_param_id, * FROM model_run_params WHERE model_run_id IN "
+                     "(SELECT model_run_id FROM model_run_metadata WHERE model_start_time IS NOT NULL AND model_end_time IS NULL)")
+        if self.filter:
+            statement = "%s AND (%s)" % (statement, self.filter)
+        cursor = self.connection.cursor()
+        rows = cursor.execute(statement).fetchall()
+        cursor.close()
+        model_run_id_index = self.columns.index("model_run_id")
+        self.unfinished.extend((row[0], row[1:][model_run_id_index], row[1:]) for row in rows)
+        return len(rows)
+
+    def claim(self, n=1, batch_id=None):
+        """Atomically marks up to n unrun parameter rows as taken and returns them.
+
+        The rows are selected, given a new model run id, and recorded as started in the
+        metadata table inside a single write transaction (BEGIN IMMEDIATE), so several
+        dispatchers working on the same database never claim the same row.  The rows are
+        decoded before the transaction commits, so a row that cannot be decoded rolls the
+        claim back rather than leaving rows claimed without a run.  Unlike next(), the claimed
+        rows will not be returned again.  Rows queued by queue_unfinished are handed out
+        first, with their existing model run id.
+        Args:
+            n -- the maximum number of rows to claim
+            batch_id -- the batch id to record the claimed runs under (NULL if None)
+        Returns:
+            a list of (run_param_id, model_run_id, parameter dictionary) tuples, empty if
+            there is nothing left to run
+        """
+        if self.limit is not None:
+            n = min(n, self.limit - self.current)
+        if n <= 0:
+            return []
+        decode = self.decoder.decode
+        claimed = [(run_id, model_run_id, decode(values)) for run_id, model_run_id, values in self.unfinished[:n]]
+        del self.unfinished[:n]
+        n -= len(claimed)
+        batch_id = None if batch_id is None else str(batch_id)
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            rows = cursor.execute(self.claim_statement, (n,)).fetchall() if n > 0 else []
+            start_time = time.time()
+            new_claims = [(row[0], str(uuid.uuid4()), decode(row[1:])) for row in rows]
+            cursor.executemany("UPDATE model_run_params SET model_run_id = ?, model_batch_id = ? WHERE run_param_id = ?",
+                               [(model_run_id, batch_id, run_id) for run_id, model_run_id, _ in new_claims])
+            cursor.executemany("INSERT INTO model_run_metadata (model_run_id, model_batch_id, model_start_time) VALUES (?, ?, ?)",
+                               [(model_run_id, batch_id, start_time) for _, model_run_id, _ in new_claims])
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        claimed += new_claims
+        self.current += len(claimed)
+        return claimed
+
     def empty(self):
         """Returns True if there are no more parameters for this iterator to return."""
         if self.limit is not None and self.current > self.limit:
@@ -158,30 +358,174 @@ class ModelSelector:
                 return False
 
     
-def make_and_run_model(model_class, batch_id, model_run_id, param_dict, out_dir, run_param_id):
-    """Creates a new instantiation of a landlab model, runs it, and saves the output as a netcdf."""
-    model = model_class(param_dict)
+def apply_warm_start(model, warm_start):
+    """Loads the final node fields of a donor run into a new model before it runs.
+
+    Args:
+        model -- the new model
+        warm_start -- None, or a dictionary with the "donor" model run id and either the "path" of
+                      its netcdf file or its "node_fields" (see WarmStarter.warm_start)
+    Returns the donor's model run id, or None if nothing was loaded.
+    """
+    if warm_start is None:
+        return None
+    if "node_fields" in warm_start:
+        fields = warm_start["node_fields"]
+    else:
+        fields = read_node_fields(warm_start["path"])
+    if not model.load_node_fields(fields):
+        print("run %s can not start from run %s, it has no matching fields" % (model.run_id, warm_start["donor"]))
+        return None
+    return warm_start["donor"]
+
+def make_and_run_model(model_class, batch_id, model_run_id, param_dict, out_dir, run_param_id, to_store=False, warm_start=None):
+    """Creates a new instantiation of a landlab model, runs it, and saves the output as a netcdf.
+
+    With to_store the fields are returned in the outputs instead, for the dispatcher to append
+    to its OutputStore.  If the run is profiled (runtime.profile) the summary of its timers,
+    including model construction, run and save, is returned as the outputs' "timings".  The
+    resources used by the run (see ResourceUsage) are returned as its "resources".  With a
+    warm_start (see apply_warm_start) the run starts from the donor's final fields, and the
+    donor is returned as "warm_start_donor".  The model is taken from, and put back into, the
+    worker's MODEL_POOL, so runs of one grid and component configuration reuse one model.
+    """
+    usage = ResourceUsage()
+    setup_start = time.perf_counter()
+    model = MODEL_POOL.get(model_class, param_dict)
+    model.timer.add("setup", time.perf_counter() - setup_start)
     model.batch_id = batch_id
     model.run_id = model_run_id
+    set_checkpoint(model, param_dict, out_dir, run_param_id)
+    donor = apply_warm_start(model, warm_start)
     start_time = time.time()
-    model.run()
+    with model.timer.time("run"):
+        model.run()
     end_time = time.time()
-    output_f = "%s%s.nc" % (out_dir, model.run_id)
-    model.grid.save(output_f, names=model.grid_fields_to_save)
-    outputs = model.get_output()
+    outputs = save_model_run(model, start_time, end_time, out_dir, run_param_id, to_store)
+    model.remove_checkpoint()
+    MODEL_POOL.put(model)
+    outputs["resources"] = usage.stop(outputs["output_bytes"])
+    if donor is not None:
+        outputs["warm_start_donor"] = donor
+    return outputs
+
+def set_checkpoint(model, param_dict, out_dir, run_param_id):
+    """Points a model at the checkpoint file for its parameter row.
+
+    The checkpoint is named after the run_param_id rather than the model run id, so a run
+    that is reset (see ModelDispatcher.clean_unfinished_runs) and claimed again, or rerun
+    with run_model, still continues from where it was stopped.  The key makes the model
+    ignore a checkpoint left behind for different parameters.
+    """
+    model.checkpoint_path = "%srun_param_%s.checkpoint" % (out_dir, run_param_id)
+    model.checkpoint_key = json.dumps(param_dict, sort_keys=True, default=str)
+
+def save_model_run(model, start_time, end_time, out_dir, run_param_id, to_store=False):
+    """Saves a finished model's grid as a netcdf and returns its outputs dictionary.
+
+    The fields saved, and how they are stored, are set by the output.fields parameter (see
+    write_model_run).  With to_store nothing is written; the fields to save, their encodings
+    and the grid topology are added to the outputs as "node_fields", "field_encodings" and
+    "grid_topology" for an OutputStore instead.  The number of bytes written (or handed to
+    the store) is returned as "output_bytes".
+    """
+    with model.timer.time("save"):
+        outputs = model.get_output()
+        if to_store:
+            outputs["node_fields"] = model_run_fields(model)
+            outputs["field_encodings"] = output_encodings(model.save_fields)
+            outputs["field_complevel"] = model.save_complevel
+            outputs["grid_topology"] = grid_topology(model.grid)
+            outputs["output_bytes"] = sum(values.nbytes for values in outputs["node_fields"].values())
+        else:
+            output_f = "%s%s.nc" % (out_dir, model.run_id)
+            write_model_run(model, output_f)
+            outputs["output_bytes"] = os.path.getsize(output_f)
     outputs['model_batch_id'] = model.batch_id
     outputs['model_run_id'] = model.run_id
     outputs['start_time'] = start_time
     outputs['end_time'] = end_time
     outputs["run_param_id"] = run_param_id
+    if model.timer.enabled:
+        outputs["timings"] = model.timer.summary()
+    return outputs
+
+def batch_key(param_dict):
+    """A key that is equal for parameters whose models can share a LandlabModelBatch.
+
+    Runs can be batched when they share a grid and run controls and differ only in
+    their other (scalar) parameters.
+    """
+    return json.dumps([param_dict.get("grid"), param_dict.get("runtime")], sort_keys=True, default=str)
+
+def group_runs(runs, batch_size):
+    """Splits claimed (run_param_id, model_run_id, param_dict) runs into groups of at most batch_size compatible runs."""
+    groups = {}
+    for run in runs:
+        groups.setdefault(batch_key(run[2]), []).append(run)
+    return [group[i:i + batch_size] for group in groups.values() for i in range(0, len(group), batch_size)]
+
+def make_and_run_model_batch(model_class, batch_id, runs, out_dir, to_store=False, warm_starts=None):
+    """Creates a model for each claimed run, runs them in lock step, and saves each output as a netcdf.
+
+    Arguments:
+        model_class -- the Landlab model object
+        batch_id -- the uuid of the dispatcher's batch
+        runs -- a list of (run_param_id, model_run_id, param_dict) that can share a LandlabModelBatch
+        out_dir -- a directory/prefix to save the model runs to
+        to_store -- return the fields in the outputs for an OutputStore instead of saving them
+        warm_starts -- a warm start (see apply_warm_start) for each run, or None
+
+    Returns a list with the outputs dictionary of every run, as make_and_run_model does.  The runs
+    share a process, so each is given an equal share of the batch's CPU time and the batch's peak RSS.
+    Batched models are not pooled (see ModelPool), their fields end up as rows of the batch's arrays.
+    """
+    # imported here so the commands that never run a model do not load landlab
+    from model_base import LandlabModelBatch
+    usage = ResourceUsage()
+    run_param_ids = {}
+    donors = {}
+    models = []
+    for run_index, (run_param_id, model_run_id, param_dict) in enumerate(runs):
+        model = model_class(param_dict)
+        model.batch_id = batch_id
+        model.run_id = model_run_id
+        run_param_ids[model_run_id] = run_param_id
+        if warm_starts is not None:
+            donors[model_run_id] = apply_warm_start(model, warm_starts[run_index])
+        models.append(model)
+    start_time = time.time()
+    outputs = []
+
+    def on_finish(model):
+        # save each run as soon as it drops out of the batch
+        outputs.append(save_model_run(model, start_time, time.time(), out_dir, run_param_ids[model.run_id], to_store))
+
+    LandlabModelBatch(models).run(on_finish)
+    resources = usage.stop()
+    for run_outputs in outputs:
+        run_resources = dict(resources, output_bytes=run_outputs["output_bytes"])
+        run_resources["user_cpu_time"] /= len(outputs)
+        run_resources["system_cpu_time"] /= len(outputs)
+        run_outputs["resources"] = run_resources
+        if donors.get(run_outputs["model_run_id"]) is not None:
+            run_outputs["warm_start_donor"] = donors[run_outputs["model_run_id"]]
     return outputs
 
 def update_db(outputs, cursor):
-    """Given a dictionary of outputs, update the database with the new information."""
+    """Given a dictionary of outputs, update the database with the new information.
+
+    The database needs the resource columns and timing table; call upgrade_db_for_dispatch
+    once on the connection before updating it with any runs.
+    """
     cursor.execute("UPDATE model_run_params SET model_run_id = ?, model_batch_id = ? WHERE run_param_id = ?", 
                    (outputs['model_run_id'], outputs['model_batch_id'], outputs['run_param_id']))
     cursor.execute("INSERT INTO model_run_metadata (model_run_id, model_batch_id, model_start_time, model_end_time) VALUES (?, ?, ?, ?)",
                      (outputs['model_run_id'], outputs['model_batch_id'], outputs['start_time'], outputs['end_time']))
+    if "resources" in outputs:
+        cursor.execute(resource_update_sql(), resource_values(outputs["resources"], outputs['model_run_id']))
+    if "timings" in outputs:
+        cursor.executemany(TIMING_INSERT_SQL, [(outputs['model_run_id'],) + tuple(row) for row in outputs["timings"]])
     valid_output_query = cursor.execute("SELECT * FROM model_run_outputs")
     valid_output_names = [d[0] for d in valid_output_query.description]
     valid_outputs = {key: outputs[key] for key in outputs.keys() if key in valid_output_names}
@@ -193,6 +537,7 @@ def update_db(outputs, cursor):
 def update_db_from_file(output_path, database):
     """Given a path to a netcdf file, update the database with the information contained in that file."""
     connection = sqlite3.connect(database)
+    upgrade_db_for_dispatch(connection)
     cursor = connection.cursor()
     # open up output file, read line by line, load line as json, call update_db function
     with open(output_path, 'r') as file:
@@ -213,13 +558,16 @@ def run_model(database, model_class, batch_id, run_param_id, output_dir, update_
     columns = [c[0] for c in cursor.description[1:]]
     cursor.close()
     model_parameters = results[1:]
-    parameter_types = get_param_types(connection)
-    param_dict = row_to_params(model_parameters, columns, parameter_types)
+    param_dict = RowDecoder.from_connection(connection, columns).decode(model_parameters)
     model_run_id = str(uuid.uuid4())
     start_time = time.time()
     outputs = make_and_run_model(model_class, batch_id, model_run_id, param_dict, output_dir, run_param_id)
     if update_db_now:
+        upgrade_db_for_dispatch(connection)
+        cursor = connection.cursor()
         update_db(outputs, cursor)
+        connection.commit()
+        cursor.close()
     else:
         print(json.dumps(outputs))
     
@@ -272,7 +620,67 @@ python model_control.py dispatch --one -d "${{vals[0]}}" -m "${{vals[1]}}" -od "
                      """
     with open(slurm_path, 'w') as file:
         file.write(slurm_file_str)
-    
+
+def parse_slurm_time(walltime):
+    """Converts a SLURM time limit ("minutes", "minutes:seconds", "hours:minutes:seconds",
+    "days-hours", "days-hours:minutes" or "days-hours:minutes:seconds") to seconds."""
+    walltime = str(walltime)
+    days = 0
+    if '-' in walltime:
+        days, walltime = walltime.split('-', 1)
+        parts = [int(p) for p in walltime.split(':')]
+        hours, minutes, seconds = (parts + [0, 0])[:3]
+    else:
+        parts = [int(p) for p in walltime.split(':')]
+        if len(parts) == 3:
+            hours, minutes, seconds = parts
+        else:
+            hours = 0
+            minutes, seconds = (parts + [0])[:2]
+    return ((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+def generate_pilot_sbatch_file(job_name, pilots, walltime, database, model, output_directory, filter=None, cpus=1,
+                               batch_size=1, walltime_margin=DEFAULT_WALLTIME_MARGIN,
+                               slurm_path="landlab_pilots_for_slurm.sh", output_file="output_from_pilots.txt"):
+    """Writes an sbatch file that starts a number of pilot jobs rather than one array task per run.
+
+    Every pilot is a long lived dispatcher (model_control.py pilot) that keeps claiming unrun rows
+    from the database until there are none left or its walltime is nearly used up, so python,
+    landlab and the database are started once per pilot instead of once per run.  Pilots claim
+    rows atomically (see ModelSelector.claim), so any number of them can share a database.
+
+    Arguments:
+        job_name -- the SLURM job name
+        pilots -- the number of pilot jobs (array tasks)
+        walltime -- the SLURM time limit of each pilot, e.g. "04:00:00"
+        database -- the parameter database
+        model -- the model class, e.g. diffusion_streampower_lem.SimpleLem
+        output_directory -- a directory/prefix for the model runs
+        filter -- a sqlite condition for the runs to claim
+        cpus -- the cpus per pilot; a pilot with more than one runs its models on that many processes
+        batch_size -- the number of compatible runs each pilot advances together
+        walltime_margin -- the seconds before the time limit after which a pilot starts no more runs
+    """
+    command = ["python", "model_control.py", "pilot", "-d", database, "-m", model, "-od", output_directory,
+               "--walltime", walltime, "--margin", str(walltime_margin)]
+    if filter:
+        command += ["-f", filter]
+    if int(cpus) > 1:
+        command += ["-p", str(cpus)]
+    if int(batch_size) > 1:
+        command += ["--batch_size", str(batch_size)]
+    slurm_file_str = f"""#!/bin/bash
+#SBATCH --job-name={job_name.replace(' ', '_')}
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --time={walltime}
+#SBATCH --array=1-{pilots}
+
+{" ".join(shlex.quote(str(c)) for c in command)} >> {output_file}
+"""
+    with open(slurm_path, 'w') as file:
+        file.write(slurm_file_str)
+
 
 class ModelDispatcher:
     """An object that creates and runs landlab models from a parameter database.
@@ -286,61 +694,193 @@ class ModelDispatcher:
         filter -- a sqlite statement to filter parameters by
         parameter_types -- a dictionary where the keys are model parameter columns and the values
                            are the python types of the parameter
-        self.client -- a daskclient for multiprocessing
+        self.executor -- the executor (dask or a process pool) used for multiprocessing
         self.processes -- the number of processes to run simultaneously
+        self.tasks_per_worker -- the number of runs queued on each worker at a time
+        self.batch_size -- the maximum number of compatible runs advanced together as one LandlabModelBatch
+        self.connection -- a long lived (WAL mode) connection used for reads
+        self.output_store -- the OutputStore finished runs are appended to, None if each run is saved to its own file
+        self.unsynced_runs -- outputs of the runs appended to the output_store since it was last synced
+        self.unsynced_since -- the time the first of the unsynced_runs was appended
+        self.run_writer -- the AsyncRunWriter writing each run's file in the background, None if they are written by the runs
+        self.writer -- a DatabaseWriter all bookkeeping writes go through
+        self.deadline -- the time after which no more runs are claimed, None without a walltime
+        self.warm_starter -- the WarmStarter picking the run each new run starts from, None without warm starts
+        self.wait_for_rows -- seconds to wait for new rows once none are left to claim, None to stop at once
+        self.longest_run -- the longest wall time of a run (or batch) so far, in seconds
     """
-    def __init__(self, database, model_class, out_dir="", filter=None, limit=None, processes=None):
-        """Creates a ModelDispatcher"""
+    def __init__(self, database, model_class, out_dir="", filter=None, limit=None, processes=None, max_write_delay=DEFAULT_MAX_DELAY,
+                 tasks_per_worker=2, backend="auto", max_tasks_per_child=None, batch_size=1,
+                 output_store=False, walltime=None, walltime_margin=DEFAULT_WALLTIME_MARGIN, warm_start=False,
+                 async_writes=False, wait_for_rows=None):
+        """Creates a ModelDispatcher
+
+        Bookkeeping writes are queued on a write-behind DatabaseWriter and committed
+        together at most max_write_delay seconds after they are made.  In multiprocessing
+        mode runs go to the given executor backend ("dask", "process" or "auto" for dask
+        if it is installed), each worker is kept tasks_per_worker runs deep, and process
+        pool workers are replaced after max_tasks_per_child runs if it is given.  With a
+        batch_size above one, claimed runs that share a grid and run controls are run
+        batch_size at a time in lock step (see LandlabModelBatch).  With output_store the
+        saved fields of every run go into a single batch_<batch_id>.nc OutputStore in
+        out_dir, written only by the dispatcher, rather than one netcdf file per run; the store
+        is synced every STORE_SYNC_RUNS runs or STORE_SYNC_DELAY seconds, and a run is recorded
+        as finished once it is synced.
+        With a walltime (seconds) the dispatcher works as a pilot job: it stops claiming
+        runs once the longest run so far would no longer finish walltime_margin seconds
+        before the walltime is up (see time_for_more_runs).  With warm_start every run starts
+        from the final node fields of the nearest finished run in parameter space (see
+        WarmStarter), which is recorded in the warm_start_donor column of the metadata table.
+        With async_writes (and no output_store) runs hand their fields back instead of writing
+        their own files, and an AsyncRunWriter writes them in the background while the next
+        runs go on; a run is recorded as finished once its file is synced to disk.
+        With wait_for_rows (seconds) the dispatcher does not stop as soon as every row is
+        claimed, but waits that long for new rows, such as those refine_in_rounds adds (see
+        claim_or_wait).
+        """
         self.database = database
         self.model_class = model_class
+        connection = connect_wal(database)
+        self.connection = connection
+        upgrade_db_for_dispatch(connection)
         self.parameter_list = ModelSelector(database, filter, limit)
-        self.batch_id = uuid.uuid4()
+        self.writer = DatabaseWriter(database, max_write_delay)
+        self.batch_id = str(uuid.uuid4())
         self.out_dir = out_dir
         self.filter = filter
-        connection = sqlite3.connect(database, check_same_thread=False)
         self.parameter_types = get_param_types(connection)
+        self.executor = None
         if processes is not None:
-            try:
-                from dask.distributed import Client
-                self.client = Client(threads_per_worker=1, n_workers=processes)
-            except ImportError:
-                print("Dask is required for multiprocessing at this time.  Install Dask in this python environment or use in single process mode.")
-                os._exit(os.EX_UNAVAILABLE)
+            self.executor = get_executor(backend, processes, max_tasks_per_child)
         self.processes = processes
+        self.tasks_per_worker = tasks_per_worker
+        self.batch_size = batch_size
+        self.output_store = None
+        if output_store:
+            self.output_store = OutputStore("%sbatch_%s.nc" % (out_dir, self.batch_id))
+        self.unsynced_runs = []
+        self.unsynced_since = None
+        self.run_writer = None
+        if async_writes and self.output_store is None:
+            self.run_writer = AsyncRunWriter()
+        # runs return their fields to the dispatcher rather than writing their own files
+        self.returns_fields = self.output_store is not None or self.run_writer is not None
+        self.deadline = None
+        if walltime is not None:
+            self.deadline = time.time() + walltime - walltime_margin
+        self.longest_run = 0.0
+        self.wait_for_rows = wait_for_rows
+        self.warm_starter = None
+        if warm_start:
+            add_warm_start_column(connection.cursor())
+            connection.commit()
+            self.warm_starter = WarmStarter(connection, out_dir, self.output_store)
         cursor = connection.cursor()
         outputs = cursor.execute("SELECT * FROM model_run_outputs")
         self.valid_outputs = [d[0] for d in outputs.description]
         cursor.close()
 
+    def time_for_more_runs(self):
+        """Returns True if another run is expected to finish before the deadline.
+
+        In multiprocessing mode a newly claimed run waits behind tasks_per_worker runs on
+        its worker, so that many of the longest runs so far have to fit.
+        """
+        if self.deadline is None:
+            return True
+        queued = self.tasks_per_worker if self.processes is not None else 1
+        return time.time() + self.longest_run * queued < self.deadline
+
+    def claim(self, n=1):
+        """Claims up to n runs for this dispatcher, or none once the walltime budget is used up."""
+        if not self.time_for_more_runs():
+            return []
+        return self.parameter_list.claim(n, self.batch_id)
+
+    def claim_or_wait(self, n=1):
+        """Claims up to n runs, waiting up to wait_for_rows seconds for new rows if none are left.
+
+        Only called when none of this dispatcher's runs are in progress.  The finished runs are
+        recorded before waiting, so whatever adds the new rows (e.g. refine_in_rounds) sees
+        their results.
+        """
+        claimed = self.claim(n)
+        if claimed or not self.wait_for_rows:
+            return claimed
+        self.record_written_runs(wait=True)
+        self.writer.flush()
+        give_up = time.time() + self.wait_for_rows
+        while not claimed and time.time() < give_up and self.time_for_more_runs():
+            print("waiting for new runs")
+            time.sleep(max(0.0, min(ROW_POLL_INTERVAL, give_up - time.time())))
+            claimed = self.claim(n)
+        return claimed
+
+    def warm_starts(self, runs):
+        """The warm start of each claimed (run_param_id, model_run_id, param_dict) run, or None without warm starts."""
+        if self.warm_starter is None:
+            return None
+        return [self.warm_starter.warm_start(model_run_id, param_dict) for _, model_run_id, param_dict in runs]
+
     def run_a_model(self):
-        """Grabs the next set of parameters, creates a model, and runs it."""
-        try:
-            run_id, param_dict = self.parameter_list.next()
-            self.dispatch_model(run_id, param_dict)
-        except StopIteration:
+        """Claims the next set of parameters, creates a model, and runs it."""
+        claimed = self.claim(1)
+        if claimed:
+            run_id, model_run_id, param_dict = claimed[0]
+            self.dispatch_model(run_id, param_dict, model_run_id)
+        else:
             self.end_batch()
 
     def end_batch(self):
         """Little handler for when there are no more parameters"""
+        self.record_written_runs(wait=True)
+        self.writer.flush()
         print("no more to run")
 
+    def close(self):
+        """Commits any queued bookkeeping, stops the executor, and closes the database connections."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.record_written_runs(wait=True)
+        if self.output_store is not None:
+            self.output_store.close()
+        if self.run_writer is not None:
+            self.run_writer.close()
+        self.writer.close()
+        self.connection.close()
+        self.parameter_list.connection.close()
+
     def run_all(self):
         """Runs all the models in the ModelSelector.
 
-        Dispatches to dask client if in multiprocessign mode.
+        Dispatches to the executor if in multiprocessign mode.
         """
         if self.processes is not None:
-            self.run_models_on_dask()
+            self.run_models_in_parallel()
+        elif self.batch_size > 1:
+            claimed = self.claim_or_wait(self.batch_size)
+            while claimed:
+                for runs in group_runs(claimed, self.batch_size):
+                    for outputs in make_and_run_model_batch(self.model_class, self.batch_id, runs, self.out_dir,
+                                                            self.returns_fields, self.warm_starts(runs)):
+                        self.record_finished_run(outputs)
+                self.record_written_runs()
+                claimed = self.claim_or_wait(self.batch_size)
         else:
-            for run_id, param_dict in self.parameter_list:
-                self.dispatch_model(run_id, param_dict)
+            claimed = self.claim_or_wait(1)
+            while claimed:
+                run_id, model_run_id, param_dict = claimed[0]
+                self.dispatch_model(run_id, param_dict, model_run_id)
+                self.record_written_runs()
+                claimed = self.claim_or_wait(1)
         self.end_batch()
 
     def get_unfinished_runs(self):
         """Finds all the runs in the database that were started but never finished."""
         # should this be moved to the ModelSelector class?
-        connection = sqlite3.connect(self.database, check_same_thread=False)
-        cursor = connection.cursor()
+        self.writer.flush()
+        cursor = self.connection.cursor()
         selection_statement = "SELECT model_run_id FROM model_run_metadata WHERE model_start_time IS NOT NULL AND model_end_time IS NULL"
         if self.filter:
             selection_statement = "%s AND %s" % (selection_statement, self.filter)
@@ -353,15 +893,17 @@ class ModelDispatcher:
 
     def reset_model(self, model_run_id, clear_metadata=True):
         """Takes a given model run, sets it as unrun, and deletes the corresponding  metadata table entry."""
-        connection = sqlite3.connect(self.database, check_same_thread=False)
-        cursor = connection.cursor()
-        update_statement = "UPDATE model_run_params SET model_run_id = NULL, model_batch_id = NULL WHERE model_run_id = \"%s\"" % model_run_id
-        cursor.execute(update_statement)
+        self.writer.execute("UPDATE model_run_params SET model_run_id = NULL, model_batch_id = NULL WHERE model_run_id = ?", (model_run_id,))
         if clear_metadata:
-            delete_statement = "DELETE FROM model_run_metadata WHERE model_run_id = \"%s\"" % model_run_id
-            cursor.execute(delete_statement)
-        connection.commit()
-        cursor.close()
+            self.writer.execute("DELETE FROM model_run_metadata WHERE model_run_id = ?", (model_run_id,))
+
+    def resume_unfinished_runs(self):
+        """Runs that started but never finished are run again first, continuing from their checkpoints.
+
+        Unlike clean_unfinished_runs the runs keep their model run ids.
+        """
+        resumed = self.parameter_list.queue_unfinished()
+        print("resuming %d unfinished runs" % resumed)
 
     def clean_unfinished_runs(self, clear_metadata=True):
         """Resets all model runs that started but never finished"""
@@ -369,106 +911,181 @@ class ModelDispatcher:
         if unfinished_runs:
             for model_run in unfinished_runs:
                 self.reset_model(model_run, clear_metadata)
+            self.writer.flush()
 
                 
 
-    def run_models_on_dask(self):
-        """Runs all the models by dispatching them to the corresponding dask client."""
-        # First we do some setup, with two variables to keep track of things.
-        model_runs = []
-        parameter_list_empty = False
-        # Now we "seed" the dask client with two model runs for every worker (assuming there are enough).
-        for _ in range(2*self.processes):
-            try:
-                run_id, param_dict = self.parameter_list.next()
-                model_run = self.dispatch_model_to_dask(run_id, param_dict)
-                model_runs.append(model_run)
-            except StopIteration:
-                break
-        # Now we loop, checking for finished runs and handeling the database work needed, and adding new runs.
-        while True:
-            # First we try finding any finished models in the model_runs list
-            try:
-                index = [model.status for model in model_runs].index('finished') # this is what should pop the ValueError
-                # if we get one, pop it out, and record it in the database
-                finished_run = model_runs.pop(index)
-                self.record_finished_run(finished_run.result())
-                # check to see if we have no more parameters to run, and no more model runs to wait for
-                if parameter_list_empty and len(model_runs)==0:
-                    # if we do, break out of the loop and end the function
-                    break
-                try:
-                    # if so, try go grab a new parameter and add that to the dask queue to run
-                    run_id, param_dict = self.parameter_list.next()
-                    model_run = self.dispatch_model_to_dask(run_id, param_dict)
-                    model_runs.append(model_run)
-                except StopIteration:
-                    # if we've run out of model parameters toggle our boolean so we just wait for our existing runs to finish
-                    parameter_list_empty = True
-            except ValueError:
-                # if no models are finished running, check again
-                # should we add a timer to wait here?
-                pass
-
-                 
+    def run_models_in_parallel(self):
+        """Runs all the models by dispatching them to the executor.
+
+        Every worker is kept tasks_per_worker runs deep.  The dispatcher blocks until at
+        least one run finishes, records the finished runs and replaces each of them with
+        a newly claimed one, so it sleeps while the models run instead of polling them.
+        """
+        # "seed" the executor with tasks_per_worker model runs (or batches) for every worker (assuming there are enough).
+        model_runs = self.dispatch_claimed(self.claim_or_wait(self.tasks_per_worker*self.processes*self.batch_size))
+        while model_runs:
+            finished_runs, model_runs = self.executor.wait(model_runs)
+            for finished_run in finished_runs:
+                self.record_model_run(finished_run)
+                model_runs |= self.dispatch_claimed(self.claim(self.batch_size))
+            self.record_written_runs()
+            if not model_runs:
+                model_runs = self.dispatch_claimed(self.claim_or_wait(self.tasks_per_worker*self.processes*self.batch_size))
+
+    def dispatch_claimed(self, claimed):
+        """Submits claimed runs to the executor, grouped into batches if batch_size is above one.
+
+        Returns the set of submitted futures.
+        """
+        if self.batch_size == 1:
+            return {self.dispatch_model_to_executor(run_id, param_dict, model_run_id)
+                    for run_id, model_run_id, param_dict in claimed}
+        return {self.executor.submit(make_and_run_model_batch, self.model_class, self.batch_id, runs, self.out_dir,
+                                     self.returns_fields, self.warm_starts(runs))
+                for runs in group_runs(claimed, self.batch_size)}
+
+    def record_model_run(self, model_run):
+        """Records the outputs of a finished model run (or batch of runs) future.
+
+        A run that raised is reported and left unfinished in the metadata table, so it
+        can be reset with clean_unfinished_runs.
+        """
+        try:
+            outputs = model_run.result()
+        except Exception as error:
+            print("model run failed: %r" % error)
+            return
+        if isinstance(outputs, list):
+            for run_outputs in outputs:
+                self.record_finished_run(run_outputs)
+        else:
+            self.record_finished_run(outputs)
+
     def record_finished_run(self, outputs):
-        """For a given run_id set that run end time in the metadata table."""
-        connection = sqlite3.connect(self.database, check_same_thread=False)
-        cursor = connection.cursor()
-        metadata_update_statement = "UPDATE model_run_metadata SET model_end_time = %f WHERE model_run_id = \"%s\"" %(outputs['end_time'], outputs['model_run_id'])
-        cursor.execute(metadata_update_statement)
+        """For a given run_id set that run end time in the metadata table.
+
+        Fields returned for the OutputStore are appended, and the run is marked as finished
+        once the store is synced.  Fields returned for the AsyncRunWriter are queued to be
+        written, and the run is marked as finished once its file is written.  See
+        record_written_runs.
+        """
+        self.longest_run = max(self.longest_run, outputs['end_time'] - outputs['start_time'])
+        if "node_fields" not in outputs:
+            self.record_outputs(outputs)
+        elif self.output_store is None:
+            self.run_writer.put("%s%s.nc" % (self.out_dir, outputs['model_run_id']), outputs)
+        else:
+            self.output_store.append(outputs)
+            if not self.unsynced_runs:
+                self.unsynced_since = time.time()
+            # the fields are not needed once appended; only the bookkeeping waits for the sync
+            self.unsynced_runs.append({key: value for key, value in outputs.items()
+                                       if key not in ("node_fields", "grid_topology")})
+            self.record_written_runs()
+
+    def record_written_runs(self, wait=False):
+        """Marks the runs whose fields are on disk as finished.
+
+        Runs appended to the OutputStore are marked once it is synced, which is done when
+        STORE_SYNC_RUNS runs are waiting or the first of them has waited STORE_SYNC_DELAY
+        seconds, so a run is never recorded as finished long before its fields are saved.
+        Runs queued on the AsyncRunWriter are marked once their files are written.  With
+        wait, the store is synced and every queued file waited for first.  A run whose file
+        could not be written is reported and left unfinished, so it can be reset with
+        clean_unfinished_runs.
+        """
+        if self.unsynced_runs and (wait or len(self.unsynced_runs) >= STORE_SYNC_RUNS
+                                   or time.time() - self.unsynced_since >= STORE_SYNC_DELAY):
+            self.output_store.sync()
+            for outputs in self.unsynced_runs:
+                self.record_outputs(outputs)
+            self.unsynced_runs = []
+        if self.run_writer is None:
+            return
+        for outputs in (self.run_writer.flush() if wait else self.run_writer.finished()):
+            if "write_error" in outputs:
+                print("could not write run %s: %r" % (outputs['model_run_id'], outputs["write_error"]))
+                continue
+            if "resources" in outputs:
+                outputs["resources"]["output_bytes"] = outputs["output_bytes"]
+            self.record_outputs(outputs)
+
+    def record_outputs(self, outputs):
+        """Marks a run whose fields are saved as finished and records its outputs."""
+        self.writer.execute("UPDATE model_run_metadata SET model_end_time = ? WHERE model_run_id = ?",
+                            (outputs['end_time'], outputs['model_run_id']))
+        if "resources" in outputs:
+            self.writer.execute(resource_update_sql(), resource_values(outputs["resources"], outputs['model_run_id']))
+        if "timings" in outputs:
+            self.writer.executemany(TIMING_INSERT_SQL, [(outputs['model_run_id'],) + tuple(row) for row in outputs["timings"]])
+        if "warm_start_donor" in outputs:
+            self.writer.execute(WARM_START_UPDATE_SQL, (outputs["warm_start_donor"], outputs['model_run_id']))
+        if self.warm_starter is not None:
+            self.warm_starter.finished(outputs['model_run_id'])
         valid_outputs = {key: outputs[key] for key in outputs.keys() if key in self.valid_outputs}
-        columns = str(tuple(valid_outputs.keys()))
-        values = str(tuple(valid_outputs.values()))
-        query_str = "INSERT INTO model_run_outputs %s VALUES %s;" % (columns, values)
-        cursor.execute(query_str)
-        connection.commit()
-        cursor.close()
+        columns = ", ".join(["\"%s\"" % column for column in valid_outputs.keys()])
+        placeholder_string = ", ".join(["?"]*len(valid_outputs))
+        self.writer.execute("INSERT INTO model_run_outputs (%s) VALUES (%s)" % (columns, placeholder_string),
+                            tuple(valid_outputs.values()))
                 
-    def dispatch_model_to_dask(self, run_id, param_dict):
-        """For a given model parameter list, submit the model creation and run to dask."""
-        model_run_id = str(uuid.uuid4())
-        start_time = time.time()
-        self.set_model_as_in_progress(self.batch_id, model_run_id, run_id, start_time)
-        model_run = self.client.submit(make_and_run_model, self.model_class, self.batch_id, model_run_id, param_dict, self.out_dir)
+    def dispatch_model_to_executor(self, run_id, param_dict, model_run_id=None):
+        """For a given model parameter list, submit the model creation and run to the executor.
+
+        If no model_run_id is given the parameters are marked as in progress first, otherwise
+        they are assumed to already be claimed (see ModelSelector.claim).
+        """
+        if model_run_id is None:
+            model_run_id = str(uuid.uuid4())
+            start_time = time.time()
+            self.set_model_as_in_progress(self.batch_id, model_run_id, run_id, start_time)
+        warm_start = None
+        if self.warm_starter is not None:
+            warm_start = self.warm_starter.warm_start(model_run_id, param_dict)
+        model_run = self.executor.submit(make_and_run_model, self.model_class, self.batch_id, model_run_id, param_dict, self.out_dir, run_id,
+                                         self.returns_fields, warm_start)
         return model_run
 
     def set_model_as_in_progress(self, model_batch_id, model_run_id, param_run_id, start_time):
         """Update the metadata and parameter table to indicate that this given parameter set is running or queued for running."""
-        connection = sqlite3.connect(self.database, check_same_thread=False)
-        cursor = connection.cursor()
-        update_statement = "UPDATE model_run_params SET model_batch_id = \"%s\", model_run_id = \"%s\" WHERE run_param_id = %d" % (model_batch_id, model_run_id, param_run_id)
-        cursor.execute(update_statement)
-        start_time = time.time()
-        metadata_insert_statement = "INSERT INTO model_run_metadata (model_run_id, model_batch_id, model_start_time) VALUES (\"%s\", \"%s\", %f)" % (model_run_id, model_batch_id, start_time)
-        cursor.execute(metadata_insert_statement)
-        connection.commit()
-        cursor.close()
+        self.writer.execute("UPDATE model_run_params SET model_batch_id = ?, model_run_id = ? WHERE run_param_id = ?",
+                            (str(model_batch_id), model_run_id, param_run_id))
+        self.writer.execute("INSERT INTO model_run_metadata (model_run_id, model_batch_id, model_start_time) VALUES (?, ?, ?)",
+                            (model_run_id, str(model_batch_id), start_time))
+
+    def dispatch_model(self, run_id, param_dict, model_run_id=None):
+        """Create and run a model.  Used for single process mode.
 
-    def dispatch_model(self, run_id, param_dict):
-        """Create and run a model.  Used for single process mode."""
+        If no model_run_id is given the parameters are marked as in progress first, otherwise
+        they are assumed to already be claimed (see ModelSelector.claim).
+        """
         # Probably could be rewritten to use some of the functions used in the dask mode.
         print("dispatching model %d" % run_id)
-        connection = sqlite3.connect(self.database, check_same_thread=False)
-        cursor = connection.cursor()
-        model_run_id = str(uuid.uuid4())
-        model = self.model_class(param_dict)
+        dispatch_start = time.time()
+        usage = ResourceUsage()
+        setup_start = time.perf_counter()
+        model = MODEL_POOL.get(self.model_class, param_dict)
+        model.timer.add("setup", time.perf_counter() - setup_start)
         model.batch_id = self.batch_id
-        model.run_id = model_run_id
-        update_statement = "UPDATE model_run_params SET model_batch_id = \"%s\", model_run_id = \"%s\" WHERE run_param_id = %d" % (model.batch_id, model.run_id, run_id)
-        cursor.execute(update_statement)
-        start_time = time.time()
-        metadata_insert_statement = "INSERT INTO model_run_metadata (model_run_id, model_batch_id, model_start_time) VALUES (\"%s\", \"%s\", %f)" % (model.run_id, model.batch_id, start_time)
-        cursor.execute(metadata_insert_statement)
-        connection.commit()
-        cursor.close()
-        model.update_until(model.run_duration, model.dt)
+        if model_run_id is None:
+            model.run_id = str(uuid.uuid4())
+            self.set_model_as_in_progress(model.batch_id, model.run_id, run_id, time.time())
+        else:
+            model.run_id = model_run_id
+        set_checkpoint(model, param_dict, self.out_dir, run_id)
+        donor = None
+        if self.warm_starter is not None:
+            donor = apply_warm_start(model, self.warm_starter.warm_start(model.run_id, param_dict))
+        with model.timer.time("run"):
+            model.run()
         end_time = time.time()
-        cursor = connection.cursor()
-        metadata_update_statement = "UPDATE model_run_metadata SET model_end_time = %f WHERE model_run_id = \"%s\"" %(end_time, str(model.run_id))
-        cursor.execute(metadata_update_statement)
-        connection.commit()
-        output_f = "%s%s.nc" % (self.out_dir, model.run_id)
-        model.grid.save(output_f)
+        # the outputs are recorded like those of every other path, so refinement sees the run
+        outputs = save_model_run(model, dispatch_start, end_time, self.out_dir, run_id, to_store=self.returns_fields)
+        outputs["resources"] = usage.stop(outputs["output_bytes"])
+        if donor is not None:
+            outputs["warm_start_donor"] = donor
+        model.remove_checkpoint()
+        MODEL_POOL.put(model)
+        self.record_finished_run(outputs)
 
     
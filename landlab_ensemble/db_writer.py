@@ -0,0 +1,169 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_DELAY = 1.0  # seconds a write may wait before it is committed
+DEFAULT_MAX_BATCH = 1000  # statements per transaction
+BUSY_TIMEOUT = 60.0  # seconds to wait on another process holding the write lock
+FLUSH_POLL_INTERVAL = 0.5  # seconds between checks that the writer thread is still alive while flushing
+
+_STOP = object()
+
+def connect_wal(database, check_same_thread=False):
+    """Opens a connection to a database in WAL mode.
+
+    WAL lets readers (status queries, other dispatchers selecting parameters) keep
+    working while a write transaction is open, and synchronous=NORMAL only syncs at
+    checkpoints rather than on every commit.
+    """
+    connection = sqlite3.connect(database, check_same_thread=check_same_thread, timeout=BUSY_TIMEOUT)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    return connection
+
+def _run_statement(connection, statement):
+    """Runs a queued (many, sql, parameters) statement on a connection."""
+    many, sql, parameters = statement
+    if many:
+        connection.executemany(sql, parameters)
+    else:
+        connection.execute(sql, parameters)
+
+class DatabaseWriter:
+    """A write-behind writer that owns the only write connection a dispatcher uses.
+
+    Statements are queued and a background thread groups them into a single
+    transaction once the oldest queued statement has waited max_delay seconds
+    or max_batch statements are waiting, whichever comes first.  The statements
+    are buffered in memory until then, so the database write lock is only held
+    for the commit itself.  flush() blocks until everything queued so far is
+    committed, and close() (also registered to run at interpreter exit) flushes
+    and stops the thread.
+
+    Attributes:
+        database -- the path of the database written to
+        max_delay -- the maximum number of seconds a statement waits before being committed
+        max_batch -- the maximum number of statements committed in one transaction
+        error -- the last sqlite error raised in the writer thread, re-raised by flush()
+        failure -- the exception that stopped the writer thread, re-raised by flush() and close()
+    """
+    def __init__(self, database, max_delay=DEFAULT_MAX_DELAY, max_batch=DEFAULT_MAX_BATCH):
+        """Starts the writer thread for a database.
+
+        Args:
+            database -- the database path to write to
+            max_delay -- the maximum number of seconds a statement waits before being committed
+            max_batch -- the maximum number of statements committed in one transaction
+        """
+        self.database = database
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.error = None
+        self.failure = None
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="DatabaseWriter", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def execute(self, sql, parameters=()):
+        """Queues a single statement."""
+        self._put((False, sql, parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        """Queues a statement to be run once for each set of parameters."""
+        self._put((True, sql, list(seq_of_parameters)))
+
+    def flush(self):
+        """Blocks until every statement queued so far has been committed."""
+        if not self._closed:
+            done = threading.Event()
+            self._queue.put(done)
+            # a writer thread that died (see failure) never sets done
+            while not done.wait(FLUSH_POLL_INTERVAL) and self._thread.is_alive():
+                pass
+        self._raise_error()
+
+    def close(self):
+        """Commits everything still queued and stops the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        atexit.unregister(self.close)
+        self._raise_error()
+
+    def _put(self, item):
+        if self._closed:
+            raise RuntimeError("DatabaseWriter for %s is closed" % self.database)
+        if self.failure is not None:
+            raise RuntimeError("DatabaseWriter for %s has stopped" % self.database) from self.failure
+        self._queue.put(item)
+
+    def _raise_error(self):
+        if self.failure is not None:
+            raise self.failure
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _commit(self, connection, pending):
+        """Runs the buffered statements in one transaction.
+
+        If the transaction fails it is rolled back and the statements are retried one at
+        a time, so a single bad statement does not lose the rest of the batch.
+        """
+        if not pending:
+            return
+        try:
+            with connection:
+                for statement in pending:
+                    _run_statement(connection, statement)
+        except sqlite3.Error:
+            for statement in pending:
+                try:
+                    with connection:
+                        _run_statement(connection, statement)
+                except sqlite3.Error as error:
+                    print("DatabaseWriter failed to run %r: %s" % (statement[1], error))
+                    self.error = error
+        pending.clear()
+
+    def _run(self):
+        connection = None
+        try:
+            connection = connect_wal(self.database, check_same_thread=True)
+            self._write_batches(connection)
+        except Exception as failure:
+            print("DatabaseWriter for %s stopped: %r" % (self.database, failure))
+            self.failure = failure
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def _write_batches(self, connection):
+        """Commits the queued statements in batches until the writer is stopped."""
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if not pending else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._commit(connection, pending)
+                continue
+            if item is _STOP:
+                self._commit(connection, pending)
+                return
+            if isinstance(item, threading.Event):
+                self._commit(connection, pending)
+                item.set()
+                continue
+            if not pending:
+                deadline = time.monotonic() + self.max_delay
+            pending.append(item)
+            if len(pending) >= self.max_batch:
+                self._commit(connection, pending)
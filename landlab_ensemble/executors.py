@@ -0,0 +1,83 @@
+import concurrent.futures
+import multiprocessing
+import sys
+
+class DaskExecutor:
+    """Runs model tasks on a local dask.distributed cluster.
+
+    Attributes:
+        client -- the dask client
+    """
+    def __init__(self, processes, max_tasks_per_child=None):
+        """Starts a local dask cluster with one single threaded worker per process."""
+        from dask.distributed import Client
+        if max_tasks_per_child is not None:
+            print("max_tasks_per_child is only supported by the process backend, ignoring it for dask.")
+        self.client = Client(threads_per_worker=1, n_workers=processes)
+
+    def submit(self, function, *args):
+        """Submits a task, returning its future."""
+        # pure=False as two runs with the same arguments should still both run
+        return self.client.submit(function, *args, pure=False)
+
+    def wait(self, futures):
+        """Blocks until at least one future is finished, returning the finished and unfinished futures."""
+        from dask.distributed import wait
+        done, not_done = wait(list(futures), return_when="FIRST_COMPLETED")
+        return set(done), set(not_done)
+
+    def shutdown(self):
+        """Stops the cluster."""
+        self.client.close()
+
+class ProcessPoolBackend:
+    """Runs model tasks on a standard library process pool.
+
+    Worker processes can be recycled after max_tasks_per_child runs, which keeps memory
+    that models leak (or that the allocator does not give back) from piling up over a
+    long batch.
+
+    Attributes:
+        pool -- the concurrent.futures.ProcessPoolExecutor
+    """
+    def __init__(self, processes, max_tasks_per_child=None):
+        """Starts a pool of processes, recycled every max_tasks_per_child runs if given."""
+        pool_args = {"max_workers": processes}
+        if max_tasks_per_child is not None:
+            if sys.version_info < (3, 11):
+                print("max_tasks_per_child needs python 3.11 or newer, workers will not be recycled.")
+            else:
+                pool_args["max_tasks_per_child"] = max_tasks_per_child
+                pool_args["mp_context"] = multiprocessing.get_context("spawn")
+        self.pool = concurrent.futures.ProcessPoolExecutor(**pool_args)
+
+    def submit(self, function, *args):
+        """Submits a task, returning its future."""
+        return self.pool.submit(function, *args)
+
+    def wait(self, futures):
+        """Blocks until at least one future is finished, returning the finished and unfinished futures."""
+        done, not_done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        return set(done), set(not_done)
+
+    def shutdown(self):
+        """Waits for running tasks and stops the worker processes."""
+        self.pool.shutdown()
+
+EXECUTOR_BACKENDS = {"dask": DaskExecutor,
+                     "process": ProcessPoolBackend}
+
+def get_executor(backend, processes, max_tasks_per_child=None):
+    """Creates the executor for a backend name.
+
+    "auto" uses dask if it is installed and a process pool otherwise.
+    """
+    if backend == "auto":
+        try:
+            import dask.distributed
+            backend = "dask"
+        except ImportError:
+            backend = "process"
+    if backend not in EXECUTOR_BACKENDS:
+        raise ValueError("Unknown executor backend '%s', expected one of %s" % (backend, ", ".join(["auto"] + list(EXECUTOR_BACKENDS))))
+    return EXECUTOR_BACKENDS[backend](processes, max_tasks_per_child)
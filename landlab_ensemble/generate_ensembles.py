@@ -1,8 +1,9 @@
 import json
 import re
 import numpy as np
-from copy import deepcopy
 import sqlite3
+import itertools
+import time
 from collections.abc import MutableMapping
 
 MODEL_PARAM_TABLE_SQL_START = """
@@ -15,6 +16,10 @@ MODEL_PARAM_TABLE_SQL_END = """
 );
 """
 
+TEMPLATE_TABLE_SQL_START = """
+CREATE TABLE model_param_template (
+    template_id INTEGER PRIMARY KEY AUTOINCREMENT"""
+
 MODEL_RUN_TABLE_SQL = """
 CREATE TABLE model_run_metadata (
     run_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -32,6 +37,19 @@ CREATE TABLE model_param_dimension (
 );
                       """
 
+TIMING_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS model_run_timing (
+    model_run_id TEXT,
+    timer TEXT,
+    calls INTEGER,
+    total REAL,
+    mean REAL,
+    p50 REAL,
+    p95 REAL,
+    max REAL
+);
+"""
+
 OUTPUT_TABLE_SQL = """
 CREATE TABLE model_run_outputs (
     output_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -39,6 +57,18 @@ CREATE TABLE model_run_outputs (
     model_batch_id TEXT,
 """
 
+DEFAULT_CHUNK_SIZE = 10000
+BULK_BUILD_PRAGMAS = ("PRAGMA journal_mode = MEMORY",
+                      "PRAGMA synchronous = OFF",
+                      "PRAGMA cache_size = -65536")
+
+# Partial indexes so that finding unrun rows (and looking runs up by id) does not scan the table
+MODEL_RUN_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS model_run_params_unrun ON model_run_params (run_param_id) WHERE model_run_id IS NULL;",
+    "CREATE INDEX IF NOT EXISTS model_run_params_run_id ON model_run_params (model_run_id) WHERE model_run_id IS NOT NULL;",
+    "CREATE INDEX IF NOT EXISTS model_run_metadata_run_id ON model_run_metadata (model_run_id);",
+)
+
 def _flatten_dict_gen(d, parent_key, sep):
     """Takes a dictionary and returns a new "flat" generator with old heirarchy represented in key (from StackOverflow)."""
     for k, v in d.items():
@@ -71,16 +101,50 @@ def python_type_to_sql_type(value):
     else:
         return "TEXT"
 
-def generate_model_param_table_sql(run_params):
-    """Returns a sqlite string for a table with a column for every model parameter."""
+def _column_definitions(flat_run_params, columns=None):
+    """Returns the column definitions for the given flattened parameters (all of them if columns is None)."""
+    if columns is None:
+        columns = flat_run_params.keys()
+    definitions = ""
+    for param in columns:
+        param_type = python_type_to_sql_type(flat_run_params[param])
+        definitions += "\"%s\" %s," % (param, param_type)
+    return definitions
+
+def generate_model_param_table_sql(run_params, columns=None):
+    """Returns a sqlite string for a table with a column for every model parameter.
+
+    If a list of (flattened, "model_param" prefixed) columns is given only those
+    parameters get a column, which is used for the normalized layout.
+    """
     table_creation_sql = MODEL_PARAM_TABLE_SQL_START
     flat_run_params = flatten_dict(run_params, "model_param")
-    for param, value in flat_run_params.items():
-        param_type = python_type_to_sql_type(value)
-        table_creation_sql += "\"%s\" %s," % (param, param_type)
+    table_creation_sql += _column_definitions(flat_run_params, columns)
     table_creation_sql += MODEL_PARAM_TABLE_SQL_END
     return table_creation_sql
 
+def generate_model_template_table_sql(run_params, columns):
+    """Returns a sqlite string for the batch template table holding the given constant parameter columns."""
+    table_creation_sql = TEMPLATE_TABLE_SQL_START
+    flat_run_params = flatten_dict(run_params, "model_param")
+    if columns:
+        table_creation_sql += ",\n" + _column_definitions(flat_run_params, columns).rstrip(",")
+    table_creation_sql += "\n);"
+    return table_creation_sql
+
+def split_constant_columns(run_params, dynamic_params):
+    """Splits the flattened parameter columns into constant and dynamic ones.
+
+    Args:
+        run_params -- a parameter dictionary
+        dynamic_params -- the flattened names of the dynamic parameters (as returned by get_dynamic_params)
+    Returns:
+        a list of constant columns and a list of dynamic columns, both prefixed with "model_param"
+    """
+    dynamic_columns = ["model_param." + param for param in dynamic_params]
+    constant_columns = [column for column in flatten_dict(run_params, "model_param") if column not in dynamic_columns]
+    return constant_columns, dynamic_columns
+
 def generate_model_param_dim_table_sql(run_params):
     """Returns a sqlite string to insert parameter and value information into the dimension table.""" 
     flat_run_params = flatten_dict(run_params, "model_param")
@@ -96,11 +160,36 @@ def generate_model_output_table_sql(run_params):
     return table_creation_sql
         
 
-def generate_model_run_db(db_path, params):
-    """Generates a sqlite table with parameter information."""
+def create_model_run_indexes(cursor):
+    """Creates the indexes used to claim unrun parameter rows (a no-op if they already exist)."""
+    for index_sql in MODEL_RUN_INDEX_SQL:
+        cursor.execute(index_sql)
+
+def create_model_run_timing_table(cursor):
+    """Creates the table that per-run timer summaries are recorded in (a no-op if it already exists)."""
+    cursor.execute(TIMING_TABLE_SQL)
+
+def generate_model_run_db(db_path, params, dynamic_params=None):
+    """Generates a sqlite table with parameter information.
+
+    If the names of the dynamic parameters are given the database uses the normalized
+    layout: constant parameters are stored once in the model_param_template table and
+    model_run_params only gets columns for the dynamic parameters.
+    """
     sqliteConnection = sqlite3.connect(db_path)
     cursor = sqliteConnection.cursor()
-    model_param_sql = generate_model_param_table_sql(params)
+    if dynamic_params is None:
+        model_param_sql = generate_model_param_table_sql(params)
+    else:
+        constant_columns, dynamic_columns = split_constant_columns(params, dynamic_params)
+        model_param_sql = generate_model_param_table_sql(params, dynamic_columns)
+        cursor.execute(generate_model_template_table_sql(params, constant_columns))
+        flat_params = flatten_dict(params, "model_param")
+        if constant_columns:
+            cursor.execute(_insert_sql(constant_columns, "model_param_template"),
+                           [_sql_value(flat_params[column]) for column in constant_columns])
+        else:
+            cursor.execute("INSERT INTO model_param_template DEFAULT VALUES")
     cursor.execute(model_param_sql)
     cursor.execute(MODEL_RUN_TABLE_SQL)
     cursor.execute(PARAM_DIM_TABLE_SQL)
@@ -108,12 +197,22 @@ def generate_model_run_db(db_path, params):
     cursor.execute(param_dim_sql)
     output_sql = generate_model_output_table_sql(params)
     cursor.execute(output_sql)
+    create_model_run_timing_table(cursor)
+    create_model_run_indexes(cursor)
     sqliteConnection.commit()
     cursor.close()
+    sqliteConnection.close()
 
-DYNAMIC_PARAM_KEYS = ["ITERATIVE", "RANDOM"]
+DYNAMIC_PARAM_KEYS = ["ITERATIVE", "RANDOM", "SAMPLE"]
 ITER_PARAM_RE = re.compile(r"ITERATIVE\s+(\w+)\s+(\{.*\})")
 RANDOM_PARAM_RE = re.compile(r"RANDOM\s+(\w+)\s+(\{.*\})")
+SAMPLE_PARAM_RE = re.compile(r"SAMPLE\s+(\w+)\s+(\{.*\})")
+# scipy.stats.qmc engines for the SAMPLE designs
+SAMPLE_DESIGNS = {"lhs": "LatinHypercube",
+                  "sobol": "Sobol",
+                  "halton": "Halton"}
+DEFAULT_SAMPLE_DESIGN = "sample"
+DEFAULT_SAMPLE_SEED = 0
 VALID_GENERATORS = {"linspace": np.linspace,
                     "arange": np.arange,
                     "logspace": np.logspace,
@@ -168,18 +267,140 @@ def generate_random_parameter_array(random_param_value, rng=np.random.default_rn
         args['size'] == (1)
     return scaler*function(**args)+shifter
 
+def sample_unit_hypercube(method, n, dimensions, seed=DEFAULT_SAMPLE_SEED):
+    """Draws n points of a space filling design in the unit hypercube with scipy.stats.qmc.
+
+    Args:
+        method -- the design, one of SAMPLE_DESIGNS (sobol designs are best with a power of two points)
+        n -- the number of points
+        dimensions -- the number of parameters sampled together
+        seed -- the seed of the (scrambled or randomized) design
+    Returns:
+        an (n, dimensions) array of values in [0, 1)
+    """
+    from scipy.stats import qmc
+    engine = getattr(qmc, SAMPLE_DESIGNS[method])
+    try:
+        sampler = engine(d=dimensions, rng=seed)
+    except TypeError:
+        # scipy before 1.15 calls it seed
+        sampler = engine(d=dimensions, seed=seed)
+    return sampler.random(n)
+
+def scale_samples(unit_values, low, high, scale="linear"):
+    """Maps values in [0, 1) onto [low, high), uniformly in value ("linear") or in order of magnitude ("log")."""
+    if scale == "linear":
+        return low + unit_values*(high - low)
+    elif scale == "log":
+        if low <= 0 or high <= 0:
+            raise ValueError("a log scaled sample range has to be positive, got [%s, %s]" % (low, high))
+        return 10**(np.log10(low) + unit_values*(np.log10(high) - np.log10(low)))
+    raise ValueError("unknown sample scale %r, expected 'linear' or 'log'" % scale)
+
+def generate_sample_designs(flat_params, sample_keys):
+    """Draws the points of every SAMPLE design in a flattened parameter dictionary.
+
+    This function expects a sample parameter to be defined with the following pattern:
+    "SAMPLE <design method> {"range": [<low>, <high>], ...}"
+    where the design method is one of SAMPLE_DESIGNS.  All sample parameters with the same
+    "design" name (default "sample") are drawn jointly as one design of "n" points, seeded
+    with "seed" (default 0) so the same file always gives the same runs.  The method, n and
+    seed have to agree between the parameters of a design (and can be given on just one of
+    them).  Each parameter has its own "range" and "scale" ("linear", the default, or "log").
+    Args:
+        flat_params -- a flattened parameter dictionary
+        sample_keys -- the flattened names of its SAMPLE parameters
+    Returns:
+        a list of (keys, values) for each design in order of first appearance, where values
+        is an (n, len(keys)) array with a column for each key
+    """
+    designs = {}
+    for key in sample_keys:
+        match = SAMPLE_PARAM_RE.match(flat_params[key])
+        args = json.loads(match.group(2))
+        name = args.pop("design", DEFAULT_SAMPLE_DESIGN)
+        design = designs.setdefault(name, {"method": match.group(1), "keys": [], "ranges": []})
+        if design["method"] != match.group(1):
+            raise ValueError("sample design %r is given as both %r and %r" % (name, design["method"], match.group(1)))
+        for setting in ("n", "seed"):
+            if setting in args:
+                value = args.pop(setting)
+                if design.setdefault(setting, value) != value:
+                    raise ValueError("sample design %r is given %s = %r and %r" % (name, setting, design[setting], value))
+        low, high = args.pop("range")
+        design["keys"].append(key)
+        design["ranges"].append((low, high, args.pop("scale", "linear")))
+        if args:
+            raise ValueError("unknown sample arguments %s for %s" % (sorted(args), key))
+    sampled = []
+    for name, design in designs.items():
+        if "n" not in design:
+            raise ValueError("sample design %r needs the number of points, n" % name)
+        unit_values = sample_unit_hypercube(design["method"], design["n"], len(design["keys"]),
+                                            design.get("seed", DEFAULT_SAMPLE_SEED))
+        values = np.column_stack([scale_samples(unit_values[:, column], *design["ranges"][column])
+                                  for column in range(len(design["keys"]))])
+        sampled.append((design["keys"], values))
+    return sampled
+
+def _combination_axis_order(n_axes):
+    """Returns the axes of a parameter grid from fastest to slowest varying.
+
+    The combinations have always been enumerated in the order produced by
+    np.array(np.meshgrid(*arrays)).T.reshape(-1, n), where the second array
+    varies fastest, then the first, then the rest in order.  This keeps the
+    lazy decoding in the same order so existing databases line up.
+    """
+    if n_axes < 2:
+        return list(range(n_axes))
+    return [1, 0] + list(range(2, n_axes))
+
+def _patch_template(template, key_paths, values):
+    """Returns a copy of template with the values at key_paths replaced.
+
+    Only the dictionaries along each key path are copied, everything else
+    is shared with the template, so the returned dictionary should be
+    treated as read only.
+    Args:
+        template -- the (nested) parameter dictionary to patch
+        key_paths -- a list of key tuples, one per value
+        values -- the values to place at each key path
+    """
+    patched = dict(template)
+    copied = {(): patched}
+    for path, value in zip(key_paths, values):
+        working_params = patched
+        for depth in range(1, len(path)):
+            prefix = path[:depth]
+            if prefix not in copied:
+                copied[prefix] = dict(working_params[path[depth-1]])
+                working_params[path[depth-1]] = copied[prefix]
+            working_params = copied[prefix]
+        working_params[path[-1]] = value
+    return patched
+
 class ModelParams:
     """An object that iterates over all possible parameter combinations.
 
     The ModelParams pbject expects a paramter dictionary where some parameters are
     defined as "ITERATIVE" (see documentation for generate_parameter_array).  This
     iterator then will return every possible paramter combination based on the iterative
-    parameters.
+    parameters.  Parameters defined as "SAMPLE" are drawn jointly as space filling designs
+    (see generate_sample_designs); each design is a single axis of the combinations, so its
+    points are combined with the iterative values rather than with each other.
+
+    Combinations are never materialized; the i-th combination is decoded on demand
+    by treating i as a mixed-radix number whose digits index into each parameter
+    array.  This means the object supports len(), random access and slicing, and
+    memory use does not depend on the number of combinations.
 
     Attributes:
         parameters -- the parameter dictionary
-        iterative_params -- the keys of the parameters that are iterative
-        iterative_parameter_values -- all possible combinations of iterative parameters
+        dynamic_params -- the keys and types of the parameters that are dynamic
+        parameter_arrays -- the possible values of each axis: an array for each iterative
+                            parameter followed by an (n, parameters) array for each sample design
+        key_paths -- the key path of every value of a combination, in axis order
+        n_iterative_axes -- the number of axes that are a single parameter
         current -- the current parameter combination to be returned
     
     """
@@ -187,9 +408,8 @@ class ModelParams:
     def __init__(self, parameters):
         """Initializes the iteratator based on a parameter array.
 
-        This finds the iterative parameters and creates a matrix where each row represents
-
-        a possible parameter combination.
+        This finds the dynamic parameters and generates the array of possible
+        values for each of them.
         Args:
             parameters -- a parameter dictionary
         """
@@ -198,7 +418,19 @@ class ModelParams:
         self.rng = np.random.default_rng()
         flat_params = flatten_dict(parameters)#, "model_param")
         parameter_arrays = [self.generate_parameter_array(flat_params[param[0]], param[1]) for param in self.dynamic_params if param[1] in ("ITERATIVE", "RANDOM")]
-        self.iterative_parameter_values = np.array(np.meshgrid(*parameter_arrays)).T.reshape(-1,len(parameter_arrays))
+        # a shared dtype so every combination is typed as if it came from one matrix
+        if parameter_arrays:
+            common_dtype = np.result_type(*parameter_arrays)
+            parameter_arrays = [np.asarray(array, dtype=common_dtype).ravel() for array in parameter_arrays]
+        self.n_iterative_axes = len(parameter_arrays)
+        key_paths = [param[0] for param in self.dynamic_params if param[1] in ("ITERATIVE", "RANDOM")]
+        for keys, values in generate_sample_designs(flat_params, [param[0] for param in self.dynamic_params if param[1] == "SAMPLE"]):
+            parameter_arrays.append(values)
+            key_paths.extend(keys)
+        self.parameter_arrays = parameter_arrays
+        self.key_paths = [tuple(key.split('.')) for key in key_paths]
+        self.axis_order = _combination_axis_order(len(parameter_arrays))
+        self.size = int(np.prod([len(array) for array in parameter_arrays], dtype=np.int64))
         self.current = 0
 
     def generate_parameter_array(self, parameter, dynamic_type):
@@ -210,6 +442,37 @@ class ModelParams:
         else:
             raise ValueError
 
+    def __len__(self):
+        """Returns the total number of parameter combinations."""
+        return self.size
+
+    def __getitem__(self, index):
+        """Returns the parameter dictionary for a combination index, or a list of them for a slice."""
+        if isinstance(index, slice):
+            return [self.combination(i) for i in range(*index.indices(self.size))]
+        index = int(index)
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("combination index %d out of range for %d combinations" % (index, self.size))
+        return self.combination(index)
+
+    def combination_values(self, index):
+        """Decodes a combination index into the value of each dynamic parameter."""
+        values = [None]*len(self.parameter_arrays)
+        for axis in self.axis_order:
+            array = self.parameter_arrays[axis]
+            index, digit = divmod(index, len(array))
+            values[axis] = array[digit]
+        if len(values) > self.n_iterative_axes:
+            # a design's point holds a value for each of its parameters
+            values = values[:self.n_iterative_axes] + [value for point in values[self.n_iterative_axes:] for value in point]
+        return values
+
+    def combination(self, index):
+        """Returns the parameter dictionary for a given combination index."""
+        return _patch_template(self.parameters, self.key_paths, self.combination_values(index))
+
     def __iter__(self):
         """Returns the object as it is an iterator."""
         return self
@@ -220,45 +483,109 @@ class ModelParams:
         
     def next(self):
         """" Returns the next combination of parameters as a dictionary"""
-        if self.current >= len(self.iterative_parameter_values):
+        if self.current >= self.size:
             raise StopIteration
-        iterative_param_values = self.iterative_parameter_values[self.current]
-        params_to_return = deepcopy(self.parameters)
-        for i, param in enumerate(self.dynamic_params):
-            param = param[0]
-            param_val = iterative_param_values[i]
-            working_params = params_to_return
-            for key in param.split('.')[:-1]:
-                working_params = working_params[key]
-            working_params[param.split('.')[-1]] = param_val
+        params_to_return = self.combination(self.current)
         self.current += 1
         return params_to_return
 
+def _sql_value(value):
+    """Returns the value as it is stored in the parameter table (numbers as is, everything else as a string)."""
+    if not isinstance(value, (int, float)):
+        return str(value)
+    return value
+
+def _insert_sql(columns, table="model_run_params"):
+    """Returns a parameterized insert statement for the given columns."""
+    column_string = ", ".join(["\"%s\"" % column for column in columns])
+    placeholder_string = ", ".join(["?"]*len(columns))
+    return "INSERT INTO %s (%s) VALUES (%s);" % (table, column_string, placeholder_string)
+
 def insert_model_run(cursor, params):
     """Flattens a parameter dictionary and inserts it with the provided sqlite cursor."""
     flat_params = flatten_dict(params, "model_param")
-    columns = str(tuple(flat_params.keys()))#.replace('[', '(').replace(']', ')')
-    values = []
-    for value in flat_params.values():
-        if not isinstance(value, (int, float)):
-            values.append(str(value))
-        else:
-            values.append(value)
-    values = str(tuple(values))#.replace('[', '(').replace(']', ')')
-    query_str = "INSERT INTO model_run_params %s VALUES %s;" % (columns, values)
-    cursor.execute(query_str)
+    query_str = _insert_sql(flat_params.keys())
+    cursor.execute(query_str, [_sql_value(value) for value in flat_params.values()])
+
+def model_param_rows(model_params, columns):
+    """Yields the remaining combinations of a ModelParams object as rows of table values.
+
+    The constant parameters are flattened and converted once, so each row only
+    costs substituting the dynamic values into a copy of the template row.
+    Args:
+        model_params -- a ModelParams object
+        columns -- the flattened parameter names (prefixed with "model_param") in column order
+    """
+    flat_template = flatten_dict(model_params.parameters, "model_param")
+    template_row = [_sql_value(flat_template[column]) for column in columns]
+    positions = [columns.index("model_param." + ".".join(path)) for path in model_params.key_paths]
+    for index in range(model_params.current, len(model_params)):
+        row = template_row.copy()
+        for position, value in zip(positions, model_params.combination_values(index)):
+            row[position] = _sql_value(value)
+        yield row
+    model_params.current = len(model_params)
 
-def create_model_db(db_path, param_path):
-    """Given a model parameter json file path, creates and fills an associated model database."""
+def insert_model_runs(cursor, rows, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Streams rows of parameter values into the parameter table in chunks with executemany.
+
+    Only a single chunk of rows is held in memory at a time, so this works with
+    a lazy row generator of any size (see model_param_rows).
+    Args:
+        cursor -- a sqlite cursor for the parameter database
+        rows -- an iterable of value sequences, one per parameter combination
+        columns -- the column names of the values, in order
+        chunk_size -- the number of rows handed to each executemany call
+    Returns:
+        the number of rows inserted
+    """
+    query_str = _insert_sql(columns)
+    rows = iter(rows)
+    total = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        cursor.executemany(query_str, chunk)
+        total += len(chunk)
+    return total
+
+def create_model_db(db_path, param_path, chunk_size=DEFAULT_CHUNK_SIZE, report=True, normalized=False):
+    """Given a model parameter json file path, creates and fills an associated model database.
+
+    Rows are streamed in chunks with parameterized bulk inserts, and the build
+    connection uses relaxed durability pragmas since a half built database is
+    discarded anyway.
+    Args:
+        db_path -- the path of the database to create
+        param_path -- the path of the json parameter template
+        chunk_size -- the number of rows inserted per executemany call
+        report -- print the number of rows inserted and the insert rate
+        normalized -- store constant parameters once in model_param_template instead of on every row
+    Returns:
+        the number of rows inserted
+    """
     with open(param_path, 'r') as param_f:
         params = json.load(param_f)
     model_params = ModelParams(params)
-    param = model_params.next()
-    generate_model_run_db(db_path, param)
+    first_param = model_params[0]
+    if normalized:
+        dynamic_params = [param[0] for param in model_params.dynamic_params]
+        generate_model_run_db(db_path, first_param, dynamic_params)
+        columns = split_constant_columns(first_param, dynamic_params)[1]
+    else:
+        generate_model_run_db(db_path, first_param)
+        columns = list(flatten_dict(first_param, "model_param").keys())
     sqliteConnection = sqlite3.connect(db_path)
     cursor = sqliteConnection.cursor()
-    insert_model_run(cursor, param)
-    for param in model_params:
-        insert_model_run(cursor, param)
+    for pragma in BULK_BUILD_PRAGMAS:
+        cursor.execute(pragma)
+    start_time = time.perf_counter()
+    total = insert_model_runs(cursor, model_param_rows(model_params, columns), columns, chunk_size)
     sqliteConnection.commit()
+    elapsed = time.perf_counter() - start_time
     cursor.close()
+    sqliteConnection.close()
+    if report:
+        print("inserted %d parameter combinations in %.2f s (%.0f rows/sec)" % (total, elapsed, total/max(elapsed, 1e-9)))
+    return total
@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+MODEL_POOL_SIZE = 4  # finished models kept per process, one per grid and component configuration
+
+class ModelPool:
+    """Finished models kept by a worker for the next run with the same grid and components.
+
+    Building a model (its grid, flow routing and other components) can cost as much as a
+    short run.  A model put back after its run is handed to the next run whose parameters
+    differ from its own only in the model's resettable_params (see LandlabModel.pool_key),
+    through its reset hook.  A model whose class can not be reset, or whose reset fails,
+    is simply built again.  The least recently used configuration is dropped once more
+    than size are kept.
+
+    Attributes:
+        size -- the number of models kept
+        models -- the kept models by (model class, pool key)
+        reused -- the number of models handed out again
+        built -- the number of models built
+    """
+    def __init__(self, size=MODEL_POOL_SIZE):
+        self.size = size
+        self.models = OrderedDict()
+        self.lock = threading.Lock()  # workers running runs on threads share the pool
+        self.reused = 0
+        self.built = 0
+
+    def get(self, model_class, param_dict):
+        """A model for param_dict, reset from the pool if one fits, otherwise new.
+
+        The model's pool_entry is set so it can be put back after its run.
+        """
+        key = model_class.pool_key(param_dict) if self.size > 0 else None
+        with self.lock:
+            model = self.models.pop((model_class, key), None) if key is not None else None
+        if model is not None:
+            try:
+                if model.reset(param_dict):
+                    self.reused += 1
+                    model.pool_entry = (model_class, key)
+                    return model
+            except Exception as e:
+                print("could not reset a pooled %s, building a new one: %s" % (model_class.__name__, e))
+        model = model_class(param_dict)
+        self.built += 1
+        model.pool_entry = None if key is None else (model_class, key)
+        return model
+
+    def put(self, model):
+        """Keeps a finished model for reuse.  Only put back models whose run ended normally."""
+        pool_entry = getattr(model, "pool_entry", None)
+        if pool_entry is None:
+            return
+        with self.lock:
+            self.models[pool_entry] = model
+            self.models.move_to_end(pool_entry)
+            while len(self.models) > self.size:
+                self.models.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+
+# the pool of this process; every dask or process pool worker has its own
+MODEL_POOL = ModelPool()
@@ -0,0 +1,382 @@
+import os
+import queue
+import threading
+
+import netCDF4
+import numpy as np
+
+DEFAULT_CHUNK_RUNS = 16  # runs per compressed chunk, a random read decompresses one chunk
+DEFAULT_COMPLEVEL = 4
+FLOAT_DTYPES = ("float64", "float32")
+INTEGER_DTYPES = ("int8", "uint8", "int16", "uint16", "int32", "uint32")
+ENCODING_KEYS = ("dtype", "scale_factor", "add_offset", "complevel", "chunks")
+DEFAULT_WRITE_QUEUE = 4  # finished runs waiting to be written before the dispatcher blocks
+
+def field_encoding(spec):
+    """Checks how one field of output.fields is to be stored, returning it as a dictionary.
+
+    A field's entry is None (stored as it is), a dtype name, or a dictionary with any of
+    "dtype", "scale_factor", "add_offset", "complevel" (zlib compression level) and "chunks"
+    ([rows, columns] of grid nodes per compressed chunk).  Floats can be stored as float32;
+    netcdf has no float16, use a scaled integer instead.  Integer dtypes store the values
+    scaled, value = stored * scale_factor + add_offset; without a scale_factor each run's
+    range of values is spread over the integers (see packing_scale).
+    """
+    if spec is None:
+        return {}
+    if isinstance(spec, str):
+        spec = {"dtype": spec}
+    unknown = set(spec) - set(ENCODING_KEYS)
+    if unknown:
+        raise ValueError("Unknown output field settings %s, expected any of %s" % (sorted(unknown), ENCODING_KEYS))
+    encoding = dict(spec)
+    dtype = encoding.get("dtype")
+    if dtype == "float16":
+        raise ValueError("netcdf can not store float16, use a scaled integer dtype (e.g. int16) instead")
+    if dtype is not None and dtype not in FLOAT_DTYPES + INTEGER_DTYPES:
+        raise ValueError("Can not store output fields as %s, expected one of %s" % (dtype, FLOAT_DTYPES + INTEGER_DTYPES))
+    return encoding
+
+def output_encodings(fields):
+    """The encoding of each field of the output.fields parameter (see field_encoding), {} for a list of names."""
+    if not isinstance(fields, dict):
+        return {}
+    return {name: field_encoding(spec) for name, spec in fields.items()}
+
+def packing_scale(values, dtype):
+    """The scale_factor and add_offset that spread the range of values over the integers of dtype."""
+    limits = np.iinfo(dtype)
+    low, high = float(np.nanmin(values)), float(np.nanmax(values))
+    scale_factor = (high - low) / (int(limits.max) - int(limits.min)) if high > low else 1.0
+    return scale_factor, low - limits.min * scale_factor
+
+def _create_field(dataset, name, dimensions, values, encoding, complevel, chunksizes=None):
+    """Creates the variable of a field with its encoding (see field_encoding), returning it.
+
+    Without an encoded dtype the field keeps its own, except that booleans (such as
+    flow__sink_flag) are stored as int8, and netcdf3 files, which have no 64 bit or unsigned
+    integers, store integers (such as flow__data_structure_delta) as int32, as landlab's
+    grid.save does.
+    """
+    dtype = encoding.get("dtype") or np.asarray(values).dtype
+    if np.dtype(dtype) == bool:
+        dtype = "i1"
+    elif (dataset.data_model.startswith("NETCDF3") and np.dtype(dtype).kind in "iu"
+          and (np.dtype(dtype).kind == "u" or np.dtype(dtype).itemsize > 4)):
+        dtype = "i4"
+    complevel = encoding.get("complevel", complevel) or 0
+    options = {}
+    if complevel > 0:
+        options.update(zlib=True, complevel=complevel)
+    if complevel > 0 or "chunks" in encoding:
+        options["chunksizes"] = chunksizes
+    if np.dtype(dtype).kind in "iu":
+        # every integer is a value, none is kept free to mark missing ones
+        options["fill_value"] = False
+    variable = dataset.createVariable(name, dtype, dimensions, **options)
+    if "scale_factor" in encoding or (encoding.get("dtype") and np.dtype(dtype).kind in "iu"):
+        if "scale_factor" in encoding:
+            scale_factor, add_offset = encoding["scale_factor"], encoding.get("add_offset", 0.0)
+        else:
+            scale_factor, add_offset = packing_scale(values, dtype)
+        # set before any values are written, so netCDF4 packs them
+        variable.scale_factor = scale_factor
+        variable.add_offset = add_offset
+    return variable
+
+def write_run_netcdf(path, grid, fields, encodings=None, complevel=None):
+    """Saves node fields of a raster grid as a netcdf laid out like landlab's grid.save.
+
+    Without encodings or compression the file is written by grid.save itself.  Otherwise it is
+    a netcdf4 file with each field stored as encodings gives (see field_encoding) and compressed
+    at complevel unless its encoding says otherwise.
+    Args:
+        path -- the path of the netcdf file
+        grid -- the raster grid
+        fields -- the names of the node fields to save
+        encodings -- the encoding of each field, fields without one are stored as they are
+        complevel -- the zlib compression level of fields without their own (default none)
+    """
+    encodings = encodings or {}
+    if not complevel and not any(encodings.values()):
+        grid.save(path, names=list(fields))
+        return
+    write_fields_netcdf(path, grid_topology(grid), {name: grid.at_node[name] for name in fields}, encodings, complevel)
+
+def write_fields_netcdf(path, topology, fields, encodings=None, complevel=None, sync=False):
+    """Saves node fields copied from a raster grid as a netcdf laid out like landlab's grid.save.
+
+    Without encodings or compression it is a netcdf3 file like grid.save writes, otherwise a
+    netcdf4 file (see write_run_netcdf).  With sync the file is written to a temporary name,
+    synced to disk and renamed, so once this returns the whole file is durable.
+    Args:
+        path -- the path of the netcdf file
+        topology -- the grid's topology (see grid_topology)
+        fields -- a dictionary of field name to node values
+        encodings -- the encoding of each field, fields without one are stored as they are
+        complevel -- the zlib compression level of fields without their own (default none)
+        sync -- sync the file to disk before returning
+    """
+    if "shape" not in topology:
+        raise ValueError("Only raster grids can be saved as netcdf files, %s runs need an output store" % topology["type"])
+    encodings = encodings or {}
+    shape = tuple(topology["shape"])
+    file_format = "NETCDF4" if complevel or any(encodings.values()) else "NETCDF3_64BIT_OFFSET"
+    written_path = path + ".tmp" if sync else path
+    with netCDF4.Dataset(written_path, "w", format=file_format) as dataset:
+        dataset.createDimension("nt", None)
+        dataset.createDimension("nj", shape[0])
+        dataset.createDimension("ni", shape[1])
+        for name in ("x", "y"):
+            options = {"zlib": True, "complevel": complevel} if complevel else {}
+            dataset.createVariable(name, "f8", ("nj", "ni"), **options)[:] = np.reshape(topology[name + "_of_node"], shape)
+        for name, values in fields.items():
+            encoding = encodings.get(name, {})
+            chunks = tuple(encoding.get("chunks") or shape)
+            variable = _create_field(dataset, name, ("nt", "nj", "ni"), values, encoding, complevel, (1,) + chunks)
+            variable[0] = np.reshape(values, shape)
+    if sync:
+        fsync_file(written_path)
+        os.replace(written_path, path)
+
+def fsync_file(path):
+    """Makes sure what has been written to a file is on disk, not just in the page cache."""
+    file_descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+
+def write_model_run(model, path):
+    """Saves the fields of a finished model (see LandlabModel.fields_to_save) as given by its output parameters."""
+    write_run_netcdf(path, model.grid, model.fields_to_save(), output_encodings(model.save_fields),
+                     model.save_complevel)
+
+def grid_topology(grid):
+    """Collects what is needed to place node values of a grid: node coordinates, status and shape."""
+    topology = {"type": type(grid).__name__,
+                "x_of_node": np.asarray(grid.x_of_node),
+                "y_of_node": np.asarray(grid.y_of_node),
+                "status_at_node": np.asarray(grid.status_at_node)}
+    if hasattr(grid, "shape"):
+        topology["shape"] = tuple(int(n) for n in grid.shape)
+    return topology
+
+def model_run_fields(model):
+    """Copies the node fields of a finished model that are to be saved (see LandlabModel.fields_to_save)."""
+    return {name: np.array(model.grid.at_node[name]) for name in model.fields_to_save()}
+
+def read_node_fields(path, fields=None):
+    """Reads the node fields of a run saved with grid.save, at its last saved time.
+
+    Returns a dictionary of field name to (flat) node values, of the given fields or of
+    every field in the file.
+    """
+    node_fields = {}
+    with netCDF4.Dataset(path) as dataset:
+        for name, variable in dataset.variables.items():
+            if name in ("x", "y") or variable.ndim < 2 or (fields is not None and name not in fields):
+                continue
+            values = np.array(variable[:])
+            if variable.dimensions[0] == "nt":
+                values = values[-1]
+            node_fields[name] = values.ravel()
+    return node_fields
+
+class AsyncRunWriter:
+    """Writes the netcdf files of finished runs on a background thread, while the next runs go on.
+
+    The dispatcher hands over a finished run's outputs with its copied "node_fields",
+    "grid_topology" and "field_encodings" (see save_model_run with to_store).  put blocks
+    once max_queued runs are waiting to be written, so the fields held in memory are
+    bounded however far the runs get ahead of the filesystem.  Each file is synced to disk
+    and renamed into place (see write_fields_netcdf) before its outputs are handed back by
+    finished, without the fields and with "output_bytes" set to the size of the file, so a
+    run is only recorded as finished once its file is durable.  A run whose file could not
+    be written is handed back with its "write_error" instead.
+
+    Attributes:
+        max_queued -- the number of runs that can wait to be written
+    """
+    def __init__(self, max_queued=DEFAULT_WRITE_QUEUE):
+        self.max_queued = max_queued
+        self._queue = queue.Queue(max_queued)
+        self._written = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="AsyncRunWriter", daemon=True)
+        self._thread.start()
+
+    def put(self, path, outputs):
+        """Queues a finished run's fields to be written to path, blocking while the queue is full."""
+        self._queue.put((path, outputs))
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            path, outputs = job
+            node_fields = outputs.pop("node_fields")
+            topology = outputs.pop("grid_topology")
+            encodings = outputs.pop("field_encodings", None)
+            try:
+                write_fields_netcdf(path, topology, node_fields, encodings, outputs.pop("field_complevel", None), sync=True)
+                outputs["output_bytes"] = os.path.getsize(path)
+            except Exception as error:
+                outputs["write_error"] = error
+            self._written.put(outputs)
+            self._queue.task_done()
+
+    def finished(self):
+        """The outputs of every run written since the last call (not waiting for any)."""
+        written = []
+        while True:
+            try:
+                written.append(self._written.get_nowait())
+            except queue.Empty:
+                return written
+
+    def flush(self):
+        """Waits for every queued run to be written, returning the outputs of the runs written since the last call."""
+        self._queue.join()
+        return self.finished()
+
+    def close(self):
+        """Writes the queued runs and stops the thread.  Their outputs can still be collected with finished."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+class OutputStore:
+    """A single netCDF file holding the node fields of many model runs.
+
+    Every saved node field is a (run, node) variable, compressed in chunks of
+    chunk_runs runs, and the runs are keyed by the run_param_id and model_run_id
+    variables.  The grid topology (node coordinates, status and shape) is stored
+    once.  The store is meant to have a single writer, the dispatcher, which
+    appends the fields its workers return; any number of readers can open it
+    with mode="r".
+
+    Attributes:
+        path -- the path of the netCDF file
+        dataset -- the open netCDF4.Dataset
+        fields -- the names of the stored node fields
+    """
+    def __init__(self, path, mode="a", chunk_runs=DEFAULT_CHUNK_RUNS, complevel=DEFAULT_COMPLEVEL):
+        """Opens (or with mode "a" creates) an output store.
+
+        Args:
+            path -- the path of the netCDF file
+            mode -- "a" to append runs, "r" to only read them
+            chunk_runs -- the number of runs in each compressed chunk of a field
+            complevel -- the zlib compression level
+        """
+        self.path = path
+        self.chunk_runs = chunk_runs
+        self.complevel = complevel
+        if mode == "a" and not os.path.exists(path):
+            mode = "w"
+        self.dataset = netCDF4.Dataset(path, mode)
+        self.fields = [name for name, variable in self.dataset.variables.items()
+                       if variable.dimensions == ("run", "node")]
+        self._index = None
+
+    def __len__(self):
+        """The number of runs in the store."""
+        if "run" not in self.dataset.dimensions:
+            return 0
+        return len(self.dataset.dimensions["run"])
+
+    def _create(self, topology, fields, encodings=None):
+        """Creates the dimensions, topology and field variables from the first run.
+
+        Fields are stored as their encodings give (see field_encoding), except that the
+        chunks are always chunk_runs runs.  Runs share one scale, so integer dtypes need
+        a scale_factor.
+        """
+        dataset = self.dataset
+        n_nodes = len(topology["x_of_node"])
+        dataset.createDimension("run", None)
+        dataset.createDimension("node", n_nodes)
+        dataset.grid_type = topology["type"]
+        if "shape" in topology:
+            dataset.grid_shape = np.array(topology["shape"])
+        for name in ("x_of_node", "y_of_node", "status_at_node"):
+            variable = dataset.createVariable(name, np.asarray(topology[name]).dtype, ("node",))
+            variable[:] = topology[name]
+        dataset.createVariable("run_param_id", "i8", ("run",))
+        dataset.createVariable("model_run_id", str, ("run",))
+        encodings = encodings or {}
+        for name, values in fields.items():
+            encoding = encodings.get(name, {})
+            if np.dtype(encoding.get("dtype") or "f8").kind in "iu" and "scale_factor" not in encoding:
+                raise ValueError("Field %s is stored as %s in an output store, which needs a scale_factor" % (name, encoding["dtype"]))
+            _create_field(dataset, name, ("run", "node"), values, encoding, self.complevel, (self.chunk_runs, n_nodes))
+        self.fields = list(fields)
+
+    def append(self, outputs):
+        """Appends a finished run.
+
+        Args:
+            outputs -- a run's outputs dictionary, with the "run_param_id" and "model_run_id" of the
+                       run, its "node_fields" (see model_run_fields) and "grid_topology" (see grid_topology),
+                       and optionally their "field_encodings" (see output_encodings)
+        """
+        fields = outputs["node_fields"]
+        if not self.fields:
+            self._create(outputs["grid_topology"], fields, outputs.get("field_encodings"))
+        if set(fields) != set(self.fields):
+            raise ValueError("Run %s has fields %s, but the store holds %s" % (outputs["model_run_id"], sorted(fields), sorted(self.fields)))
+        row = len(self)
+        self.dataset["run_param_id"][row] = outputs["run_param_id"]
+        self.dataset["model_run_id"][row] = str(outputs["model_run_id"])
+        for name in self.fields:
+            self.dataset[name][row, :] = fields[name]
+        if self._index is not None:
+            self._index[int(outputs["run_param_id"])] = row
+            self._index[str(outputs["model_run_id"])] = row
+
+    def _row(self, run_param_id=None, model_run_id=None):
+        """Finds the row of a run, reading the run id variables once to build the index."""
+        if self._index is None:
+            self._index = {}
+            if len(self):
+                for row, run_id in enumerate(self.dataset["run_param_id"][:]):
+                    self._index[int(run_id)] = row
+                for row, run_id in enumerate(self.dataset["model_run_id"][:]):
+                    self._index[str(run_id)] = row
+        key = int(run_param_id) if run_param_id is not None else str(model_run_id)
+        if key not in self._index:
+            raise KeyError("No run %s in %s" % (key, self.path))
+        return self._index[key]
+
+    def read(self, run_param_id=None, model_run_id=None, fields=None):
+        """Reads the node fields of one run, found by its run_param_id or model_run_id.
+
+        Returns a dictionary of field name to node values.
+        """
+        row = self._row(run_param_id, model_run_id)
+        return {name: self.dataset[name][row, :].data for name in (fields or self.fields)}
+
+    def topology(self):
+        """Reads the stored node coordinates and status (and grid shape if there is one)."""
+        topology = {"type": self.dataset.grid_type}
+        for name in ("x_of_node", "y_of_node", "status_at_node"):
+            topology[name] = self.dataset[name][:].data
+        if "grid_shape" in self.dataset.ncattrs():
+            topology["shape"] = tuple(int(n) for n in self.dataset.grid_shape)
+        return topology
+
+    def sync(self):
+        """Writes everything appended so far to disk.
+
+        Dataset.sync only hands netCDF's buffers to the operating system, so the file is
+        fsynced as well; runs are recorded as finished once this returns.
+        """
+        self.dataset.sync()
+        fsync_file(self.path)
+
+    def close(self):
+        """Closes the file."""
+        if self.dataset.isopen():
+            self.dataset.close()
@@ -0,0 +1,119 @@
+import numpy as np
+
+from .resources import varying_parameters
+
+LOG_SCALE_RATIO = 100.0  # parameters spanning at least this ratio (two orders of magnitude) are compared in log space
+DISTANCE_CHUNK = 512  # query points per block of the distance matrix
+
+def _is_numeric(python_type):
+    return issubclass(python_type, (int, float, np.number)) and not issubclass(python_type, (bool, np.bool_))
+
+def numeric_parameters(connection):
+    """The model_param columns of model_run_params that vary between rows and hold numbers."""
+    # imported here as construct_model imports this module (through warm_start)
+    from .construct_model import get_param_types
+    types = get_param_types(connection)
+    return [column for column in varying_parameters(connection) if _is_numeric(types[column])]
+
+class ParameterSpace:
+    """Maps parameter values onto the unit hypercube, so that distances weigh every parameter alike.
+
+    Each parameter is scaled from its [low, high] range onto [0, 1], in log space if it
+    is log scaled.  Refinement (see refinement.py) measures how far apart runs are, and
+    where between them to add new ones, in these unit coordinates.
+
+    Attributes:
+        columns -- the model_param columns of the space
+        low -- the lowest value of each parameter
+        high -- the highest value of each parameter
+        log -- whether each parameter is scaled in log space
+        integer -- whether each parameter holds integers
+    """
+    def __init__(self, columns, low, high, log=None, integer=None):
+        self.columns = list(columns)
+        self.low = np.asarray(low, dtype=float)
+        self.high = np.asarray(high, dtype=float)
+        self.log = np.zeros(len(self.columns), dtype=bool) if log is None else np.asarray(log, dtype=bool)
+        self.integer = np.zeros(len(self.columns), dtype=bool) if integer is None else np.asarray(integer, dtype=bool)
+        self._offset = np.where(self.log, np.log10(np.where(self.log, self.low, 1.0)), self.low)
+        top = np.where(self.log, np.log10(np.where(self.log, self.high, 1.0)), self.high)
+        # a parameter with a single value maps onto 0
+        self._width = np.where(top > self._offset, top - self._offset, 1.0)
+
+    @classmethod
+    def from_database(cls, connection, columns=None):
+        """The space spanned by the rows of a parameter database.
+
+        Args:
+            connection -- a connection to the parameter database
+            columns -- the model_param columns to use (default: every numeric parameter that varies)
+        """
+        from .construct_model import get_param_types
+        if columns is None:
+            columns = numeric_parameters(connection)
+        types = get_param_types(connection)
+        if not columns:
+            return cls([], [], [])
+        ranges = connection.execute("SELECT %s FROM model_run_params" % ", ".join(
+            ["MIN(\"%s\"), MAX(\"%s\")" % (column, column) for column in columns])).fetchone()
+        low = np.array(ranges[0::2], dtype=float)
+        high = np.array(ranges[1::2], dtype=float)
+        log = (low > 0) & (high >= low * LOG_SCALE_RATIO)
+        integer = [issubclass(types[column], (int, np.integer)) for column in columns]
+        return cls(columns, low, high, log, integer)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def to_unit(self, values):
+        """Maps an (n, parameters) array of values onto the unit hypercube."""
+        values = np.asarray(values, dtype=float)
+        scaled = np.where(self.log, np.log10(np.where(self.log, values, 1.0)), values)
+        return (scaled - self._offset) / self._width
+
+    def from_unit(self, unit):
+        """Maps an (n, parameters) array of unit coordinates back to parameter values.
+
+        Integer parameters are rounded, but stay floats in the returned array; write them as
+        ints (see refinement.insert_rows).
+        """
+        scaled = np.asarray(unit, dtype=float) * self._width + self._offset
+        values = np.where(self.log, 10**np.where(self.log, scaled, 0.0), scaled)
+        return np.where(self.integer, np.round(values), values)
+
+def squared_distances(points, queries):
+    """The (queries, points) matrix of squared euclidean distances between two sets of points."""
+    points = np.asarray(points, dtype=float)
+    queries = np.asarray(queries, dtype=float)
+    distances = (queries**2).sum(axis=1)[:, None] + (points**2).sum(axis=1)[None, :] - 2 * queries @ points.T
+    return np.maximum(distances, 0, out=distances)
+
+def nearest(points, queries, k=1, exclude_self=False):
+    """Finds the k nearest points to each query by brute force, a block of queries at a time.
+
+    Args:
+        points -- an (n, d) array of points
+        queries -- an (m, d) array of query points
+        k -- the number of neighbours to find
+        exclude_self -- the queries are the points themselves, so leave each one out of its own neighbours
+    Returns:
+        (m, k) arrays of the indices of the nearest points and their distances, nearest first
+    """
+    points = np.asarray(points, dtype=float)
+    queries = np.asarray(queries, dtype=float)
+    k = max(0, min(k, len(points) - (1 if exclude_self else 0)))
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    distances = np.empty((len(queries), k))
+    if k <= 0:
+        return indices, distances
+    for start in range(0, len(queries), DISTANCE_CHUNK):
+        block = squared_distances(points, queries[start:start + DISTANCE_CHUNK])
+        if exclude_self:
+            rows = np.arange(len(block))
+            block[rows, rows + start] = np.inf
+        block_indices = np.argpartition(block, k - 1, axis=1)[:, :k] if k < block.shape[1] else np.argsort(block, axis=1)[:, :k]
+        block_distances = np.take_along_axis(block, block_indices, axis=1)
+        order = np.argsort(block_distances, axis=1)
+        indices[start:start + len(block)] = np.take_along_axis(block_indices, order, axis=1)
+        distances[start:start + len(block)] = np.sqrt(np.take_along_axis(block_distances, order, axis=1))
+    return indices, distances
@@ -0,0 +1,208 @@
+import time
+
+import numpy as np
+
+from .db_writer import connect_wal
+from .parameter_space import ParameterSpace, nearest
+
+FINISHED_RESULTS_QUERY = """
+SELECT p.run_param_id, {parameters}, {outputs}
+FROM model_run_params p
+JOIN model_run_metadata m ON p.model_run_id = m.model_run_id
+JOIN model_run_outputs o ON p.model_run_id = o.model_run_id
+WHERE m.model_end_time IS NOT NULL AND {not_null}
+"""
+ROUND_PROGRESS_QUERY = """
+SELECT COUNT(*), COUNT(m.model_end_time)
+FROM model_run_params p
+LEFT JOIN model_run_metadata m ON p.model_run_id = m.model_run_id
+WHERE p.run_param_id > ? AND p.run_param_id <= ?
+"""
+LAST_ROW_QUERY = "SELECT COALESCE(MAX(run_param_id), 0) FROM model_run_params"
+ROW_COLUMNS_EXCLUDED = ("run_param_id", "model_run_id", "model_batch_id")
+DEFAULT_POLL_INTERVAL = 10.0  # seconds between checks for the runs of the previous round having finished
+
+def finished_results(connection, columns, outputs):
+    """Reads the parameters and outputs of every finished run.
+
+    Args:
+        connection -- a connection to the parameter database
+        columns -- the model_param columns to read
+        outputs -- the model_run_outputs columns to read; runs missing any of them are left out
+    Returns:
+        the run_param_ids, an (n, columns) array of parameter values and an (n, outputs) array of outputs
+    """
+    query = FINISHED_RESULTS_QUERY.format(parameters=", ".join(["p.\"%s\"" % column for column in columns]),
+                                          outputs=", ".join(["o.\"%s\"" % output for output in outputs]),
+                                          not_null=" AND ".join(["o.\"%s\" IS NOT NULL" % output for output in outputs]))
+    rows = connection.execute(query).fetchall()
+    run_param_ids = [row[0] for row in rows]
+    values = np.array([row[1:1 + len(columns)] for row in rows], dtype=float).reshape(len(rows), len(columns))
+    results = np.array([row[1 + len(columns):] for row in rows], dtype=float).reshape(len(rows), len(outputs))
+    return run_param_ids, values, results
+
+def propose_points(unit_points, results, existing, n_points, neighbours=None, min_distance=1e-3):
+    """Picks new points between neighbouring finished runs whose outputs differ the most.
+
+    Every finished run is joined to its nearest neighbours (2 per parameter by default), and
+    each pair is scored by the largest change of any output between them, in standard
+    deviations of that output.  A large change between close runs is a steep gradient, and
+    between distant runs an unresolved (uncertain) part of the space; either way the midpoint
+    is where another run tells us the most.  Midpoints are taken best first, skipping any
+    that are closer than a quarter of their pair's distance to an existing or already picked
+    point, or whose pair is closer together than twice min_distance.
+    Args:
+        unit_points -- an (n, d) array of finished runs in unit coordinates (see ParameterSpace)
+        results -- an (n, outputs) array of their outputs
+        existing -- an (m, d) array of every row of the database (run or not) in unit coordinates
+        n_points -- the maximum number of points to pick
+        neighbours -- the number of neighbours of each run to consider
+        min_distance -- the smallest distance, in unit coordinates, to refine down to
+    Returns:
+        an (k, d) array of the picked points, the index of the finished run each was made from
+        (used as a template for its other parameters), and their scores
+    """
+    n, dimensions = unit_points.shape
+    if neighbours is None:
+        neighbours = 2 * dimensions
+    indices, distances = nearest(unit_points, unit_points, neighbours, exclude_self=True)
+    if n_points <= 0 or indices.size == 0:
+        return np.empty((0, dimensions)), np.empty(0, dtype=np.int64), np.empty(0)
+    spread = results.std(axis=0)
+    spread[spread == 0] = 1.0
+    first = np.repeat(np.arange(n), indices.shape[1])
+    second = indices.ravel()
+    lengths = distances.ravel()
+    # each pair once
+    _, keep = np.unique(np.column_stack([np.minimum(first, second), np.maximum(first, second)]), axis=0, return_index=True)
+    first, second, lengths = first[keep], second[keep], lengths[keep]
+    scores = (np.abs(results[first] - results[second]) / spread).max(axis=1)
+    candidates = (unit_points[first] + unit_points[second]) / 2
+    clearance = nearest(existing, candidates, 1)[1][:, 0] if len(existing) else np.full(len(candidates), np.inf)
+    picked = []
+    for candidate in np.argsort(-scores, kind="stable"):
+        if len(picked) == n_points or scores[candidate] <= 0:
+            break
+        if lengths[candidate] < 2 * min_distance or clearance[candidate] < lengths[candidate] / 4:
+            continue
+        if picked:
+            gaps = np.sqrt(((candidates[picked] - candidates[candidate])**2).sum(axis=1))
+            if gaps.min() < lengths[candidate] / 4:
+                continue
+        picked.append(candidate)
+    picked = np.array(picked, dtype=np.int64)
+    return candidates[picked], first[picked], scores[picked]
+
+def insert_rows(connection, template_ids, columns, values, integer=None):
+    """Inserts new unrun rows, each a copy of a template row with the given parameter values.
+
+    The values of integer columns (integer[i] is true for columns[i]) are written as ints, as
+    a dispatcher decodes those columns with int().  Returns the number of rows inserted.
+    """
+    integer = [False] * len(columns) if integer is None else integer
+    cursor = connection.execute("SELECT * FROM model_run_params LIMIT 0")
+    row_columns = [d[0] for d in cursor.description if d[0] not in ROW_COLUMNS_EXCLUDED]
+    positions = [row_columns.index(column) for column in columns]
+    select = "SELECT %s FROM model_run_params WHERE run_param_id = ?" % ", ".join(["\"%s\"" % c for c in row_columns])
+    insert = "INSERT INTO model_run_params (%s) VALUES (%s)" % (", ".join(["\"%s\"" % c for c in row_columns]),
+                                                               ", ".join(["?"] * len(row_columns)))
+    rows = []
+    for template_id, point in zip(template_ids, values):
+        row = list(connection.execute(select, (template_id,)).fetchone())
+        for position, value, is_integer in zip(positions, point, integer):
+            row[position] = int(round(value)) if is_integer else value.item()
+        rows.append(row)
+    connection.executemany(insert, rows)
+    connection.commit()
+    return len(rows)
+
+def refine(database, outputs, n_points, parameters=None, neighbours=None, min_distance=1e-3):
+    """Adds up to n_points unrun rows to a database where the outputs of the finished runs change fastest.
+
+    The new rows are copies of a finished run with the refined parameters replaced (see
+    propose_points), so a dispatcher claims them like any other unrun row.
+    Args:
+        database -- the path of the parameter database
+        outputs -- the model_run_outputs columns to refine, e.g. ["output.topography.range"]
+        n_points -- the maximum number of rows to add
+        parameters -- the model_param columns to refine over (default: every numeric parameter that varies)
+        neighbours -- the number of neighbours of each run that are compared (default: twice the parameters)
+        min_distance -- the smallest distance, as a fraction of each parameter's range, to refine down to
+    Returns:
+        the number of rows added
+    """
+    connection = connect_wal(database)
+    try:
+        space = ParameterSpace.from_database(connection, parameters)
+        if not len(space):
+            print("no numeric parameters vary between runs, nothing to refine")
+            return 0
+        run_param_ids, values, results = finished_results(connection, space.columns, outputs)
+        if len(run_param_ids) < 2:
+            print("%d finished runs, nothing to refine yet" % len(run_param_ids))
+            return 0
+        existing = np.array(connection.execute("SELECT %s FROM model_run_params" % ", ".join(
+            ["\"%s\"" % column for column in space.columns])).fetchall(), dtype=float)
+        points, templates, scores = propose_points(space.to_unit(values), results, space.to_unit(existing),
+                                                   n_points, neighbours, min_distance)
+        added = insert_rows(connection, [run_param_ids[t] for t in templates], space.columns, space.from_unit(points),
+                            space.integer)
+    finally:
+        connection.close()
+    print("added %d runs from %d finished runs" % (added, len(run_param_ids)))
+    return added
+
+def wait_for_round(database, first, last, min_results=None, poll_interval=DEFAULT_POLL_INTERVAL):
+    """Waits until the rows with run_param_id in (first, last] have finished running.
+
+    With min_results, waits only until that many of them have finished.  Rows that never finish
+    (a run that failed and was not reset) keep this waiting, so give min_results below the
+    number of rows if that can happen.
+    """
+    connection = connect_wal(database)
+    try:
+        while True:
+            rows, finished = connection.execute(ROUND_PROGRESS_QUERY, (first, last)).fetchone()
+            if finished >= rows or (min_results is not None and finished >= min_results):
+                return finished
+            time.sleep(poll_interval)
+    finally:
+        connection.close()
+
+def refine_in_rounds(database, outputs, n_points, rounds, parameters=None, neighbours=None,
+                     min_distance=1e-3, poll_interval=DEFAULT_POLL_INTERVAL, min_results=None):
+    """Refines a database in rounds alongside a running ModelDispatcher.
+
+    Each round waits until the rows of the previous round (for the first round, every row in
+    the database) have finished, or min_results of them have, then adds up to n_points new
+    rows from all the runs that have finished (see refine), so each round builds on the results
+    of the last.  The dispatcher must still be there to claim the new rows: start it with
+    wait_for_rows (dispatch --wait), or it exits once it has claimed every row.  Stops early if
+    a round adds nothing.
+    Args:
+        database -- the path of the parameter database
+        outputs -- the model_run_outputs columns to refine
+        n_points -- the maximum number of rows added per round
+        rounds -- the number of rounds
+        poll_interval -- seconds between checks for the previous round's runs having finished
+        min_results -- the number of finished runs of the previous round to wait for (default: all of them)
+        (see refine for the other arguments)
+    Returns:
+        the total number of rows added
+    """
+    total = 0
+    connection = connect_wal(database)
+    first, last = 0, connection.execute(LAST_ROW_QUERY).fetchone()[0]
+    connection.close()
+    for round_number in range(rounds):
+        finished = wait_for_round(database, first, last, min_results, poll_interval)
+        print("refinement round %d, after %d new results" % (round_number + 1, finished))
+        added = refine(database, outputs, n_points, parameters, neighbours, min_distance)
+        total += added
+        if added == 0:
+            break
+        # refine appends its rows, so they are the ones after the last row of this round
+        connection = connect_wal(database)
+        first, last = last, connection.execute(LAST_ROW_QUERY).fetchone()[0]
+        connection.close()
+    return total
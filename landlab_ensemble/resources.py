@@ -0,0 +1,153 @@
+import os
+import socket
+import sqlite3
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# columns added to model_run_metadata for the resources used by each run
+RESOURCE_COLUMNS = (("peak_rss_kb", "INTEGER"),
+                    ("user_cpu_time", "REAL"),
+                    ("system_cpu_time", "REAL"),
+                    ("output_bytes", "INTEGER"),
+                    ("host", "TEXT"),
+                    ("pid", "INTEGER"))
+
+def add_resource_columns(cursor):
+    """Adds the resource columns to model_run_metadata if they are not there yet.
+
+    They are added when a database is first dispatched from rather than when it is created,
+    so databases made by older versions get them the same way.
+    """
+    missing = _missing_resource_columns(cursor)
+    for column, column_type in RESOURCE_COLUMNS:
+        if column in missing:
+            cursor.execute("ALTER TABLE model_run_metadata ADD COLUMN %s %s" % (column, column_type))
+
+def _missing_resource_columns(cursor):
+    """The RESOURCE_COLUMNS names model_run_metadata does not have yet."""
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(model_run_metadata)").fetchall()}
+    return [column for column, _ in RESOURCE_COLUMNS if column not in existing]
+
+def resource_metadata_sql(cursor):
+    """The metadata table to select resources from, with missing resource columns read as NULL.
+
+    Readers use this rather than add_resource_columns, so reporting on a database that was
+    never dispatched from does not change its schema.
+    """
+    missing = _missing_resource_columns(cursor)
+    if not missing:
+        return "model_run_metadata"
+    return "(SELECT *, %s FROM model_run_metadata)" % ", ".join(["NULL AS %s" % column for column in missing])
+
+def _reset_peak_rss():
+    """Resets the kernel's peak resident set size of this process (linux only), returning True if it did."""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_kb():
+    """The peak resident set size of this process in kilobytes."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss is the peak over the life of the process (kilobytes on linux, bytes on mac)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _cpu_times():
+    if resource is None:
+        times = os.times()
+        return times.user, times.system
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime, usage.ru_stime
+
+class ResourceUsage:
+    """Measures the resources a model run uses inside the process running it.
+
+    CPU times are the difference between getrusage calls at start() and stop().  The peak
+    RSS is reset at start() where the kernel allows it (linux), so it covers just this run
+    even in a worker that is reused; elsewhere it is the peak of the worker so far.
+
+    Attributes:
+        peak_rss_reset -- whether the peak RSS was reset for this run
+    """
+    def __init__(self):
+        self.start()
+
+    def start(self):
+        """Starts (or restarts) measuring."""
+        self.peak_rss_reset = _reset_peak_rss()
+        self._user_time, self._system_time = _cpu_times()
+
+    def stop(self, output_bytes=None):
+        """Returns the resources used since start() as a dictionary of RESOURCE_COLUMNS values."""
+        user_time, system_time = _cpu_times()
+        return {"peak_rss_kb": _peak_rss_kb(),
+                "user_cpu_time": user_time - self._user_time,
+                "system_cpu_time": system_time - self._system_time,
+                "output_bytes": output_bytes,
+                "host": socket.gethostname(),
+                "pid": os.getpid()}
+
+def resource_update_sql():
+    """The statement that records a run's resources: the RESOURCE_COLUMNS values followed by the model_run_id."""
+    assignments = ", ".join(["%s = ?" % column for column, _ in RESOURCE_COLUMNS])
+    return "UPDATE model_run_metadata SET %s WHERE model_run_id = ?" % assignments
+
+def resource_values(resources, model_run_id):
+    """The parameters for resource_update_sql."""
+    return tuple(resources[column] for column, _ in RESOURCE_COLUMNS) + (model_run_id,)
+
+COST_QUERY = """
+SELECT {parameters}, COUNT(*), AVG({cost}), SUM({cost}), AVG(m.peak_rss_kb), MAX(m.peak_rss_kb)
+FROM model_run_params p JOIN {metadata} m ON p.model_run_id = m.model_run_id
+WHERE m.model_end_time IS NOT NULL AND m.user_cpu_time IS NOT NULL
+GROUP BY {parameters}
+ORDER BY {parameters}
+"""
+
+def varying_parameters(connection):
+    """The model_param columns of model_run_params that take more than one value."""
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM model_run_params LIMIT 0")
+    columns = [d[0] for d in cursor.description if d[0].startswith("model_param.")]
+    if not columns:
+        return []
+    counts = cursor.execute("SELECT %s FROM model_run_params" % ", ".join(["COUNT(DISTINCT \"%s\")" % c for c in columns])).fetchone()
+    cursor.close()
+    return [column for column, count in zip(columns, counts) if count > 1]
+
+def cost_by_parameters(database, parameters=None, cost="m.user_cpu_time + m.system_cpu_time"):
+    """Summarises the cost of finished runs for every combination of the given parameters.
+
+    Args:
+        database -- the path of the parameter database
+        parameters -- the model_param columns to group by (default: the ones that vary between runs)
+        cost -- an sql expression over the metadata table (m) to summarise, CPU seconds by default
+    Returns:
+        the column names and a list of rows of the parameter values, the number of runs, the mean
+        and total cost and the mean and maximum peak RSS (kB)
+    """
+    connection = sqlite3.connect(database)
+    metadata = resource_metadata_sql(connection.cursor())
+    if parameters is None:
+        parameters = varying_parameters(connection)
+    if parameters:
+        parameter_sql = ", ".join(["p.\"%s\"" % parameter for parameter in parameters])
+    else:
+        parameter_sql = "NULL"
+    rows = connection.execute(COST_QUERY.format(parameters=parameter_sql, cost=cost, metadata=metadata)).fetchall()
+    connection.close()
+    columns = list(parameters) + ["runs", "mean_cost", "total_cost", "mean_peak_rss_kb", "max_peak_rss_kb"]
+    return columns, rows
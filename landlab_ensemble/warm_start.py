@@ -0,0 +1,129 @@
+import os
+import time
+
+import numpy as np
+
+from .parameter_space import ParameterSpace, nearest
+
+WARM_START_COLUMN = "warm_start_donor"
+WARM_START_UPDATE_SQL = "UPDATE model_run_metadata SET warm_start_donor = ? WHERE model_run_id = ?"
+FINISHED_RUNS_QUERY = """
+SELECT p.model_run_id, m.model_end_time{columns}
+FROM model_run_params p JOIN model_run_metadata m ON p.model_run_id = m.model_run_id
+WHERE m.model_end_time IS NOT NULL AND m.model_end_time >= ?
+"""
+DEFAULT_REFRESH_INTERVAL = 10.0  # seconds between looking for runs finished by other dispatchers
+INITIAL_POINTS = 64  # rows of the donor point array before it first grows
+
+def add_warm_start_column(cursor):
+    """Adds the warm_start_donor column to model_run_metadata if it is not there yet.
+
+    Like the resource columns it is added when a database is first dispatched from with
+    warm starts, so the tables made by create_model_db do not change.
+    """
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(model_run_metadata)").fetchall()}
+    if WARM_START_COLUMN not in existing:
+        cursor.execute("ALTER TABLE model_run_metadata ADD COLUMN %s TEXT" % WARM_START_COLUMN)
+
+def _parameter_value(param_dict, column):
+    value = param_dict
+    for key in column.split('.')[1:]:
+        value = value[key]
+    return value
+
+class WarmStarter:
+    """Picks the finished run nearest to a new run's parameters for the new run to start from.
+
+    Distances are measured between the numeric parameters that vary between rows, each
+    scaled to its range (see ParameterSpace).  Finished runs are read from the database
+    when the WarmStarter is made and again every refresh_interval seconds, which picks up
+    runs finished by other dispatchers; runs of this dispatcher are added as they finish.
+
+    Attributes:
+        space -- the ParameterSpace distances are measured in
+        out_dir -- the directory/prefix the runs' netcdf files are saved to
+        output_store -- the dispatcher's OutputStore, None if runs are saved to their own files
+        run_ids -- the model run ids of the finished runs that can be donors
+        points -- the unit coordinates of the donors, in the first len(run_ids) rows
+    """
+    def __init__(self, connection, out_dir="", output_store=None, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        """Creates a WarmStarter for the runs of a parameter database.
+
+        Args:
+            connection -- a connection to the parameter database, used to look for finished runs
+            out_dir -- the directory/prefix the runs' netcdf files are saved to
+            output_store -- the dispatcher's OutputStore, if runs are saved to one
+            refresh_interval -- the seconds between reads of the finished runs
+        """
+        self.connection = connection
+        self.space = ParameterSpace.from_database(connection)
+        self.out_dir = out_dir
+        self.output_store = output_store
+        self.refresh_interval = refresh_interval
+        self.run_ids = []
+        self.points = np.empty((INITIAL_POINTS, len(self.space)))
+        self._known = set()
+        self._pending = {}
+        self._last_end_time = 0.0
+        self._last_refresh = None
+
+    def refresh(self):
+        """Adds the runs finished since the last refresh."""
+        columns = "".join([", p.\"%s\"" % column for column in self.space.columns])
+        rows = self.connection.execute(FINISHED_RUNS_QUERY.format(columns=columns), (self._last_end_time,)).fetchall()
+        for row in rows:
+            self._last_end_time = max(self._last_end_time, row[1])
+            self._add(row[0], row[2:])
+        self._last_refresh = time.monotonic()
+
+    def _add(self, model_run_id, values):
+        if model_run_id in self._known:
+            return
+        self._known.add(model_run_id)
+        if len(self.run_ids) == len(self.points):
+            # doubled, so adding n donors copies O(n) rows in all
+            grown = np.empty((2 * len(self.points), len(self.space)))
+            grown[:len(self.points)] = self.points
+            self.points = grown
+        self.points[len(self.run_ids)] = self.space.to_unit(np.array([values], dtype=float))[0]
+        self.run_ids.append(model_run_id)
+
+    def point(self, param_dict):
+        """The values of the space's parameters in a parameter dictionary."""
+        return [_parameter_value(param_dict, column) for column in self.space.columns]
+
+    def donor(self, param_dict):
+        """Returns the model run id of the nearest finished run, None if there is none yet."""
+        if self._last_refresh is None or time.monotonic() - self._last_refresh > self.refresh_interval:
+            self.refresh()
+        if not self.run_ids:
+            return None
+        query = self.space.to_unit(np.array([self.point(param_dict)], dtype=float))
+        indices, _ = nearest(self.points[:len(self.run_ids)], query, 1)
+        return self.run_ids[indices[0, 0]]
+
+    def warm_start(self, model_run_id, param_dict):
+        """Finds what a new run should start from.
+
+        Returns None if there is no finished run with saved fields yet, otherwise a dictionary
+        with the "donor" model run id and either the "path" of its netcdf file or, for runs in
+        the output store, its "node_fields" (see apply_warm_start in construct_model).
+        """
+        self._pending[model_run_id] = self.point(param_dict)
+        donor = self.donor(param_dict)
+        if donor is None:
+            return None
+        path = "%s%s.nc" % (self.out_dir, donor)
+        if os.path.exists(path):
+            return {"donor": donor, "path": path}
+        if self.output_store is not None:
+            try:
+                return {"donor": donor, "node_fields": self.output_store.read(model_run_id=donor)}
+            except KeyError:
+                pass
+        return None
+
+    def finished(self, model_run_id):
+        """Makes a run of this dispatcher a donor as soon as it has finished."""
+        if model_run_id in self._pending:
+            self._add(model_run_id, self._pending.pop(model_run_id))
@@ -1,2 +1 @@
-from .model_base import LandlabModel
-
+from .model_base import LandlabModel, LandlabModelBatch
@@ -6,7 +6,12 @@
 # *(Greg Tucker, University of Colorado Boulder)*
 #
 
+import json
+import math
+import os
+import pickle
 import sys
+import time
 
 import numpy as np
 from landlab import ModelGrid, create_grid, load_params
@@ -35,7 +40,7 @@ def merge_user_and_default_params(user_params, default_params):
         if k in default_params:
             if k not in user_params.keys():
                 user_params[k] = default_params[k]
-            elif isinstance(user_params[k], dict) and k != "grid":
+            elif isinstance(user_params[k], dict) and isinstance(default_params[k], dict) and k != "grid":
                 merge_user_and_default_params(user_params[k], default_params[k])
 
 
@@ -80,19 +85,257 @@ def _get_pause_time_list_and_next(time_info, clock_dict):
     next_pause = pause_times.pop(0)
     return pause_times, next_pause
 
-def max_steady_state(old_values, new_values):
-    return np.abs(np.max(old_values) - np.max(new_values))
+def max_steady_state(old_values, new_values, out=None, axis=None):
+    """Change in the maximum value."""
+    return np.abs(np.max(old_values, axis=axis) - np.max(new_values, axis=axis))
 
-def mean_steady_state(old_values, new_values):
-    return np.abs(np.mean(old_values) - np.mean(new_values))
+def mean_steady_state(old_values, new_values, out=None, axis=None):
+    """Change in the mean value."""
+    return np.abs(np.mean(old_values, axis=axis) - np.mean(new_values, axis=axis))
 
-def max_local_steady_state(old_values, new_values):
-    return np.max(np.abs(old_values-new_values))
+def max_local_steady_state(old_values, new_values, out=None, axis=None):
+    """Largest change at any single node.
+
+    If given, ``out`` is used as scratch space for the differences so no
+    grid-sized temporary is allocated.
+    """
+    out = np.subtract(new_values, old_values, out=out)
+    np.abs(out, out=out)
+    return np.max(out, axis=axis)
 
 STEADY_STATE_FUNCTIONS = {'max': max_steady_state,
                           'mean': mean_steady_state,
                           'max_local': max_local_steady_state}
 
+
+class SteadyStateMonitor:
+    """Track whether a field has stopped changing between checks.
+
+    The field is compared against a snapshot taken at the previous check. The
+    snapshot and a scratch array are allocated once and updated in place, so a
+    check allocates no grid-sized temporaries. The field counts as steady once
+    the change has stayed under ``threshold`` for ``window`` consecutive checks.
+
+    Parameters
+    ----------
+    values : array
+        Initial values of the field (copied into the snapshot).
+    metric : str
+        One of the keys of ``STEADY_STATE_FUNCTIONS``.
+    threshold : float
+        Change below which an interval counts as steady.
+    window : int, optional
+        Number of consecutive steady intervals needed.
+
+    Examples
+    --------
+    >>> z = np.zeros(4)
+    >>> monitor = SteadyStateMonitor(z, "max_local", 0.5, window=2)
+    >>> z += 1.0
+    >>> monitor.check(z)
+    False
+    >>> z += 0.1
+    >>> monitor.check(z)
+    False
+    >>> monitor.check(z)
+    True
+    >>> monitor.consecutive
+    2
+    """
+
+    def __init__(self, values, metric, threshold, window=1):
+        self.metric = STEADY_STATE_FUNCTIONS[metric]
+        self.threshold = threshold
+        self.window = max(int(window), 1)
+        self.snapshot = np.array(values, dtype=float)
+        self.scratch = np.empty_like(self.snapshot)
+        self.reset(values)
+
+    def reset(self, values):
+        """Take a new snapshot and forget any steady intervals."""
+        np.copyto(self.snapshot, values)
+        self.amount = -1
+        self.consecutive = 0
+        self.steady = False
+
+    def check(self, values):
+        """Compare against the snapshot, then update the snapshot in place."""
+        self.amount = self.metric(self.snapshot, values, out=self.scratch)
+        np.copyto(self.snapshot, values)
+        if self.amount < self.threshold:
+            self.consecutive += 1
+        else:
+            self.consecutive = 0
+        self.steady = self.consecutive >= self.window
+        return self.steady
+
+TIMER_BUCKETS_PER_OCTAVE = 8  # histogram buckets per doubling of a duration, see TimerStats
+_ZERO_BUCKET = -(2 ** 31)  # the bucket of durations too short for the clock
+
+
+class TimerStats:
+    """Streaming statistics of the durations of one timer, in constant memory.
+
+    The number of calls, total, minimum and maximum are exact. Percentiles
+    come from a histogram of the durations in logarithmic buckets,
+    ``TIMER_BUCKETS_PER_OCTAVE`` per doubling, so they are within about 4%
+    of the exact ones (and exact when every call took the same time).
+
+    Examples
+    --------
+    >>> stats = TimerStats()
+    >>> for duration in (0.1, 0.2, 0.3, 0.4, 10.0):
+    ...     stats.add(duration)
+    >>> stats.count, stats.total, stats.max
+    (5, 11.0, 10.0)
+    >>> round(stats.percentile(50), 2)  # 0.3 exactly
+    0.31
+    >>> stats.percentile(100)
+    10.0
+    """
+
+    __slots__ = ("count", "total", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, duration):
+        """Record one duration."""
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        if duration < self.min:
+            self.min = duration
+        bucket = math.floor(math.log2(duration) * TIMER_BUCKETS_PER_OCTAVE) if duration > 0 else _ZERO_BUCKET
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, q):
+        """The q-th percentile (nearest rank) of the durations, from the histogram."""
+        rank = max(1, math.ceil(q / 100.0 * self.count))
+        if rank >= self.count:
+            return self.max
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                break
+        if bucket == _ZERO_BUCKET:
+            return 0.0
+        # the geometric middle of the bucket, kept within the durations seen
+        value = 2.0 ** ((bucket + 0.5) / TIMER_BUCKETS_PER_OCTAVE)
+        return min(max(value, self.min), self.max)
+
+
+class _Timing:
+    """Context manager adding the duration of a block to a ``TimerStats``."""
+
+    __slots__ = ("stats", "start")
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add(time.perf_counter() - self.start)
+        return False
+
+
+class _NoTiming:
+    """Context manager that does nothing, used when timing is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_TIMING = _NoTiming()
+
+
+class RunTimer:
+    """Accumulate wall-clock durations of named sections of a run.
+
+    Every ``with timer.time(name):`` block adds one duration to the
+    ``TimerStats`` of ``name``, so memory does not grow with the number of
+    time steps. When the timer is disabled ``time`` returns a shared no-op context
+    manager, so the instrumentation can stay in hot loops.
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        Whether to record anything.
+
+    Examples
+    --------
+    >>> timer = RunTimer()
+    >>> for i in range(3):
+    ...     with timer.time("step"):
+    ...         pass
+    >>> timer.add("setup", 2.0)
+    >>> [(name, calls, total) for name, calls, total, *_ in timer.summary()]  # doctest: +ELLIPSIS
+    [('setup', 1, 2.0), ('step', 3, ...)]
+    >>> RunTimer(enabled=False).summary()
+    []
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stats = {}
+
+    def time(self, name):
+        """Context manager timing one call of ``name``."""
+        if not self.enabled:
+            return _NO_TIMING
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = TimerStats()
+        return _Timing(stats)
+
+    def add(self, name, duration):
+        """Record a duration measured elsewhere."""
+        if self.enabled:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = TimerStats()
+            stats.add(duration)
+
+    def summary(self):
+        """Calls, total, mean, median, 95th percentile and maximum of each timer.
+
+        Returns a list of ``(name, calls, total, mean, p50, p95, max)``
+        tuples sorted by name. The percentiles are approximate, see
+        ``TimerStats``.
+        """
+        rows = []
+        for name in sorted(self.stats):
+            stats = self.stats[name]
+            rows.append((name, stats.count, stats.total, stats.total / stats.count,
+                         stats.percentile(50), stats.percentile(95), stats.max))
+        return rows
+
+
+def write_checkpoint(path, state):
+    """Pickle ``state`` to ``path`` atomically.
+
+    The state is written and synced to a temporary file next to ``path``,
+    which then replaces ``path``, so a run killed mid-write leaves the
+    previous checkpoint intact.
+    """
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as checkpoint_file:
+        pickle.dump(state, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary_path, path)
+
 def out_of_time(run_duration, start_time, current_time):
     if run_duration is None:
         return False
@@ -107,6 +350,17 @@ def get_out_of_time_function(run_duration, start_time):
 class LandlabModel:
     """Base class for a generic Landlab grid-based model."""
 
+    # node field whose change is tracked for steady state
+    steady_state_field = "topographic__elevation"
+
+    # node fields saved at the end of a run when ``output.fields`` is not given
+    # (None saves every node field)
+    grid_fields_to_save = None
+
+    # parameters (dotted keys, e.g. "diffuser.D") that ``reset`` can change on
+    # an existing model; runs differing in anything else need a new model
+    resettable_params = ()
+
     DEFAULT_PARAMS = {
         "grid": {
             "source": "create",
@@ -136,6 +390,72 @@ class LandlabModel:
         self.setup_for_output(params)
         self.setup_run_control(params["runtime"])
 
+    @classmethod
+    def pool_key(cls, params):
+        """A key that is equal for parameters one pooled model can be reset to.
+
+        The parameters are compared without ``resettable_params``. Returns
+        None for a model that does not override ``reset`` and for a grid
+        passed as an object, which can not be compared.
+
+        Examples
+        --------
+        >>> class Model(LandlabModel):
+        ...     resettable_params = ("seed", "diffuser.D")
+        ...     def reset(self, params):
+        ...         return True
+        >>> a = {"grid": {"source": "create"}, "seed": 1, "diffuser": {"D": 0.1}}
+        >>> b = {"grid": {"source": "create"}, "seed": 2, "diffuser": {"D": 0.2}}
+        >>> Model.pool_key(a) == Model.pool_key(b)
+        True
+        >>> b["grid"]["source"] = "file"
+        >>> Model.pool_key(a) == Model.pool_key(b)
+        False
+        >>> LandlabModel.pool_key(a) is None
+        True
+        """
+        if cls.reset is LandlabModel.reset or params.get("grid", {}).get("source") == "grid_object":
+            return None
+        pruned = json.loads(json.dumps(params, default=str))
+        for key in cls.resettable_params:
+            *parents, name = key.split(".")
+            section = pruned
+            for parent in parents:
+                section = section.get(parent, {}) if isinstance(section, dict) else {}
+            if isinstance(section, dict):
+                section.pop(name, None)
+        return json.dumps(pruned, sort_keys=True)
+
+    def reset(self, params):
+        """Prepare this finished model for a new run with params.
+
+        Rebuilding the grid and components costs as much as a short run, so
+        ``ModelPool`` hands a finished model to the next run whose parameters
+        differ only in ``resettable_params`` (see ``pool_key``). Override this
+        to call ``reset_run_control``, put the grid fields back to their
+        initial values (see ``snapshot_fields``) and rebind the changed
+        parameters, then return True. The default returns False, so a new
+        model is built instead.
+        """
+        return False
+
+    def reset_run_control(self, params):
+        """Set up output and run control for params again, keeping the grid."""
+        merge_user_and_default_params(params, self.DEFAULT_PARAMS)
+        self.setup_for_output(params)
+        self.setup_run_control(params["runtime"])
+
+    def snapshot_fields(self):
+        """Copy every grid field, to be put back with ``restore_fields``."""
+        return {name: self.grid.field_values(name.split(":", 1)[1], at=name[3:].split(":", 1)[0]).copy()
+                for name in self.grid.fields()}
+
+    def restore_fields(self, fields):
+        """Copy fields saved by ``snapshot_fields`` back into the grid's arrays."""
+        for name, values in fields.items():
+            at, field = name[3:].split(":", 1)
+            np.copyto(self.grid.field_values(field, at=at), values)
+
     def setup_grid(self, grid_params):
         """Load or create the grid.
 
@@ -192,6 +512,10 @@ class LandlabModel:
         is interpreted as a list of model times for plotting, saving, or reporting.
         If a single float, the value is interpreted as the (regular) time
         interval (in model time) for plotting, saving, or reporting.
+        ``output`` may also have ``fields``, the node fields saved at the end
+        of a run: a list of names, or a dictionary of name to how the field is
+        stored (see ``landlab_ensemble.output_store.field_encoding``), and
+        ``complevel``, the compression level of the saved fields.
             Should also contain a key ``clock`` as a dictionary that has values
         for ``start`` and ``stop``.
         """
@@ -211,6 +535,8 @@ class LandlabModel:
         self.ndigits_for_save_files = int(np.ceil(np.log10(len(self.save_times) + 1)))
         self.save_num = 0  # current save file frame number
         self.save_path = op_params["save_path"]
+        self.save_fields = op_params.get("fields")
+        self.save_complevel = op_params.get("complevel")
         if op_params["plot_to_file"]:
             self.ndigits_for_plot_files = int(
                 np.ceil(np.log10(len(self.plot_times) + 1))
@@ -218,6 +544,18 @@ class LandlabModel:
             self.plot_num = 0  # current plot image frame number
         self.display_params = params
 
+    def fields_to_save(self):
+        """The names of the node fields saved at the end of a run.
+
+        These are the fields of ``output.fields`` if it is given, otherwise
+        ``grid_fields_to_save``, otherwise every node field.
+        """
+        if self.save_fields is not None:
+            return list(self.save_fields)
+        if self.grid_fields_to_save is not None:
+            return list(self.grid_fields_to_save)
+        return list(self.grid.at_node.keys())
+
     def setup_run_control(self, runtime_params):
         """Initialize variables related to control of run timing."""
         self.dt = 1
@@ -229,18 +567,135 @@ class LandlabModel:
         except KeyError:
             self.run_duration = None
             self.current_time = 0
+        self.start_time = self.current_time
+        self.steady_state_type = "max_local"
+        self.steady_state_threshold = 0.0
+        self.steady_state_window = 1
         try:
             steady_state_params = runtime_params['steady_state']
-            self.steady_state = steady_state_params['steady_state']
+            self.stop_at_steady_state = steady_state_params['steady_state']
             self.steady_state_type = steady_state_params['steady_state_type']
             self.steady_state_threshold = steady_state_params['steady_state_threshold']
             self.steady_state_interval = steady_state_params['steady_state_interval']
+            self.steady_state_window = steady_state_params.get('steady_state_window', 1)
         except KeyError:
-            self.steady_state = False
+            self.stop_at_steady_state = False
             self.steady_state_interval = self.run_duration
+        self.steady_state = False
+        self.steady_state_ammount = -1
+        self.steady_state_monitor = None
+        self.next_steady_state_check = None
+        checkpoint_params = runtime_params.get('checkpoint', {})
+        self.checkpoint_interval = checkpoint_params.get('interval')
+        self.checkpoint_wall_interval = checkpoint_params.get('wall_interval')
+        self.checkpoint_path = None
+        self.checkpoint_key = None
+        self.timer = RunTimer(enabled=runtime_params.get('profile', False))
+
+    def start_steady_state_monitor(self):
+        """(Re)start steady-state tracking from the current state of the grid."""
+        values = self.grid.at_node[self.steady_state_field]
+        if self.steady_state_monitor is None:
+            self.steady_state_monitor = SteadyStateMonitor(
+                values,
+                self.steady_state_type,
+                self.steady_state_threshold,
+                self.steady_state_window,
+            )
+        else:
+            self.steady_state_monitor.reset(values)
+        self.steady_state = False
         self.steady_state_ammount = -1
-        self.last_elevation = np.zeros(self.grid.number_of_nodes)
-        
+
+    def checkpoint_state(self):
+        """Collect everything needed to continue the run later.
+
+        Override (and extend ``restore_checkpoint_state``) to add model state
+        that is not held in grid fields, such as a random number generator.
+        """
+        monitor = self.steady_state_monitor
+        return {
+            "key": self.checkpoint_key,
+            "current_time": self.current_time,
+            "next_steady_state_check": self.next_steady_state_check,
+            "fields": {name: self.grid.field_values(name.split(":", 1)[1], at=name[3:].split(":", 1)[0])
+                       for name in self.grid.fields()},
+            "steady_state": self.steady_state,
+            "steady_state_ammount": self.steady_state_ammount,
+            "monitor": None if monitor is None else {
+                "snapshot": monitor.snapshot,
+                "amount": monitor.amount,
+                "consecutive": monitor.consecutive,
+            },
+        }
+
+    def restore_checkpoint_state(self, state):
+        """Restore the state collected by ``checkpoint_state``.
+
+        Fields are copied into the existing arrays so components keep
+        working on the grid they were created with.
+        """
+        for name, values in state["fields"].items():
+            at, field = name[3:].split(":", 1)
+            if self.grid.has_field(field, at=at):
+                np.copyto(self.grid.field_values(field, at=at), values)
+            else:
+                self.grid.add_field(field, values.copy(), at=at)
+        self.current_time = state["current_time"]
+        self.next_steady_state_check = state["next_steady_state_check"]
+        self.start_steady_state_monitor()
+        if state["monitor"] is not None:
+            monitor = self.steady_state_monitor
+            np.copyto(monitor.snapshot, state["monitor"]["snapshot"])
+            monitor.amount = state["monitor"]["amount"]
+            monitor.consecutive = state["monitor"]["consecutive"]
+            monitor.steady = monitor.consecutive >= monitor.window
+        self.steady_state = state["steady_state"]
+        self.steady_state_ammount = state["steady_state_ammount"]
+
+    def load_node_fields(self, fields):
+        """Start from given node values, e.g. the final state of a similar run.
+
+        Values are copied into the node fields the grid already has, so
+        components keep working on the same arrays; fields the grid does not
+        have, or of a different size, are skipped. Returns the names of the
+        fields that were copied.
+        """
+        loaded = []
+        for name, values in fields.items():
+            if self.grid.has_field(name, at="node") and np.size(values) == self.grid.number_of_nodes:
+                np.copyto(self.grid.at_node[name], np.reshape(values, -1))
+                loaded.append(name)
+        return loaded
+
+    def save_checkpoint(self, path=None):
+        """Atomically write a checkpoint to path (default ``checkpoint_path``)."""
+        with self.timer.time("checkpoint"):
+            write_checkpoint(path or self.checkpoint_path, self.checkpoint_state())
+        self.last_checkpoint_wall_time = time.monotonic()
+
+    def load_checkpoint(self, path=None):
+        """Restore the run from a checkpoint at path (default ``checkpoint_path``).
+
+        A checkpoint written with a different ``checkpoint_key`` (i.e. for
+        other parameters) is ignored. Returns True if the run was restored.
+        """
+        path = path or self.checkpoint_path
+        if path is None or not os.path.exists(path):
+            return False
+        with open(path, "rb") as checkpoint_file:
+            state = pickle.load(checkpoint_file)
+        if state["key"] != self.checkpoint_key:
+            print("Ignoring checkpoint %s, it was written for different parameters" % path)
+            return False
+        self.restore_checkpoint_state(state)
+        print("Resuming from checkpoint %s at time %s" % (path, self.current_time))
+        return True
+
+    def remove_checkpoint(self):
+        """Delete the checkpoint of a finished run."""
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
 
     def report(self, current_time):
         """Issue a text update on status."""
@@ -259,19 +714,57 @@ class LandlabModel:
         save_grid(self.grid, save_path + str(save_num).zfill(ndigits) + ".grid")
 
     def check_if_steady_state(self):
-        steady_state_condition = STEADY_STATE_FUNCTIONS[self.steady_state_type]
-        self.steady_state_ammount = steady_state_condition(self.last_elevation, self.grid.at_node['topographic__elevation'])
-        self.stady_state = self.steady_state_ammount < self.steady_state_threshold
-        self.last_elevation = self.grid.at_node['topographic__elevation']
-        
-        
+        """Compare the steady-state field with its value at the previous check."""
+        if self.steady_state_monitor is None:
+            self.start_steady_state_monitor()
+            return self.steady_state
+        monitor = self.steady_state_monitor
+        self.steady_state = monitor.check(self.grid.at_node[self.steady_state_field])
+        self.steady_state_ammount = monitor.amount
+        return self.steady_state
+
     def update(self, dt):
         """Advance the modelb by one time step of duration dt."""
         self.current_time += dt
 
+    def rebind_fields(self):
+        """Refresh handles to grid fields after their arrays were replaced.
+
+        ``LandlabModelBatch`` swaps the steady-state field of each model for a
+        row of one stacked array. Override this if the model keeps its own
+        reference to that field (e.g. ``self.topo``).
+        """
+        pass
+
+    @classmethod
+    def batch_update(cls, batch, dt):
+        """Advance every active model of a ``LandlabModelBatch`` by dt.
+
+        The default steps each model on its own. Override this to work on
+        ``batch.state`` (one row per active model) with per-run parameter
+        vectors from ``batch.parameter``. Each model's ``current_time`` must
+        be advanced, as ``update`` does. ``batch.last_step`` is True for the
+        last step before a steady-state check, the only step after which a
+        model can drop out of the batch (see ``leave_batch``).
+        """
+        for model in batch.active:
+            model.update(dt)
+
+    def leave_batch(self):
+        """Called when the model drops out of a ``LandlabModelBatch``.
+
+        A ``batch_update`` that skips some of the model's own components can
+        bring their grid fields up to date here. The default does nothing.
+        """
+        pass
+
     def update_until_steady_state(self, dt):
+        """Run, checking every steady_state_interval, until the model is steady."""
+        if self.steady_state_monitor is None:
+            self.start_steady_state_monitor()
         while not self.steady_state:
-            self.update(dt)
+            self.update_until(self.current_time + self.steady_state_interval, dt)
+            self.check_if_steady_state()
 
     def update_until(self, update_to_time, dt):
         """Iterate up to given time, using time-step duration dt."""
@@ -287,16 +780,45 @@ class LandlabModel:
 
         Includes file output of images and model state at user-specified
         intervals.
+
+        If ``checkpoint_path`` is set the run continues from the checkpoint
+        there, if any, and writes a new one every ``checkpoint_interval``
+        model years and/or once ``checkpoint_wall_interval`` seconds have
+        passed since the last one (checked at every pause of the run).
         """
+        start_time = self.current_time
         if run_duration is None:
             run_duration = self.run_duration
+            start_time = self.start_time
         if dt is None:
             dt = self.dt
-        out_of_time = get_out_of_time_function(run_duration, self.current_time)
-        while not out_of_time(self.current_time) and not self.steady_state:
-            next_pause = self.current_time + self.steady_state_interval
-            self.update_until(next_pause, dt)
-            self.check_if_steady_state()
+        out_of_time = get_out_of_time_function(run_duration, start_time)
+        if not self.load_checkpoint():
+            self.start_steady_state_monitor()
+            self.next_steady_state_check = self.current_time + self.steady_state_interval
+        self.last_checkpoint_wall_time = time.monotonic()
+        next_checkpoint = None
+        if self.checkpoint_path is not None and self.checkpoint_interval is not None:
+            next_checkpoint = self.current_time + self.checkpoint_interval
+        while not out_of_time(self.current_time) and not (
+            self.stop_at_steady_state and self.steady_state
+        ):
+            next_pause = self.next_steady_state_check
+            if next_checkpoint is not None:
+                next_pause = min(next_pause, next_checkpoint)
+            with self.timer.time("update_until"):
+                self.update_until(next_pause, dt)
+            if next_pause == self.next_steady_state_check:
+                with self.timer.time("steady_state_check"):
+                    self.check_if_steady_state()
+                self.next_steady_state_check += self.steady_state_interval
+            if next_pause == next_checkpoint:
+                next_checkpoint += self.checkpoint_interval
+                self.save_checkpoint()
+            elif self.checkpoint_path is not None and self.checkpoint_wall_interval is not None and (
+                time.monotonic() - self.last_checkpoint_wall_time >= self.checkpoint_wall_interval
+            ):
+                self.save_checkpoint()
 
     def get_output(self):
         """Produce output report for storage.
@@ -314,7 +836,179 @@ class LandlabModel:
                 'output.topography.range': topo_max-topo_min,
                 'output.topography.mean': np.mean(topo),
                 'output.topography.std': np.std(topo)}
-        
+
+
+class LandlabModelBatch:
+    """Advance several runs of one model class in lock step.
+
+    Ensembles are mostly many runs of a small grid that differ only in scalar
+    parameters, where the Python overhead of stepping each model dominates.
+    The steady-state field of every run is stacked into one
+    ``(n_runs, n_nodes)`` array, ``state``, and each model's grid field is
+    replaced by its row, so array work in ``batch_update`` and the
+    steady-state checks cover all runs at once. A run drops out of the batch
+    when it runs out of time or (if it stops at steady state) becomes steady,
+    and the remaining rows are packed into a smaller array.
+
+    All models must be instances of the same class, on grids with the same
+    nodes and core nodes, with the same clock, steady-state interval and
+    steady-state type.
+
+    Parameters
+    ----------
+    models : list of LandlabModel
+        The models to run; their fields are rebound to rows of ``state``.
+
+    Examples
+    --------
+    >>> p = {"grid": {"source": "create",
+    ...               "create_grid": {"RasterModelGrid": [(3, 3)]}},
+    ...      "runtime": {"clock": {"start": 0.0, "stop": 4.0, "step": 1.0}}}
+    >>> models = []
+    >>> for i in range(3):
+    ...     model = LandlabModel(p)
+    ...     _ = model.grid.add_zeros("topographic__elevation", at="node")
+    ...     models.append(model)
+    >>> batch = LandlabModelBatch(models)
+    >>> batch.state.shape
+    (3, 9)
+    >>> np.shares_memory(models[1].grid.at_node["topographic__elevation"], batch.state)
+    True
+    >>> batch.run()
+    >>> [model.current_time for model in models]
+    [4.0, 4.0, 4.0]
+    >>> batch.active
+    []
+    """
+
+    def __init__(self, models):
+        if len(models) == 0:
+            raise ValueError("A LandlabModelBatch needs at least one model")
+        first = models[0]
+        for model in models[1:]:
+            if type(model) is not type(first):
+                raise ValueError("All models in a batch must be instances of %s" % type(first).__name__)
+            if model.grid.number_of_nodes != first.grid.number_of_nodes or not np.array_equal(
+                model.grid.core_nodes, first.grid.core_nodes
+            ):
+                raise ValueError("All models in a batch must share the same grid layout")
+            for attribute in ("dt", "current_time", "run_duration", "steady_state_interval", "steady_state_type"):
+                if getattr(model, attribute) != getattr(first, attribute):
+                    raise ValueError("All models in a batch must have the same %s" % attribute)
+        self.model_class = type(first)
+        self.field = first.steady_state_field
+        self.dt = first.dt
+        self.current_time = first.current_time
+        self.run_duration = first.run_duration
+        self.steady_state_interval = first.steady_state_interval
+        self.metric = STEADY_STATE_FUNCTIONS[first.steady_state_type]
+        self.models = list(models)
+        self.active = []
+        self.state = None
+        self.last_step = False
+        self._pack(self.models)
+
+    def _pack(self, models):
+        """Stack the field of each model into a new array and rebind the models to its rows."""
+        state = np.empty((len(models), self.models[0].grid.number_of_nodes))
+        for row, model in zip(state, models):
+            np.copyto(row, model.grid.at_node[self.field])
+        for row, model in zip(state, models):
+            model.grid.at_node[self.field] = row
+            model.rebind_fields()
+        self.active = list(models)
+        self.state = state
+        self._parameters = {}
+
+    def parameter(self, name):
+        """Per-run vector of a model attribute, one entry per active model."""
+        if name not in self._parameters:
+            self._parameters[name] = np.array([getattr(model, name) for model in self.active], dtype=float)
+        return self._parameters[name]
+
+    def update(self, dt):
+        """Advance all active models by one time step of duration dt."""
+        self.model_class.batch_update(self, dt)
+        self.current_time += dt
+
+    def update_until(self, update_to_time, dt):
+        """Iterate up to given time, using time-step duration dt."""
+        remaining_time = update_to_time - self.current_time
+        while remaining_time > 0.0:
+            dt = min(dt, remaining_time)
+            self.last_step = dt == remaining_time
+            self.update(dt)
+            remaining_time -= dt
+        self.last_step = False
+
+    def start_steady_state_monitor(self):
+        """Snapshot the state and forget any steady intervals, for every active model."""
+        self.snapshot = self.state.copy()
+        self.scratch = np.empty_like(self.state)
+        self.thresholds = self.parameter("steady_state_threshold")
+        self.windows = np.maximum(self.parameter("steady_state_window"), 1)
+        self.consecutive = np.zeros(len(self.active), dtype=int)
+        for model in self.active:
+            model.steady_state = False
+            model.steady_state_ammount = -1
+
+    def check_if_steady_state(self):
+        """Compare every run with its previous check in one pass over ``state``.
+
+        Returns a boolean array with one entry per active model.
+        """
+        amounts = self.metric(self.snapshot, self.state, out=self.scratch, axis=1)
+        np.copyto(self.snapshot, self.state)
+        below = amounts < self.thresholds
+        self.consecutive = np.where(below, self.consecutive + 1, 0)
+        steady = self.consecutive >= self.windows
+        for model, amount, is_steady in zip(self.active, amounts, steady):
+            model.steady_state_ammount = amount
+            model.steady_state = bool(is_steady)
+        return steady
+
+    def _drop_finished(self, finished, on_finish=None):
+        """Give finished models their own copy of the field and pack the rest."""
+        keep = ~finished
+        for model in [m for m, done in zip(self.active, finished) if done]:
+            model.leave_batch()
+            model.grid.at_node[self.field] = model.grid.at_node[self.field].copy()
+            model.rebind_fields()
+            if on_finish is not None:
+                on_finish(model)
+        snapshot = self.snapshot[keep]
+        consecutive = self.consecutive[keep]
+        self._pack([m for m, kept in zip(self.active, keep) if kept])
+        self.snapshot = snapshot
+        self.scratch = np.empty_like(self.state)
+        self.consecutive = consecutive
+        self.thresholds = self.parameter("steady_state_threshold")
+        self.windows = np.maximum(self.parameter("steady_state_window"), 1)
+
+    def run(self, on_finish=None):
+        """Run every model until it is out of time or steady.
+
+        Models are advanced ``steady_state_interval`` at a time and checked
+        for steady state after each interval, as ``LandlabModel.run`` does.
+
+        Parameters
+        ----------
+        on_finish : callable, optional
+            Called with each model as soon as it drops out of the batch.
+        """
+        out_of_time = get_out_of_time_function(self.run_duration, self.current_time)
+        self.start_steady_state_monitor()
+        while self.active:
+            if out_of_time(self.current_time):
+                self._drop_finished(np.ones(len(self.active), dtype=bool), on_finish)
+                break
+            next_pause = self.current_time + self.steady_state_interval
+            self.update_until(next_pause, self.dt)
+            steady = self.check_if_steady_state()
+            finished = steady & self.parameter("stop_at_steady_state").astype(bool)
+            if finished.any():
+                self._drop_finished(finished, on_finish)
+
 
 if __name__ == "__main__":
     """Launch a run.
@@ -1,4 +1,4 @@
-from cli_functions import create, dispatch, slurm_config, update_db
+from cli_functions import create, dispatch, pilot, slurm_config, update_db, cost, refine
 import uuid
 import argparse
 
@@ -10,14 +10,22 @@ def main():
               The possible commands are:
               createdb    Create a sqlite database based on a model configuration file
               dispatch    Create and run landlab models based on a parameter database
+              pilot       Keep running models from a parameter database until it is empty or the walltime is up
+              cost        Report the resources used by finished runs per parameter combination
+              refine      Add runs where the outputs of finished runs change fastest
               """)
     subparsers = parser.add_subparsers()
     parse_create = subparsers.add_parser("createdb")
     parse_dispatch = subparsers.add_parser("dispatch")
+    parse_pilot = subparsers.add_parser("pilot")
     parse_update = subparsers.add_parser("updatedb")
     parse_slurm = subparsers.add_parser("slurmitup")
+    parse_cost = subparsers.add_parser("cost")
+    parse_refine = subparsers.add_parser("refine")
     parse_create.add_argument('-t', '--template')
     parse_create.add_argument('-o', '--output')
+    parse_create.add_argument('--chunk_size', type=int, default=10000)
+    parse_create.add_argument('--normalized', action='store_true')
     parse_create.set_defaults(func=create)
 
     parse_dispatch.add_argument('-d', '--database')
@@ -26,13 +34,36 @@ def main():
     parse_dispatch.add_argument('-f', '--filter')
     parse_dispatch.add_argument('-n', type=int)
     parse_dispatch.add_argument('-p', '--processes', type=int)
+    parse_dispatch.add_argument('--tasks_per_worker', type=int, default=2)
+    parse_dispatch.add_argument('--backend', choices=['auto', 'dask', 'process'], default='auto')
+    parse_dispatch.add_argument('--max_tasks_per_child', type=int)
+    parse_dispatch.add_argument('--batch_size', type=int, default=1)
+    parse_dispatch.add_argument('--output_store', action='store_true')
+    parse_dispatch.add_argument('--warm_start', action='store_true')
+    parse_dispatch.add_argument('--async_writes', action='store_true')
+    parse_dispatch.add_argument('--wait', type=float)
     parse_dispatch.add_argument('-od')
     parse_dispatch.add_argument('-c', '--clean', action='store_true')
+    parse_dispatch.add_argument('--resume', action='store_true')
     parse_dispatch.add_argument('-b', '--batch_id', default=uuid.uuid4())
     parse_dispatch.add_argument('-mid', '--model_id')
     
     parse_dispatch.set_defaults(func=dispatch)
 
+    parse_pilot.add_argument('-d', '--database')
+    parse_pilot.add_argument('-m', '--model')
+    parse_pilot.add_argument('-od', default="")
+    parse_pilot.add_argument('-f', '--filter')
+    parse_pilot.add_argument('--walltime')
+    parse_pilot.add_argument('--margin', type=float, default=60.0)
+    parse_pilot.add_argument('-p', '--processes', type=int)
+    parse_pilot.add_argument('--batch_size', type=int, default=1)
+    parse_pilot.add_argument('--output_store', action='store_true')
+    parse_pilot.add_argument('--warm_start', action='store_true')
+    parse_pilot.add_argument('--async_writes', action='store_true')
+    parse_pilot.add_argument('--wait', type=float)
+    parse_pilot.set_defaults(func=pilot)
+
     parse_slurm.add_argument('-d', '--database')
     parse_slurm.add_argument('-m', '--model')
     parse_slurm.add_argument('-od')
@@ -43,6 +74,9 @@ def main():
     parse_slurm.add_argument('-ntsks', '--num_tasks', default=1)
     parse_slurm.add_argument('--cpus', default=1)
     parse_slurm.add_argument('--sbatch_file')
+    parse_slurm.add_argument('--pilots', type=int)
+    parse_slurm.add_argument('--walltime')
+    parse_slurm.add_argument('--batch_size', type=int, default=1)
 
     parse_update.set_defaults(func=update_db)
     parse_update.add_argument('-d', '--database')
@@ -50,6 +84,22 @@ def main():
 
     parse_slurm.set_defaults(func=slurm_config)
 
+    parse_cost.add_argument('-d', '--database')
+    parse_cost.add_argument('-p', '--parameters', nargs='+')
+    parse_cost.add_argument('--cost', default="m.user_cpu_time + m.system_cpu_time")
+    parse_cost.set_defaults(func=cost)
+
+    parse_refine.add_argument('-d', '--database')
+    parse_refine.add_argument('-o', '--outputs', nargs='+')
+    parse_refine.add_argument('-p', '--parameters', nargs='+')
+    parse_refine.add_argument('-n', type=int, default=100)
+    parse_refine.add_argument('--rounds', type=int, default=1)
+    parse_refine.add_argument('--neighbours', type=int)
+    parse_refine.add_argument('--min_distance', type=float, default=1e-3)
+    parse_refine.add_argument('--poll', type=float, default=10.0)
+    parse_refine.add_argument('--min_results', type=int)
+    parse_refine.set_defaults(func=refine)
+
     args = parser.parse_args()
     args.func(args)
 
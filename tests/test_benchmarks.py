@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'benchmarks')))
+
+import bench
+
+
+def test_quick_benchmarks_run():
+    results = bench.run_benchmarks(quick=True, repeat=1, only=["claim", "decode"])
+    assert set(results["benchmarks"]) == {"claim.rows_per_sec.216", "claim.rows_per_sec.2197", "row_to_params.rows_per_sec",
+                                          "row_decoder.rows_per_sec"}
+    assert all(result["value"] > 0 for result in results["benchmarks"].values())
+    assert results["environment"]["quick"]
+
+def test_batched_simple_lem_matches_single_runs():
+    # the speed of the two is compared by the simple_lem_batch benchmark, not here
+    from model_base import LandlabModelBatch
+    singles = bench.simple_lem_batch_models(4, steps=20)
+    for model in singles:
+        model.run()
+    batched = bench.simple_lem_batch_models(4, steps=20)
+    LandlabModelBatch(batched).run()
+    for single, model in zip(singles, batched):
+        np.testing.assert_allclose(model.grid.at_node["topographic__elevation"],
+                                   single.grid.at_node["topographic__elevation"], rtol=3e-8)
+
+def test_commands_start_quickly():
+    results = bench.run_benchmarks(quick=True, repeat=1, only=["startup"])
+    assert set(results["benchmarks"]) == {"startup.createdb.seconds", "startup.updatedb.seconds", "startup.tocsv.seconds"}
+    # about 0.1 s; test_cli_does_not_import_landlab guards what they import
+    assert all(result["value"] < 1 for result in results["benchmarks"].values())
+
+def test_cli_does_not_import_landlab():
+    # landlab (and matplotlib) take most of a command's startup; only running a model needs them
+    check = ("import sys, cli_functions, landlab_ensemble.construct_model; sys.path.insert(0, 'tools'); import model_processing; "
+             "print(sorted(m for m in ('landlab', 'matplotlib', 'xarray') if m in sys.modules))")
+    loaded = subprocess.run([sys.executable, "-c", check], cwd=bench.REPO, check=True, capture_output=True, text=True)
+    assert loaded.stdout.strip() == "[]"
+
+def test_compare_flags_regressions():
+    baseline = {"benchmarks": {"fast": bench.result(100.0, "rows/s"),
+                               "slow": bench.result(1.0, "s", higher_is_better=False),
+                               "gone": bench.result(1.0, "s")}}
+    results = {"benchmarks": {"fast": bench.result(70.0, "rows/s"),
+                              "slow": bench.result(1.1, "s", higher_is_better=False),
+                              "new": bench.result(1.0, "s")}}
+    assert bench.compare(results, baseline, tolerance=0.25) == ["fast"]
+    assert bench.compare(results, baseline, tolerance=0.05) == ["fast", "slow"]
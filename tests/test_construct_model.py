@@ -0,0 +1,637 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from landlab_ensemble.generate_ensembles import create_model_db
+from landlab_ensemble.db_writer import DatabaseWriter, connect_wal
+import landlab_ensemble.construct_model as cm
+from model_base import LandlabModel
+
+TEST_PARAM_FILE = os.path.abspath("tests/model_params_for_pytest.json")
+
+
+class FlatModel(LandlabModel):
+    """A model that does nothing to a flat topography."""
+    grid_fields_to_save = ["topographic__elevation"]
+
+    def __init__(self, params={}):
+        super().__init__(params)
+        self.grid.add_zeros("topographic__elevation", at="node")
+
+def make_test_db(tmp_path, name="test.db", **kwargs):
+    db_path = str(tmp_path / name)
+    create_model_db(db_path, TEST_PARAM_FILE, report=False, **kwargs)
+    return db_path
+
+def test_writer_batches_and_flushes(tmp_path):
+    db_path = str(tmp_path / "writer.db")
+    connection = connect_wal(db_path)
+    connection.execute("CREATE TABLE t (a INTEGER)")
+    connection.commit()
+    writer = DatabaseWriter(db_path, max_delay=60)
+    writer.executemany("INSERT INTO t (a) VALUES (?)", [(i,) for i in range(10)])
+    writer.execute("INSERT INTO t (a) VALUES (?)", (10,))
+    # nothing is committed until the delay passes or we flush
+    assert connection.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+    writer.flush()
+    assert connection.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 11
+    writer.execute("INSERT INTO t (a) VALUES (?)", (11,))
+    writer.close()
+    assert connection.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 12
+    connection.close()
+
+def test_writer_commits_after_max_delay(tmp_path):
+    db_path = str(tmp_path / "delay.db")
+    connection = connect_wal(db_path)
+    connection.execute("CREATE TABLE t (a INTEGER)")
+    connection.commit()
+    writer = DatabaseWriter(db_path, max_delay=0.05)
+    writer.execute("INSERT INTO t (a) VALUES (?)", (1,))
+    committed = threading.Event()
+    for _ in range(100):
+        if connection.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 1:
+            committed.set()
+            break
+        committed.wait(0.05)
+    assert committed.is_set()
+    writer.close()
+    connection.close()
+
+def test_writer_reraises_when_its_thread_dies(tmp_path, monkeypatch):
+    from landlab_ensemble import db_writer
+    def run_statement(connection, statement):
+        raise MemoryError("out of memory")
+    # not an sqlite error, so it is not retried statement by statement but stops the thread
+    monkeypatch.setattr(db_writer, "_run_statement", run_statement)
+    writer = DatabaseWriter(str(tmp_path / "dies.db"), max_delay=60)
+    writer.execute("CREATE TABLE t (a INTEGER)")
+    with pytest.raises(MemoryError):
+        writer.flush()
+    with pytest.raises(RuntimeError):
+        writer.execute("CREATE TABLE u (a INTEGER)")
+    with pytest.raises(MemoryError):
+        writer.close()
+
+def test_dispatcher_records_runs(tmp_path):
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, FlatModel, out_dir, limit=3)
+    dispatcher.run_all()
+    connection = sqlite3.connect(db_path)
+    finished = connection.execute("SELECT model_run_id FROM model_run_metadata WHERE model_end_time IS NOT NULL").fetchall()
+    assert len(finished) == 3
+    for (model_run_id,) in finished:
+        assert os.path.exists(os.path.join(out_dir, "%s.nc" % model_run_id))
+    assert dispatcher.get_unfinished_runs() is None
+    dispatcher.close()
+    connection.close()
+
+@pytest.mark.parametrize("processes", [None, 2])
+def test_async_writes_record_runs_once_written(tmp_path, processes):
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, FlatModel, out_dir, processes=processes, backend="process", async_writes=True)
+    dispatcher.run_all()
+    dispatcher.close()
+    connection = sqlite3.connect(db_path)
+    finished = connection.execute("SELECT model_run_id, output_bytes FROM model_run_metadata WHERE model_end_time IS NOT NULL").fetchall()
+    assert len(finished) == 8
+    for model_run_id, output_bytes in finished:
+        assert output_bytes == os.path.getsize(os.path.join(out_dir, "%s.nc" % model_run_id))
+    assert connection.execute("SELECT COUNT(*) FROM model_run_outputs").fetchone()[0] == 8
+    assert not [name for name in os.listdir(out_dir) if name.endswith(".tmp")]
+    connection.close()
+
+def test_async_writes_save_simple_lem_runs(tmp_path):
+    # SimpleLem saves all of its node fields by default, integer flow routing fields included
+    from diffusion_streampower_lem import SimpleLem
+    from landlab_ensemble.output_store import read_node_fields
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, SimpleLem, out_dir, async_writes=True)
+    dispatcher.run_all()
+    dispatcher.close()
+    connection = sqlite3.connect(db_path)
+    finished = [r[0] for r in connection.execute("SELECT model_run_id FROM model_run_metadata WHERE model_end_time IS NOT NULL")]
+    assert len(finished) == 8
+    assert connection.execute("SELECT COUNT(*) FROM model_run_outputs").fetchone()[0] == 8
+    connection.close()
+    fields = read_node_fields(os.path.join(out_dir, "%s.nc" % finished[0]))
+    assert {"topographic__elevation", "flow__receiver_node", "flow__data_structure_delta", "flow__sink_flag"} <= set(fields)
+    assert fields["flow__receiver_node"].dtype == np.int32
+
+def test_async_run_writer_blocks_when_full(tmp_path, monkeypatch):
+    from landlab_ensemble import output_store
+    release = threading.Event()
+    write = output_store.write_fields_netcdf
+
+    def slow_write(*args, **kwargs):
+        release.wait()
+        write(*args, **kwargs)
+    monkeypatch.setattr(output_store, "write_fields_netcdf", slow_write)
+    model = FlatModel(sloped_params(None))
+    model.run_id = "run"
+    model.batch_id = "batch"
+
+    def outputs():
+        return cm.save_model_run(model, 0.0, 1.0, "", 1, to_store=True)
+    writer = output_store.AsyncRunWriter(max_queued=1)
+    writer.put(str(tmp_path / "first.nc"), outputs())
+    writer.put(str(tmp_path / "missing" / "second.nc"), outputs())
+    third = threading.Thread(target=writer.put, args=(str(tmp_path / "third.nc"), outputs()))
+    third.start()
+    third.join(0.2)
+    # one run is being written and one is queued, so the third waits
+    assert third.is_alive() and writer.finished() == []
+    release.set()
+    third.join()
+    written = writer.flush()
+    writer.close()
+    assert ["write_error" in outputs for outputs in written] == [False, True, False]
+    assert written[2]["output_bytes"] == os.path.getsize(str(tmp_path / "third.nc"))
+    assert "node_fields" not in written[2]
+    assert sorted(os.listdir(tmp_path)) == ["first.nc", "third.nc"]
+
+def test_dispatcher_on_dask(tmp_path):
+    pytest.importorskip("dask.distributed")
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, FlatModel, out_dir, processes=2, tasks_per_worker=1)
+    dispatcher.run_all()
+    connection = sqlite3.connect(db_path)
+    assert connection.execute("SELECT COUNT(*) FROM model_run_metadata WHERE model_end_time IS NOT NULL").fetchone()[0] == 8
+    assert connection.execute("SELECT COUNT(*) FROM model_run_outputs").fetchone()[0] == 8
+    assert connection.execute("SELECT COUNT(*) FROM model_run_params WHERE model_run_id IS NULL").fetchone()[0] == 0
+    dispatcher.close()
+    connection.close()
+
+def test_dispatcher_on_process_pool(tmp_path):
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, FlatModel, out_dir, processes=2, backend="process", max_tasks_per_child=2)
+    dispatcher.run_all()
+    dispatcher.close()
+    connection = sqlite3.connect(db_path)
+    finished = connection.execute("SELECT model_run_id FROM model_run_metadata WHERE model_end_time IS NOT NULL").fetchall()
+    assert len(finished) == 8
+    assert connection.execute("SELECT COUNT(*) FROM model_run_outputs").fetchone()[0] == 8
+    for (model_run_id,) in finished:
+        assert os.path.exists(os.path.join(out_dir, "%s.nc" % model_run_id))
+    connection.close()
+
+def simple_lem_params(uplift_rate, D, streampower=None, stop_at_steady_state=False):
+    return {"grid": {"source": "create",
+                     "create_grid": {"RasterModelGrid": [[41, 5], {"xy_spacing": 5}]}},
+            "seed": 12,
+            "runtime": {"clock": {"start": 0.0, "stop": 12500, "step": 1250},
+                        "steady_state": {"steady_state": stop_at_steady_state, "steady_state_type": "mean",
+                                         "steady_state_threshold": 0.01, "steady_state_interval": 2500}},
+            "baselevel": {"uplift_rate": uplift_rate},
+            "diffuser": {"D": D},
+            "streampower": streampower or {"k": 0.001, "m": 0, "n": 2, "threshold": 2}}
+
+def test_simple_lem_batch_matches_single_runs():
+    from diffusion_streampower_lem import SimpleLem
+    from model_base import LandlabModelBatch
+    values = [(0.01, 0.01, None, False),
+              (0.1, 0.01, None, False),
+              (0.01, 0.1, {"k": 0.01, "m": 0.5, "n": 1, "threshold": 0}, False),
+              # steady at the first check, so it leaves the batch while the others go on
+              (0.00001, 0.01, {"k": 0.002, "m": 0.3, "n": 1.5, "threshold": 0.5}, True)]
+    singles = []
+    for value in values:
+        model = SimpleLem(simple_lem_params(*value))
+        model.run_id = "single"
+        model.run()
+        singles.append(model)
+    assert singles[-1].current_time < singles[0].current_time
+    batched = [SimpleLem(simple_lem_params(*value)) for value in values]
+    finish_times = {}
+    LandlabModelBatch(batched).run(on_finish=lambda model: finish_times.setdefault(id(model), model.current_time))
+    assert finish_times[id(batched[-1])] == singles[-1].current_time
+    for single, model in zip(singles, batched):
+        assert model.current_time == single.current_time
+        # FastscapeEroder solves in single precision when n is not 1
+        np.testing.assert_allclose(model.grid.at_node["topographic__elevation"],
+                                   single.grid.at_node["topographic__elevation"], rtol=1e-6)
+        for field in ("drainage_area", "flow__receiver_node"):
+            np.testing.assert_array_equal(model.grid.at_node[field], single.grid.at_node[field])
+
+def test_pooled_model_matches_new_model():
+    from diffusion_streampower_lem import SimpleLem
+    from landlab_ensemble.model_pool import ModelPool
+    pool = ModelPool()
+    first = pool.get(SimpleLem, simple_lem_params(0.01, 0.01))
+    first.run_id = "first"
+    first.run()
+    pool.put(first)
+    params = simple_lem_params(0.1, 0.05)
+    params["seed"] = 3
+    pooled = pool.get(SimpleLem, params)
+    assert pooled is first and pool.reused == 1
+    pooled.run()
+    params = simple_lem_params(0.1, 0.05)
+    params["seed"] = 3
+    fresh = SimpleLem(params)
+    fresh.run_id = "fresh"
+    fresh.run()
+    assert pooled.current_time == fresh.current_time
+    for name in fresh.grid.at_node:
+        np.testing.assert_array_equal(pooled.grid.at_node[name], fresh.grid.at_node[name])
+
+class BrokenResetModel(FlatModel):
+    resettable_params = ("seed",)
+
+    def reset(self, params):
+        raise RuntimeError("can not reset")
+
+def test_pool_builds_a_new_model_when_reset_fails():
+    from landlab_ensemble.model_pool import ModelPool
+    def params(seed):
+        return {"grid": {"source": "create", "create_grid": {"RasterModelGrid": [[5, 5]]}},
+                "runtime": {}, "seed": seed}
+    pool = ModelPool()
+    model = pool.get(BrokenResetModel, params(1))
+    pool.put(model)
+    assert pool.get(BrokenResetModel, params(2)) is not model
+    assert pool.built == 2 and pool.reused == 0
+    assert pool.get(FlatModel, params(1)).pool_entry is None
+
+def test_dispatcher_batches_runs(tmp_path):
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, FlatModel, out_dir, batch_size=3)
+    dispatcher.run_all()
+    connection = sqlite3.connect(db_path)
+    finished = connection.execute("SELECT model_run_id FROM model_run_metadata WHERE model_end_time IS NOT NULL").fetchall()
+    assert len(finished) == 8
+    assert connection.execute("SELECT COUNT(*) FROM model_run_outputs").fetchone()[0] == 8
+    for (model_run_id,) in finished:
+        assert os.path.exists(os.path.join(out_dir, "%s.nc" % model_run_id))
+    dispatcher.close()
+    connection.close()
+
+def test_dispatcher_batches_on_process_pool(tmp_path):
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, FlatModel, out_dir, processes=2, backend="process", batch_size=3)
+    dispatcher.run_all()
+    dispatcher.close()
+    connection = sqlite3.connect(db_path)
+    assert connection.execute("SELECT COUNT(*) FROM model_run_outputs").fetchone()[0] == 8
+    assert connection.execute("SELECT COUNT(*) FROM model_run_params WHERE model_run_id IS NULL").fetchone()[0] == 0
+    connection.close()
+
+def test_dispatcher_resumes_unfinished_runs(tmp_path):
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    # claim two runs as if a dispatcher was killed while running them
+    selector = cm.ModelSelector(db_path)
+    claimed = selector.claim(2, "killed")
+    selector.connection.close()
+    dispatcher = cm.ModelDispatcher(db_path, FlatModel, out_dir, limit=2)
+    dispatcher.resume_unfinished_runs()
+    dispatcher.run_all()
+    dispatcher.close()
+    connection = sqlite3.connect(db_path)
+    finished = {r[0] for r in connection.execute("SELECT model_run_id FROM model_run_metadata WHERE model_end_time IS NOT NULL")}
+    assert finished == {model_run_id for _, model_run_id, _ in claimed}
+    assert connection.execute("SELECT COUNT(*) FROM model_run_metadata").fetchone()[0] == 2
+    connection.close()
+
+def test_dispatcher_output_store(tmp_path):
+    from landlab_ensemble.output_store import OutputStore
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, FlatModel, out_dir, processes=2, backend="process", output_store=True)
+    store_path = dispatcher.output_store.path
+    dispatcher.run_all()
+    dispatcher.close()
+    assert [name for name in os.listdir(out_dir) if name.endswith(".nc")] == [os.path.basename(store_path)]
+    store = OutputStore(store_path, mode="r")
+    assert len(store) == 8
+    assert store.fields == ["topographic__elevation"]
+    assert store.topology()["shape"] == (41, 5)
+    connection = sqlite3.connect(db_path)
+    for run_param_id, model_run_id in connection.execute("SELECT run_param_id, model_run_id FROM model_run_params"):
+        fields = store.read(run_param_id=run_param_id)
+        assert fields["topographic__elevation"].shape == (205,)
+        assert store.read(model_run_id=model_run_id)["topographic__elevation"].shape == (205,)
+    with pytest.raises(KeyError):
+        store.read(run_param_id=1000)
+    store.close()
+    connection.close()
+
+def test_dispatcher_waits_for_new_rows(tmp_path, monkeypatch):
+    from landlab_ensemble.refinement import insert_rows
+    monkeypatch.setattr(cm, "ROW_POLL_INTERVAL", 0.02)
+    db_path = make_test_db(tmp_path)
+    finished_query = "SELECT COUNT(*) FROM model_run_metadata WHERE model_end_time IS NOT NULL"
+
+    def add_rows_once_finished():
+        # as refine_in_rounds does, once the dispatcher has finished every run
+        connection = sqlite3.connect(db_path)
+        while connection.execute(finished_query).fetchone()[0] < 8:
+            time.sleep(0.02)
+        insert_rows(connection, [1, 2], [], [(), ()])
+        connection.close()
+    adding = threading.Thread(target=add_rows_once_finished)
+    adding.start()
+    dispatcher = cm.ModelDispatcher(db_path, FlatModel, str(tmp_path) + os.sep, wait_for_rows=1.0)
+    dispatcher.run_all()
+    dispatcher.close()
+    adding.join()
+    connection = sqlite3.connect(db_path)
+    assert connection.execute(finished_query).fetchone()[0] == 10
+    connection.close()
+
+def test_store_runs_finish_once_synced(tmp_path, monkeypatch):
+    from diffusion_streampower_lem import SimpleLem
+    monkeypatch.setattr(cm, "STORE_SYNC_RUNS", 3)
+    monkeypatch.setattr(cm, "STORE_SYNC_DELAY", 3600)
+    db_path = make_test_db(tmp_path)
+    dispatcher = cm.ModelDispatcher(db_path, SimpleLem, str(tmp_path) + os.sep, output_store=True)
+    connection = sqlite3.connect(db_path)
+    finished_query = "SELECT COUNT(*) FROM model_run_metadata WHERE model_end_time IS NOT NULL"
+    synced = []
+    sync = dispatcher.output_store.sync
+    def checked_sync():
+        dispatcher.writer.flush()
+        synced.append((len(dispatcher.output_store), connection.execute(finished_query).fetchone()[0]))
+        sync()
+    dispatcher.output_store.sync = checked_sync
+    dispatcher.run_all()
+    dispatcher.close()
+    # no run is marked as finished before the sync that saves its fields
+    assert synced == [(3, 0), (6, 3), (8, 6)]
+    assert connection.execute(finished_query).fetchone()[0] == 8
+    assert connection.execute("SELECT COUNT(*) FROM model_run_outputs").fetchone()[0] == 8
+    connection.close()
+
+class SlopedModel(LandlabModel):
+    """A model with a sloping topography and a second node field, to check how fields are saved."""
+    def __init__(self, params={}):
+        super().__init__(params)
+        self.grid.add_field("topographic__elevation", self.grid.y_of_node * 0.123, at="node")
+        self.grid.add_ones("drainage_area", at="node")
+
+def sloped_params(fields, complevel=None):
+    return {"grid": {"source": "create", "create_grid": {"RasterModelGrid": [[101, 101], {"xy_spacing": 5}]}},
+            "runtime": {"clock": {"start": 0.0, "stop": 1.0, "step": 1.0}},
+            "output": {"fields": fields, "complevel": complevel}}
+
+def test_output_fields_are_encoded(tmp_path):
+    import netCDF4
+    from landlab_ensemble.output_store import read_node_fields
+    out_dir = str(tmp_path) + os.sep
+    full = cm.make_and_run_model(SlopedModel, "batch", "full", sloped_params(None), out_dir, 1)
+    compact = cm.make_and_run_model(SlopedModel, "batch", "compact", sloped_params(
+        {"topographic__elevation": {"dtype": "int16", "chunks": [10, 5]}}, complevel=6), out_dir, 2)
+    # netcdf4 files carry some kilobytes of headers, small grids are better kept in an output store
+    assert compact["output_bytes"] < full["output_bytes"] / 4
+    elevation = np.arange(101).repeat(101) * 5 * 0.123
+    with netCDF4.Dataset(out_dir + "compact.nc") as dataset:
+        assert list(dataset.variables) == ["x", "y", "topographic__elevation"]
+        variable = dataset["topographic__elevation"]
+        assert variable.dtype == np.int16
+        assert variable.filters()["zlib"] and variable.chunking() == [1, 10, 5]
+        assert dataset["x"].shape == (101, 101)
+        scale_factor = variable.scale_factor
+    assert set(read_node_fields(out_dir + "full.nc")) == {"topographic__elevation", "drainage_area"}
+    np.testing.assert_allclose(read_node_fields(out_dir + "compact.nc")["topographic__elevation"], elevation,
+                               atol=scale_factor)
+    cm.make_and_run_model(SlopedModel, "batch", "float32", sloped_params(
+        {"topographic__elevation": "float32", "drainage_area": {"dtype": "uint8", "scale_factor": 1}}), out_dir, 3)
+    fields = read_node_fields(out_dir + "float32.nc")
+    np.testing.assert_allclose(fields["topographic__elevation"], elevation, rtol=1e-6)
+    np.testing.assert_array_equal(fields["drainage_area"], 1)
+
+def test_output_field_encoding_errors(tmp_path):
+    from landlab_ensemble.output_store import OutputStore, field_encoding
+    assert field_encoding(None) == {}
+    assert field_encoding("float32") == {"dtype": "float32"}
+    with pytest.raises(ValueError, match="float16"):
+        field_encoding("float16")
+    with pytest.raises(ValueError, match="Unknown"):
+        field_encoding({"dtype": "float32", "precision": 3})
+    outputs = cm.make_and_run_model(SlopedModel, "batch", "stored", sloped_params({"drainage_area": "int16"}),
+                                    str(tmp_path) + os.sep, 1, to_store=True)
+    store = OutputStore(str(tmp_path / "store.nc"))
+    with pytest.raises(ValueError, match="scale_factor"):
+        store.append(outputs)
+    store.close()
+
+def test_store_sync_fsyncs_the_file(tmp_path, monkeypatch):
+    from landlab_ensemble import output_store
+    outputs = cm.make_and_run_model(SlopedModel, "batch", "stored", sloped_params(None), str(tmp_path) + os.sep, 1,
+                                    to_store=True)
+    store = output_store.OutputStore(str(tmp_path / "store.nc"))
+    store.append(outputs)
+    synced = []
+    monkeypatch.setattr(output_store, "fsync_file", synced.append)
+    store.sync()
+    assert synced == [store.path]
+    store.close()
+
+def test_profiled_runs_record_timings(tmp_path):
+    with open(TEST_PARAM_FILE) as param_file:
+        params = json.load(param_file)
+    params["runtime"]["profile"] = True
+    param_path = str(tmp_path / "profile.json")
+    with open(param_path, 'w') as param_file:
+        json.dump(params, param_file)
+    db_path = str(tmp_path / "profile.db")
+    create_model_db(db_path, param_path, report=False)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, FlatModel, out_dir, limit=2)
+    dispatcher.run_all()
+    dispatcher.close()
+    connection = sqlite3.connect(db_path)
+    timers = connection.execute("SELECT timer, COUNT(*), MIN(calls) FROM model_run_timing GROUP BY timer").fetchall()
+    assert {timer: (runs, calls) for timer, runs, calls in timers} == {
+        "run": (2, 1), "save": (2, 1), "setup": (2, 1), "steady_state_check": (2, 1000), "update_until": (2, 1000)}
+    connection.close()
+    outputs = cm.make_and_run_model(FlatModel, "batch", "run", params, out_dir, 1)
+    names = [row[0] for row in outputs["timings"]]
+    assert names == ["run", "save", "setup", "steady_state_check", "update_until"]
+
+def test_runs_record_resources(tmp_path):
+    from landlab_ensemble.resources import cost_by_parameters
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, FlatModel, out_dir, processes=2, backend="process")
+    dispatcher.run_all()
+    dispatcher.close()
+    connection = sqlite3.connect(db_path)
+    rows = connection.execute("SELECT model_run_id, peak_rss_kb, user_cpu_time, system_cpu_time, output_bytes, host, pid FROM model_run_metadata").fetchall()
+    assert len(rows) == 8
+    for model_run_id, peak_rss_kb, user_cpu_time, system_cpu_time, output_bytes, host, pid in rows:
+        assert peak_rss_kb > 0 and user_cpu_time > 0 and system_cpu_time >= 0
+        assert output_bytes == os.path.getsize(os.path.join(out_dir, "%s.nc" % model_run_id))
+        assert host and pid != os.getpid()
+    connection.close()
+    columns, rows = cost_by_parameters(db_path)
+    assert columns[:3] == ["model_param.baselevel.uplift_rate", "model_param.diffuser.D", "model_param.streampower.k"]
+    assert len(rows) == 8 and all(row[3] == 1 for row in rows)
+    columns, rows = cost_by_parameters(db_path, ["model_param.diffuser.D"])
+    assert [row[1] for row in rows] == [4, 4]
+
+def test_update_db_from_file_records_runs(tmp_path):
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    output_path = str(tmp_path / "outputs.jsonl")
+    with open(output_path, "w") as output_file:
+        for run_param_id in (1, 2):
+            _, param_dict = cm.ModelSelector(db_path, "run_param_id = %d" % run_param_id).next()
+            param_dict["runtime"]["profile"] = True
+            outputs = cm.make_and_run_model(FlatModel, "batch", "run_%d" % run_param_id, param_dict, out_dir, run_param_id)
+            output_file.write(json.dumps(outputs) + "\n")
+    cm.update_db_from_file(output_path, db_path)
+    connection = sqlite3.connect(db_path)
+    finished = connection.execute("SELECT model_run_id FROM model_run_metadata WHERE model_end_time IS NOT NULL "
+                                  "AND peak_rss_kb IS NOT NULL ORDER BY model_run_id").fetchall()
+    assert finished == [("run_1",), ("run_2",)]
+    assert connection.execute("SELECT COUNT(*) FROM model_run_outputs").fetchone()[0] == 2
+    assert connection.execute("SELECT COUNT(DISTINCT model_run_id) FROM model_run_timing").fetchone()[0] == 2
+    connection.close()
+
+def test_cost_report_leaves_the_schema_alone(tmp_path):
+    from landlab_ensemble.resources import cost_by_parameters
+    db_path = make_test_db(tmp_path)
+    connection = sqlite3.connect(db_path)
+    schema = connection.execute("PRAGMA table_info(model_run_metadata)").fetchall()
+    # a database that was never dispatched from has no resource columns, so no costs yet
+    columns, rows = cost_by_parameters(db_path)
+    assert columns[-1] == "max_peak_rss_kb" and rows == []
+    assert connection.execute("PRAGMA table_info(model_run_metadata)").fetchall() == schema
+    connection.close()
+
+class SlowModel(FlatModel):
+    """A flat model whose runs take a fixed amount of wall time."""
+    def run(self, run_duration=None, dt=None):
+        time.sleep(0.2)
+        super().run(run_duration, dt)
+
+def test_pilot_stops_before_walltime(tmp_path):
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    # the first run always starts; after it another 0.2s run no longer fits into the 0.3s budget
+    dispatcher = cm.ModelDispatcher(db_path, SlowModel, out_dir, walltime=0.3, walltime_margin=0.0)
+    dispatcher.run_all()
+    dispatcher.close()
+    connection = sqlite3.connect(db_path)
+    assert connection.execute("SELECT COUNT(*) FROM model_run_metadata WHERE model_end_time IS NOT NULL").fetchone()[0] == 1
+    assert connection.execute("SELECT COUNT(*) FROM model_run_params WHERE model_run_id IS NULL").fetchone()[0] > 0
+    connection.close()
+
+def test_parse_slurm_time():
+    assert cm.parse_slurm_time("30") == 30 * 60
+    assert cm.parse_slurm_time("30:15") == 30 * 60 + 15
+    assert cm.parse_slurm_time("04:00:00") == 4 * 3600
+    assert cm.parse_slurm_time("1-12") == 36 * 3600
+    assert cm.parse_slurm_time("2-01:30:05") == 49 * 3600 + 30 * 60 + 5
+
+def test_pilot_sbatch_file(tmp_path):
+    sbatch_path = str(tmp_path / "pilots.sh")
+    cm.generate_pilot_sbatch_file("Landlab Pilots", 4, "04:00:00", "my runs.db", "diffusion_streampower_lem.SimpleLem",
+                                  "out/", filter="\"model_param.diffuser.D\" > 0.01", cpus=2, slurm_path=sbatch_path)
+    with open(sbatch_path) as sbatch_file:
+        script = sbatch_file.read()
+    assert "#SBATCH --array=1-4\n" in script
+    assert "#SBATCH --time=04:00:00\n" in script
+    assert "#SBATCH --cpus-per-task=2\n" in script
+    assert "model_control.py pilot -d 'my runs.db'" in script
+    assert "--walltime 04:00:00" in script
+    assert "-f '\"model_param.diffuser.D\" > 0.01'" in script
+    assert "-p 2" in script
+
+def reference_row_to_params(row, columns, types, constants=None):
+    # the decoding row_to_params did before RowDecoder
+    parameters = dict(constants) if constants else {}
+    parameters.update({k.split('.', 1)[1]: cm._ensure_type(v, types[k]) for k, v in zip(columns, row) if k.split('.')[0] == "model_param"})
+    return cm.expand_dict(parameters)
+
+@pytest.mark.parametrize("normalized", [False, True])
+def test_row_decoder_matches_reference(tmp_path, normalized):
+    db_path = make_test_db(tmp_path, normalized=normalized)
+    connection = sqlite3.connect(db_path)
+    cursor = connection.execute("SELECT * FROM model_run_params")
+    columns = [c[0] for c in cursor.description]
+    rows = cursor.fetchall()
+    types = cm.get_param_types(connection)
+    constants = cm.get_constant_params(connection, types)
+    decoder = cm.RowDecoder.from_connection(connection, columns)
+    connection.close()
+    for row in rows:
+        expected = reference_row_to_params(row, columns, types, constants)
+        assert decoder.decode(row) == expected
+        assert json.dumps(decoder.decode(row)) == json.dumps(expected)  # same key order too
+    # every row gets its own dictionaries
+    first, second = decoder.decode(rows[0]), decoder.decode(rows[0])
+    first["grid"]["source"] = "changed"
+    assert second["grid"]["source"] != "changed"
+
+class CountingModel(FlatModel):
+    """A model whose topography rises by one every step, so its final state shows where it started."""
+    def update(self, dt):
+        self.grid.at_node["topographic__elevation"] += 1
+        super().update(dt)
+
+def warm_start_donors(db_path):
+    connection = sqlite3.connect(db_path)
+    rows = connection.execute("SELECT model_run_id, warm_start_donor FROM model_run_metadata "
+                              "WHERE model_end_time IS NOT NULL ORDER BY run_id").fetchall()
+    connection.close()
+    return rows
+
+def test_dispatcher_warm_starts(tmp_path):
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, CountingModel, out_dir, limit=3, warm_start=True)
+    dispatcher.run_all()
+    dispatcher.close()
+    rows = warm_start_donors(db_path)
+    assert len(rows) == 3
+    assert rows[0][1] is None
+    elevations = {model_run_id: cm.read_node_fields(os.path.join(out_dir, "%s.nc" % model_run_id))["topographic__elevation"]
+                  for model_run_id, _ in rows}
+    steps = elevations[rows[0][0]]
+    assert np.all(steps > 0)
+    for position, (model_run_id, donor) in enumerate(rows[1:], 1):
+        assert donor in [run for run, _ in rows[:position]]
+        assert np.allclose(elevations[model_run_id], elevations[donor] + steps)
+
+def test_warm_starter_grows_its_points(tmp_path, monkeypatch):
+    from landlab_ensemble import warm_start
+    monkeypatch.setattr(warm_start, "INITIAL_POINTS", 1)
+    db_path = make_test_db(tmp_path)
+    connection = sqlite3.connect(db_path)
+    starter = warm_start.WarmStarter(connection, str(tmp_path) + os.sep)
+    runs = [cm.ModelSelector(db_path, "run_param_id = %d" % run_param_id).next() for run_param_id in range(1, 9)]
+    for run_param_id, param_dict in runs:
+        starter.warm_start("run_%d" % run_param_id, param_dict)
+        starter.finished("run_%d" % run_param_id)
+    assert len(starter.points) == 8 and len(starter.run_ids) == 8
+    for run_param_id, param_dict in runs:
+        assert starter.donor(param_dict) == "run_%d" % run_param_id
+    connection.close()
+
+def test_dispatcher_warm_starts_on_process_pool(tmp_path):
+    db_path = make_test_db(tmp_path)
+    out_dir = str(tmp_path) + os.sep
+    dispatcher = cm.ModelDispatcher(db_path, CountingModel, out_dir, limit=6, processes=2, tasks_per_worker=2,
+                                    backend="process", warm_start=True)
+    dispatcher.run_all()
+    dispatcher.close()
+    rows = warm_start_donors(db_path)
+    assert len(rows) == 6
+    # the first four runs are queued before any has finished, the other two start from them
+    assert sum(donor is not None for _, donor in rows) == 2
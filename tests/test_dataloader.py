@@ -0,0 +1,100 @@
+import os
+import pickle
+import sqlite3
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'tools')))
+
+import dataloader
+import model_processing
+
+
+def write_runs(directory, names, shape=(5, 4)):
+    """Saves a small grid per run, as the dispatcher does, returning each run's elevation."""
+    from landlab import RasterModelGrid
+    rng = np.random.default_rng(3)
+    elevations = {}
+    for name in names:
+        grid = RasterModelGrid(shape)
+        elevations[name] = rng.random(shape)
+        grid.add_field("topographic__elevation", elevations[name].ravel(), at="node")
+        grid.save(os.path.join(directory, "%s.nc" % name))
+    return elevations
+
+def make_label_db(path, finished, labels):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE model_run_metadata (model_run_id TEXT, model_end_time REAL)")
+    connection.execute("CREATE TABLE model_run_outputs (model_run_id TEXT, \"output.topography.max\" REAL, \"output.topography.min\" REAL)")
+    connection.executemany("INSERT INTO model_run_metadata VALUES (?, ?)", [(run, 1.0 if run in finished else None) for run in labels])
+    connection.executemany("INSERT INTO model_run_outputs VALUES (?, ?, ?)", [(run,) + label for run, label in labels.items()])
+    connection.commit()
+    connection.close()
+
+class PackArgs:
+    def __init__(self, id, o):
+        self.id = id
+        self.o = o
+
+def pack(tmp_path, names):
+    runs_dir = tmp_path / "runs"
+    runs_dir.mkdir()
+    elevations = write_runs(str(runs_dir), names)
+    packed_path = str(tmp_path / "packed.npy")
+    model_processing.generate_packed(PackArgs(str(runs_dir), packed_path), lambda name: name.endswith(".nc"))
+    return packed_path, elevations
+
+def test_makepacked_round_trip(tmp_path):
+    names = ["run_b", "run_a", "run_c"]
+    packed_path, elevations = pack(tmp_path, names)
+    packed = np.load(packed_path, mmap_mode="r")
+    index = dataloader.read_packed_index(packed_path)
+    assert index == sorted(names)
+    assert packed.shape == (3, 5, 4)
+    for row, name in enumerate(index):
+        np.testing.assert_array_equal(packed[row], elevations[name])
+
+def test_get_labels(tmp_path):
+    db_path = str(tmp_path / "labels.db")
+    make_label_db(db_path, {"a", "b"}, {"a": (2.0, 0.5), "b": (3.0, 1.0), "c": (4.0, 1.5)})
+    labels = dataloader.get_labels(db_path, "SELECT model_run_id, \"output.topography.max\" FROM model_run_outputs")
+    assert labels == {"a": 2.0, "b": 3.0, "c": 4.0}
+    labels = dataloader.get_labels(db_path, "SELECT model_run_id, \"output.topography.max\", \"output.topography.min\" FROM model_run_outputs")
+    assert labels["b"] == (3.0, 1.0)
+
+def make_dataset(tmp_path, cache_size=0):
+    pytest.importorskip("torch")
+    names = ["run_a", "run_b", "run_c", "run_d"]
+    packed_path, elevations = pack(tmp_path, names)
+    db_path = str(tmp_path / "labels.db")
+    # run_d is not finished
+    make_label_db(db_path, {"run_a", "run_b", "run_c"}, {name: (float(i), 0.0) for i, name in enumerate(names)})
+    dataset = dataloader.LandlabBatchdataset(db_path, packed_path, "SELECT model_run_id, \"output.topography.max\" FROM model_run_outputs",
+                                             cache_size=cache_size)
+    return dataset, elevations
+
+def test_dataset_reads_packed_runs(tmp_path):
+    dataset, elevations = make_dataset(tmp_path)
+    assert len(dataset) == 3
+    for idx, run in enumerate(dataset.runs):
+        sample, label = dataset[idx]
+        np.testing.assert_array_equal(sample, elevations[run])
+        assert label == float(["run_a", "run_b", "run_c"].index(run))
+
+def test_dataset_cache_is_bounded(tmp_path):
+    dataset, _ = make_dataset(tmp_path, cache_size=2)
+    for idx in (0, 1, 2, 0):
+        dataset[idx]
+    assert list(dataset._cache) == [2, 0]
+    assert dataset[2] is dataset._cache[2]
+
+def test_dataset_pickles_without_memory_map(tmp_path):
+    dataset, elevations = make_dataset(tmp_path, cache_size=2)
+    dataset[0]
+    assert dataset._data is not None
+    copy = pickle.loads(pickle.dumps(dataset))
+    assert copy._data is None
+    assert len(copy._cache) == 0
+    np.testing.assert_array_equal(copy[1][0], elevations[copy.runs[1]])
@@ -84,6 +84,75 @@ def test_generate_random_parameter_array():
     assert np.array_equal(generate_random_parameter_array("RANDOM poisson {\"size\": [10]}", rng1),
                             rng2.poisson(size=(10)))
 
+def test_model_params_combination_order():
+    arrays = [np.arange(2), np.arange(3), np.arange(4)]
+    params = {"a": "ITERATIVE arange {\"start\": 0, \"stop\": 2, \"step\": 1}",
+              "nested": {"b": "ITERATIVE arange {\"start\": 0, \"stop\": 3, \"step\": 1}",
+                         "c": "ITERATIVE arange {\"start\": 0, \"stop\": 4, \"step\": 1}",
+                         "constant": [1, 2]}}
+    model_params = ge.ModelParams(params)
+    meshgrid_values = np.array(np.meshgrid(*arrays)).T.reshape(-1, len(arrays))
+    assert len(model_params) == len(meshgrid_values)
+    for combination, values in zip(model_params, meshgrid_values):
+        assert [combination["a"], combination["nested"]["b"], combination["nested"]["c"]] == list(values)
+        assert combination["nested"]["constant"] == [1, 2]
+    assert params["nested"]["b"].startswith("ITERATIVE")
+
+def test_model_params_random_access():
+    with open(TEST_PARAM_FILE, 'r') as param_f:
+        params = json.load(param_f)
+    model_params = ge.ModelParams(params)
+    in_order = list(ge.ModelParams(params))
+    assert len(model_params) == 8
+    assert model_params[5] == in_order[5]
+    assert model_params[-1] == in_order[-1]
+    assert model_params[2:6:2] == in_order[2:6:2]
+    with pytest.raises(IndexError):
+        model_params[8]
+
+SAMPLE_PARAMS = {"a": "ITERATIVE arange {\"start\": 0, \"stop\": 2, \"step\": 1}",
+                 "nested": {"b": "SAMPLE lhs {\"n\": 16, \"seed\": 3, \"range\": [0.001, 10], \"scale\": \"log\"}",
+                            "c": "SAMPLE lhs {\"range\": [-1, 1]}",
+                            "d": "SAMPLE sobol {\"design\": \"other\", \"n\": 4, \"range\": [0, 1]}"},
+                 "output_fields": ["output.model.endtime"]}
+
+def test_model_params_sample_designs():
+    model_params = ge.ModelParams(SAMPLE_PARAMS)
+    # each design is one axis: 2 iterative values x 16 points x 4 points
+    assert len(model_params) == 2 * 16 * 4
+    combinations = list(model_params)
+    points = {(c["nested"]["b"], c["nested"]["c"]) for c in combinations}
+    assert len(points) == 16
+    b, c = np.array(sorted(points)).T
+    assert b.min() >= 0.001 and b.max() < 10
+    assert c.min() >= -1 and c.max() < 1
+    # a latin hypercube has one point in each of n equal strata of every (scaled) parameter
+    assert sorted(np.floor((np.log10(b) + 3) / 4 * 16).astype(int)) == list(range(16))
+    assert sorted(np.floor((c + 1) / 2 * 16).astype(int)) == list(range(16))
+    assert len({c["nested"]["d"] for c in combinations}) == 4
+    # the same file gives the same design
+    assert list(ge.ModelParams(SAMPLE_PARAMS)) == combinations
+
+def test_model_params_sample_design_errors():
+    params = {"b": "SAMPLE lhs {\"n\": 16, \"range\": [0, 1]}", "c": "SAMPLE lhs {\"n\": 8, \"range\": [0, 1]}"}
+    with pytest.raises(ValueError):
+        ge.ModelParams(params)
+    with pytest.raises(ValueError):
+        ge.ModelParams({"b": "SAMPLE lhs {\"range\": [0, 1]}"})
+    with pytest.raises(ValueError):
+        ge.ModelParams({"b": "SAMPLE lhs {\"n\": 4, \"range\": [0, 1], \"scale\": \"log\"}"})
+
+def test_sample_db_creation(tmp_path):
+    param_path = str(tmp_path / "sample_params.json")
+    with open(param_path, 'w') as param_f:
+        json.dump(SAMPLE_PARAMS, param_f)
+    db_path = str(tmp_path / "sample.db")
+    assert create_model_db(db_path, param_path, report=False, normalized=True) == 2 * 16 * 4
+    connection = sqlite3.connect(db_path)
+    rows = connection.execute("SELECT \"model_param.nested.b\", \"model_param.nested.c\" FROM model_run_params").fetchall()
+    connection.close()
+    assert len(set(rows)) == 16
+
 def get_tables(cursor):
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
     return [table[0] for table in cursor.fetchall()]
@@ -106,6 +175,116 @@ def test_db_creation():
     # delete TEST_DB_FILE
     os.remove(TEST_DB_FILE)
 
+def test_bulk_db_creation_matches_reference(tmp_path):
+    db_path = tmp_path / "bulk.db"
+    assert create_model_db(db_path, TEST_PARAM_FILE, chunk_size=3, report=False) == 8
+    test_connection = sqlite3.connect(db_path)
+    true_connection = sqlite3.connect("tests/true_test_unran.db")
+    test_cursor = test_connection.cursor()
+    true_cursor = true_connection.cursor()
+    for table in get_tables(true_cursor):
+        true_schema = true_cursor.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()
+        test_schema = test_cursor.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()
+        assert true_schema == test_schema
+        assert true_cursor.execute(f"SELECT * FROM {table}").fetchall() == test_cursor.execute(f"SELECT * FROM {table}").fetchall()
+    test_connection.close()
+    true_connection.close()
+
+def test_db_creation_with_quotes(tmp_path):
+    with open(TEST_PARAM_FILE, 'r') as param_f:
+        params = json.load(param_f)
+    params["grid"]["source"] = "it's \"quoted\""
+    param_path = tmp_path / "quoted.json"
+    with open(param_path, 'w') as param_f:
+        json.dump(params, param_f)
+    create_model_db(tmp_path / "quoted.db", param_path, report=False)
+    connection = sqlite3.connect(tmp_path / "quoted.db")
+    sources = connection.execute("SELECT DISTINCT \"model_param.grid.source\" FROM model_run_params").fetchall()
+    assert sources == [("it's \"quoted\"",)]
+    connection.close()
+
+def test_normalized_db_creation(tmp_path):
+    flat_db = tmp_path / "flat.db"
+    normalized_db = tmp_path / "normalized.db"
+    create_model_db(flat_db, TEST_PARAM_FILE, report=False)
+    create_model_db(normalized_db, TEST_PARAM_FILE, report=False, normalized=True)
+    connection = sqlite3.connect(normalized_db)
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM model_run_params")
+    param_columns = [c[0] for c in cursor.description]
+    assert param_columns == ["run_param_id",
+                             "model_param.baselevel.uplift_rate",
+                             "model_param.diffuser.D",
+                             "model_param.streampower.k",
+                             "model_run_id",
+                             "model_batch_id"]
+    assert len(cursor.fetchall()) == 8
+    assert len(cursor.execute("SELECT * FROM model_param_template").fetchall()) == 1
+    connection.close()
+    for selector_filter in ["run_param_id = 1", "run_param_id = 8"]:
+        flat_params = cm.ModelSelector(str(flat_db), selector_filter).next()
+        normalized_params = cm.ModelSelector(str(normalized_db), selector_filter).next()
+        assert flat_params == normalized_params
+
+def test_claim_is_exclusive(tmp_path):
+    db_path = str(tmp_path / "claim.db")
+    create_model_db(db_path, TEST_PARAM_FILE, report=False)
+    first_selector = cm.ModelSelector(db_path)
+    second_selector = cm.ModelSelector(db_path)
+    first_claims = first_selector.claim(3, "batch_1")
+    second_claims = second_selector.claim(10, "batch_2")
+    assert [claim[0] for claim in first_claims] == [1, 2, 3]
+    assert [claim[0] for claim in second_claims] == [4, 5, 6, 7, 8]
+    assert first_selector.claim(1, "batch_1") == []
+    assert first_claims[0][2]["diffuser"]["D"] == 0.01
+    connection = sqlite3.connect(db_path)
+    claimed = connection.execute("SELECT run_param_id, model_run_id, model_batch_id FROM model_run_params").fetchall()
+    assert {row[1] for row in claimed} == {claim[1] for claim in first_claims + second_claims}
+    assert [row[2] for row in claimed] == ["batch_1"]*3 + ["batch_2"]*5
+    started = connection.execute("SELECT COUNT(*) FROM model_run_metadata WHERE model_start_time IS NOT NULL").fetchone()[0]
+    assert started == 8
+    plan = connection.execute("EXPLAIN QUERY PLAN " + first_selector.claim_statement, (1,)).fetchall()
+    assert "model_run_params_unrun" in str(plan)
+    connection.close()
+
+def test_claim_rolls_back_rows_that_fail_to_decode(tmp_path):
+    db_path = str(tmp_path / "claim.db")
+    create_model_db(db_path, TEST_PARAM_FILE, report=False)
+    selector = cm.ModelSelector(db_path)
+    def broken_decode(values):
+        raise ValueError("undecodable row")
+    selector.decoder.decode = broken_decode
+    with pytest.raises(ValueError):
+        selector.claim(3)
+    connection = sqlite3.connect(db_path)
+    assert connection.execute("SELECT COUNT(*) FROM model_run_params WHERE model_run_id IS NOT NULL").fetchone()[0] == 0
+    assert connection.execute("SELECT COUNT(*) FROM model_run_metadata").fetchone()[0] == 0
+    connection.close()
+
+def test_selector_leaves_the_schema_alone(tmp_path):
+    db_path = str(tmp_path / "old.db")
+    create_model_db(db_path, TEST_PARAM_FILE, report=False)
+    connection = sqlite3.connect(db_path)
+    connection.execute("DROP INDEX model_run_params_unrun")
+    connection.commit()
+    selector = cm.ModelSelector(db_path)
+    claimed = selector.claim(1)
+    index_query = "SELECT COUNT(*) FROM sqlite_master WHERE name = 'model_run_params_unrun'"
+    assert connection.execute(index_query).fetchone()[0] == 0
+    batch_ids = connection.execute("SELECT model_batch_id FROM model_run_params WHERE model_run_id = ?", (claimed[0][1],)).fetchall()
+    assert batch_ids == [(None,)]
+    # a dispatcher brings the database up to date
+    cm.ModelDispatcher(db_path, None, str(tmp_path) + os.sep).close()
+    assert connection.execute(index_query).fetchone()[0] == 1
+    connection.close()
+
+def test_claim_respects_limit(tmp_path):
+    db_path = str(tmp_path / "limit.db")
+    create_model_db(db_path, TEST_PARAM_FILE, report=False)
+    selector = cm.ModelSelector(db_path, limit=2)
+    assert len(selector.claim(5)) == 2
+    assert selector.claim(5) == []
+
 def test_model_running():
     model = getattr(importlib.import_module(TEST_MODEL_MODULE), 
                     TEST_MODEL)
@@ -0,0 +1,160 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from model_base import LandlabModel, LandlabModelBatch
+from model_base.model_base import RunTimer, SteadyStateMonitor, STEADY_STATE_FUNCTIONS
+
+
+def relaxing_params(stop_at_steady_state, window=1):
+    return {"grid": {"source": "create",
+                     "create_grid": {"RasterModelGrid": [[5, 5], {"xy_spacing": 1}]}},
+            "runtime": {"clock": {"start": 0.0, "stop": 1000.0, "step": 1.0},
+                        "steady_state": {"steady_state": stop_at_steady_state,
+                                         "steady_state_type": "max_local",
+                                         "steady_state_threshold": 0.01,
+                                         "steady_state_interval": 10,
+                                         "steady_state_window": window}}}
+
+class RelaxingModel(LandlabModel):
+    """Topography that relaxes exponentially towards one."""
+    def __init__(self, params={}):
+        super().__init__(params)
+        self.topo = self.grid.add_zeros("topographic__elevation", at="node")
+
+    def update(self, dt):
+        self.topo += 0.1 * dt * (1.0 - self.topo)
+        self.current_time += dt
+
+    def rebind_fields(self):
+        self.topo = self.grid.at_node["topographic__elevation"]
+
+class BatchedRelaxingModel(RelaxingModel):
+    """RelaxingModel with the relaxation done for the whole batch at once."""
+    @classmethod
+    def batch_update(cls, batch, dt):
+        batch.state += 0.1 * dt * (1.0 - batch.state)
+        for model in batch.active:
+            model.current_time += dt
+
+def test_steady_state_functions_match_definitions():
+    rng = np.random.default_rng(0)
+    old_values = rng.random(100)
+    new_values = rng.random(100)
+    scratch = np.empty(100)
+    assert STEADY_STATE_FUNCTIONS["max"](old_values, new_values) == abs(old_values.max() - new_values.max())
+    assert STEADY_STATE_FUNCTIONS["mean"](old_values, new_values) == abs(old_values.mean() - new_values.mean())
+    assert STEADY_STATE_FUNCTIONS["max_local"](old_values, new_values, out=scratch) == np.abs(old_values - new_values).max()
+
+def test_monitor_keeps_a_copy():
+    values = np.zeros(10)
+    monitor = SteadyStateMonitor(values, "max_local", 0.5)
+    snapshot = monitor.snapshot
+    values += 1.0
+    assert not monitor.check(values)
+    assert monitor.amount == 1.0
+    assert monitor.snapshot is snapshot
+    assert monitor.check(values)
+
+def test_monitor_window_resets_on_change():
+    values = np.zeros(3)
+    monitor = SteadyStateMonitor(values, "max", 0.5, window=2)
+    assert not monitor.check(values)
+    values += 1.0
+    assert not monitor.check(values)
+    assert monitor.consecutive == 0
+    assert not monitor.check(values)
+    assert monitor.check(values)
+
+def test_run_stops_at_steady_state():
+    model = RelaxingModel(relaxing_params(True))
+    model.run()
+    assert model.steady_state
+    assert model.current_time < 1000.0
+    assert model.steady_state_ammount < 0.01
+    windowed_model = RelaxingModel(relaxing_params(True, window=3))
+    windowed_model.run()
+    assert windowed_model.current_time == model.current_time + 20
+
+def test_run_continues_without_stopping():
+    model = RelaxingModel(relaxing_params(False))
+    model.run()
+    assert model.current_time == 1000.0
+    assert model.get_output()['output.model.steadystate']
+
+def test_batch_matches_single_runs():
+    for model_class in (RelaxingModel, BatchedRelaxingModel):
+        single = RelaxingModel(relaxing_params(True, window=3))
+        single.run()
+        models = [model_class(relaxing_params(stop, window=window)) for stop, window in
+                  [(True, 1), (True, 3), (False, 1)]]
+        finished = []
+        LandlabModelBatch(models).run(on_finish=finished.append)
+        assert finished == models
+        assert models[1].current_time == single.current_time
+        assert models[0].current_time == single.current_time - 20
+        assert models[2].current_time == 1000.0
+        assert all(model.steady_state for model in models)
+        np.testing.assert_allclose(models[1].topo, single.topo)
+        # finished runs no longer share memory with the batch
+        assert not np.shares_memory(models[0].topo, models[1].topo)
+
+def test_batch_rejects_mismatched_models():
+    params = relaxing_params(True)
+    params["runtime"]["clock"]["step"] = 2.0
+    with pytest.raises(ValueError):
+        LandlabModelBatch([RelaxingModel(relaxing_params(True)), RelaxingModel(params)])
+
+class InterruptedModel(RelaxingModel):
+    """RelaxingModel that dies part way through the run."""
+    def update(self, dt):
+        if self.current_time >= 550:
+            raise RuntimeError("killed")
+        super().update(dt)
+
+def test_timer_is_bounded_and_close_to_exact():
+    durations = np.random.default_rng(0).lognormal(-8, 1.5, 100000)
+    timer = RunTimer()
+    for duration in durations:
+        timer.add("step", duration)
+    (name, calls, total, mean, p50, p95, longest), = timer.summary()
+    assert calls == len(durations)
+    assert total == pytest.approx(durations.sum())
+    assert longest == durations.max()
+    exact_p50, exact_p95 = np.percentile(durations, [50, 95])
+    assert p50 == pytest.approx(exact_p50, rel=0.05)
+    assert p95 == pytest.approx(exact_p95, rel=0.05)
+    # a bucket for every 2**(1/8) spanned, not a duration for every call
+    assert len(timer.stats["step"].buckets) < 200
+
+def test_run_resumes_from_checkpoint(tmp_path):
+    params = relaxing_params(False)
+    params["runtime"]["checkpoint"] = {"interval": 100}
+    uninterrupted = RelaxingModel(relaxing_params(False))
+    uninterrupted.run()
+    checkpoint_path = str(tmp_path / "run.checkpoint")
+    interrupted = InterruptedModel(params)
+    interrupted.checkpoint_path = checkpoint_path
+    with pytest.raises(RuntimeError):
+        interrupted.run()
+    assert os.path.exists(checkpoint_path)
+    assert not os.path.exists(checkpoint_path + ".tmp")
+    resumed = RelaxingModel(params)
+    resumed.checkpoint_path = checkpoint_path
+    assert resumed.load_checkpoint()
+    assert resumed.current_time == 500
+    resumed = RelaxingModel(params)
+    resumed.checkpoint_path = checkpoint_path
+    resumed.run()
+    assert resumed.current_time == 1000.0
+    np.testing.assert_allclose(resumed.topo, uninterrupted.topo)
+    assert resumed.steady_state_monitor.consecutive == uninterrupted.steady_state_monitor.consecutive
+    # checkpoints written for other parameters are ignored
+    other = RelaxingModel(params)
+    other.checkpoint_path = checkpoint_path
+    other.checkpoint_key = "other"
+    assert not other.load_checkpoint()
@@ -0,0 +1,124 @@
+import csv
+import json
+import os
+import sqlite3
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'tools')))
+
+import model_processing
+
+RUNS = ["run_a", "run_b", "run_c", "run_d"]
+
+
+def write_runs(directory, shape=(5, 4)):
+    """Saves a small grid per run, as the dispatcher does, returning each run's elevation."""
+    from landlab import RasterModelGrid
+    rng = np.random.default_rng(5)
+    elevations = {}
+    for name in RUNS:
+        grid = RasterModelGrid(shape)
+        elevations[name] = rng.random(shape)
+        grid.add_field("topographic__elevation", elevations[name].ravel(), at="node")
+        grid.add_ones("drainage_area", at="node")
+        grid.save(os.path.join(directory, "%s.nc" % name))
+    return elevations
+
+def is_run(name):
+    return name.endswith(".nc")
+
+def make_dirs(tmp_path, *names):
+    paths = []
+    for name in names:
+        (tmp_path / name).mkdir()
+        paths.append(str(tmp_path / name))
+    return paths
+
+def process(runs_dir, out_dir, processes=1):
+    manifest_path = os.path.join(out_dir, model_processing.MANIFEST_NAME)
+    return model_processing.process_runs(runs_dir, out_dir, ["npz", "npy", "relief"], is_run, processes,
+                                         ("topographic__elevation", "drainage_area"), manifest_path)
+
+def test_process_runs_makes_products(tmp_path):
+    runs_dir, out_dir = make_dirs(tmp_path, "runs", "out")
+    elevations = write_runs(runs_dir)
+    manifest = process(runs_dir, out_dir)
+    assert sorted(manifest) == RUNS
+    for name, elevation in elevations.items():
+        assert manifest[name]["products"] == {"npz", "npy", "relief"}
+        assert manifest[name]["relief"] == float(np.ptp(elevation))
+        np.testing.assert_array_equal(np.load(os.path.join(out_dir, "%s.npz" % name))[name], elevation)
+        npy = np.load(os.path.join(out_dir, "%s.npy" % name))
+        # the fields are concatenated along the first axis
+        assert npy.shape == (2, 5, 4)
+        np.testing.assert_array_equal(npy[0], elevation)
+    with open(os.path.join(out_dir, model_processing.MANIFEST_NAME)) as manifest_file:
+        assert sorted(json.loads(line)["run"] for line in manifest_file) == RUNS
+
+def test_second_call_skips_processed_runs(tmp_path, capsys):
+    runs_dir, out_dir = make_dirs(tmp_path, "runs", "out")
+    write_runs(runs_dir)
+    first = process(runs_dir, out_dir)
+    capsys.readouterr()
+    assert process(runs_dir, out_dir) == first
+    assert "processing 0 runs" in capsys.readouterr().out
+
+def test_processes_give_the_same_products(tmp_path):
+    runs_dir, serial_dir, parallel_dir = make_dirs(tmp_path, "runs", "serial", "parallel")
+    write_runs(runs_dir)
+    assert process(runs_dir, parallel_dir, processes=2) == process(runs_dir, serial_dir)
+    for name in RUNS:
+        np.testing.assert_array_equal(np.load(os.path.join(parallel_dir, "%s.npy" % name)),
+                                      np.load(os.path.join(serial_dir, "%s.npy" % name)))
+
+def test_truncated_manifest_line_is_redone(tmp_path, capsys):
+    runs_dir, out_dir = make_dirs(tmp_path, "runs", "out")
+    write_runs(runs_dir)
+    process(runs_dir, out_dir)
+    manifest_path = os.path.join(out_dir, model_processing.MANIFEST_NAME)
+    with open(manifest_path) as manifest_file:
+        lines = manifest_file.readlines()
+    # as if processing was killed while writing the last line
+    with open(manifest_path, 'w') as manifest_file:
+        manifest_file.writelines(lines[:-1] + [lines[-1][:10]])
+    loaded = model_processing.load_manifest(manifest_path)
+    assert len(loaded) == len(RUNS) - 1
+    capsys.readouterr()
+    manifest = process(runs_dir, out_dir)
+    assert "processing 1 runs" in capsys.readouterr().out
+    assert sorted(manifest) == RUNS
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["model_processing.py"] + list(args))
+    model_processing.main()
+
+def test_products_command(tmp_path, monkeypatch):
+    runs_dir, out_dir, parallel_dir = make_dirs(tmp_path, "runs", "out", "parallel")
+    elevations = write_runs(runs_dir)
+    run_main(monkeypatch, "products", "-id", runs_dir, "-od", out_dir, "--npz", "--relief")
+    run_main(monkeypatch, "-j", "2", "products", "-id", runs_dir, "-od", parallel_dir, "--npz", "--relief")
+    for directory in (out_dir, parallel_dir):
+        assert sorted(os.listdir(directory)) == sorted(["%s.npz" % name for name in RUNS] + [model_processing.MANIFEST_NAME])
+        manifest = model_processing.load_manifest(os.path.join(directory, model_processing.MANIFEST_NAME))
+        assert {name: record["relief"] for name, record in manifest.items()} == {
+            name: float(np.ptp(elevation)) for name, elevation in elevations.items()}
+
+def test_tocsv_relief_keeps_a_manifest(tmp_path, monkeypatch):
+    runs_dir, out_dir = make_dirs(tmp_path, "runs", "out")
+    elevations = write_runs(runs_dir)
+    db_path = str(tmp_path / "runs.db")
+    connection = sqlite3.connect(db_path)
+    connection.execute("CREATE TABLE model_run_outputs (model_run_id TEXT, \"output.topography.max\" REAL)")
+    connection.executemany("INSERT INTO model_run_outputs VALUES (?, ?)", [(name, 1.0) for name in RUNS])
+    connection.commit()
+    connection.close()
+    csv_path = os.path.join(out_dir, "outputs.csv")
+    run_main(monkeypatch, "-d", db_path, "-t", "model_run_outputs", "tocsv", "-o", csv_path, "--relief",
+             "-id", runs_dir, "-c", "model_run_id", "output.topography.max")
+    with open(csv_path) as csv_file:
+        rows = list(csv.reader(csv_file))
+    assert rows[0] == ["model_run_id", "output.topography.max", "relief"]
+    assert {row[0]: float(row[2]) for row in rows[1:]} == {name: float(np.ptp(elevation)) for name, elevation in elevations.items()}
+    assert sorted(model_processing.load_manifest(os.path.join(out_dir, model_processing.MANIFEST_NAME))) == RUNS
@@ -0,0 +1,157 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from landlab_ensemble.generate_ensembles import create_model_db
+from landlab_ensemble.parameter_space import ParameterSpace, nearest
+from landlab_ensemble import refinement
+import landlab_ensemble.construct_model as cm
+from model_base import LandlabModel
+
+GRID = "ITERATIVE linspace {\"start\": 0, \"stop\": 1, \"num\": 5}"
+
+def make_step_db(tmp_path):
+    """A 5x5 grid of runs over x and y whose output steps from 0 to 1 between x = 0.5 and x = 0.75."""
+    param_path = str(tmp_path / "params.json")
+    with open(param_path, 'w') as param_file:
+        json.dump({"x": GRID, "y": GRID, "c": 3, "output_fields": ["output.topography.range"]}, param_file)
+    db_path = str(tmp_path / "step.db")
+    create_model_db(db_path, param_path, report=False)
+    connection = sqlite3.connect(db_path)
+    for run_param_id, x in connection.execute("SELECT run_param_id, \"model_param.x\" FROM model_run_params").fetchall():
+        model_run_id = "run_%d" % run_param_id
+        connection.execute("UPDATE model_run_params SET model_run_id = ? WHERE run_param_id = ?", (model_run_id, run_param_id))
+        connection.execute("INSERT INTO model_run_metadata (model_run_id, model_start_time, model_end_time) VALUES (?, 0, 1)",
+                           (model_run_id,))
+        connection.execute("INSERT INTO model_run_outputs (model_run_id, \"output.topography.range\") VALUES (?, ?)",
+                           (model_run_id, float(x > 0.6)))
+    connection.commit()
+    connection.close()
+    return db_path
+
+def test_refine_adds_runs_at_the_step(tmp_path):
+    db_path = make_step_db(tmp_path)
+    added = refinement.refine(db_path, ["output.topography.range"], 10)
+    connection = sqlite3.connect(db_path)
+    rows = connection.execute("SELECT \"model_param.x\", \"model_param.y\", \"model_param.c\" FROM model_run_params "
+                              "WHERE model_run_id IS NULL").fetchall()
+    connection.close()
+    assert len(rows) == added
+    # every new run is halfway across the step, at least one for each row of the grid
+    assert {x for x, _, _ in rows} == {0.625}
+    assert set(np.linspace(0, 1, 5)) <= {y for _, y, _ in rows}
+    assert {c for _, _, c in rows} == {3}
+    # the same points are not added again before they have run
+    assert refinement.refine(db_path, ["output.topography.range"], 10) == 0
+
+def test_refined_integer_parameters_are_claimed(tmp_path):
+    from landlab_ensemble.construct_model import ModelSelector
+    # integer parameters are stored in TEXT columns typed numpy.int64, and decoded with int()
+    integer_grid = "ITERATIVE arange {\"start\": 0, \"stop\": 500, \"step\": 100}"
+    param_path = str(tmp_path / "params.json")
+    with open(param_path, 'w') as param_file:
+        json.dump({"x": integer_grid, "n": integer_grid, "output_fields": ["output.topography.range"]}, param_file)
+    db_path = str(tmp_path / "integer.db")
+    create_model_db(db_path, param_path, report=False)
+    finish_unrun_rows(db_path)
+    assert refinement.refine(db_path, ["output.topography.range"], 10) > 0
+    selector = ModelSelector(db_path)
+    claimed = selector.claim(100)
+    assert claimed
+    assert all(isinstance(param_dict[name], (int, np.integer)) for _, _, param_dict in claimed for name in ("x", "n"))
+
+class StepModel(LandlabModel):
+    """A model whose topography is flat for x below 0.6 and a ramp above."""
+    grid_fields_to_save = ["topographic__elevation"]
+
+    def __init__(self, params={}):
+        super().__init__(params)
+        self.grid.add_field("topographic__elevation", float(params["x"] > 0.6) * self.grid.x_of_node, at="node")
+
+def test_refine_sees_runs_of_the_single_process_dispatcher(tmp_path):
+    param_path = str(tmp_path / "params.json")
+    with open(param_path, 'w') as param_file:
+        json.dump({"x": GRID, "y": GRID, "output_fields": ["output.topography.range"],
+                   "grid": {"source": "create", "create_grid": {"RasterModelGrid": [[5, 5], {"xy_spacing": 1.0}]}},
+                   "runtime": {"clock": {"start": 0.0, "stop": 1.0, "step": 1.0}}}, param_file)
+    db_path = str(tmp_path / "dispatched.db")
+    create_model_db(db_path, param_path, report=False)
+    dispatcher = cm.ModelDispatcher(db_path, StepModel, str(tmp_path) + os.sep)
+    dispatcher.run_all()
+    dispatcher.close()
+    assert refinement.refine(db_path, ["output.topography.range"], 10) > 0
+    connection = sqlite3.connect(db_path)
+    rows = connection.execute("SELECT \"model_param.x\" FROM model_run_params WHERE model_run_id IS NULL").fetchall()
+    connection.close()
+    assert {x for x, in rows} == {0.625}
+
+def finish_unrun_rows(db_path):
+    """Runs the unrun rows of a step database, as a dispatcher would."""
+    connection = sqlite3.connect(db_path)
+    for run_param_id, x in connection.execute("SELECT run_param_id, \"model_param.x\" FROM model_run_params "
+                                              "WHERE model_run_id IS NULL").fetchall():
+        model_run_id = "run_%d" % run_param_id
+        connection.execute("UPDATE model_run_params SET model_run_id = ? WHERE run_param_id = ?", (model_run_id, run_param_id))
+        connection.execute("INSERT INTO model_run_metadata (model_run_id, model_start_time, model_end_time) VALUES (?, 0, 1)",
+                           (model_run_id,))
+        connection.execute("INSERT INTO model_run_outputs (model_run_id, \"output.topography.range\") VALUES (?, ?)",
+                           (model_run_id, float(float(x) > 0.6)))
+    connection.commit()
+    connection.close()
+
+def test_rounds_wait_for_the_previous_round(tmp_path):
+    db_path = make_step_db(tmp_path)
+    totals = []
+    refining = threading.Thread(target=lambda: totals.append(refinement.refine_in_rounds(
+        db_path, ["output.topography.range"], 10, 2, poll_interval=0.01)))
+    refining.start()
+    connection = sqlite3.connect(db_path)
+    count_query = "SELECT COUNT(*) FROM model_run_params"
+    while connection.execute(count_query).fetchone()[0] == 25:
+        time.sleep(0.01)
+    first_round = connection.execute(count_query).fetchone()[0]
+    # the first round's rows are not finished, so the second round has to wait
+    time.sleep(0.2)
+    assert refining.is_alive()
+    assert connection.execute(count_query).fetchone()[0] == first_round
+    finish_unrun_rows(db_path)
+    refining.join(10)
+    assert not refining.is_alive()
+    # the second round refines the step between the first round's runs
+    xs = {x for (x,) in connection.execute("SELECT \"model_param.x\" FROM model_run_params WHERE model_run_id IS NULL")}
+    connection.close()
+    assert totals[0] > first_round - 25
+    assert xs and all(0.5 < x < 0.75 and x != 0.625 for x in xs)
+
+def test_round_waits_for_min_results(tmp_path):
+    db_path = make_step_db(tmp_path)
+    connection = sqlite3.connect(db_path)
+    connection.execute("UPDATE model_run_metadata SET model_end_time = NULL WHERE model_run_id IN ('run_1', 'run_2')")
+    connection.commit()
+    connection.close()
+    assert refinement.wait_for_round(db_path, 0, 25, min_results=20, poll_interval=0.01) == 23
+    assert refinement.wait_for_round(db_path, 2, 25, poll_interval=0.01) == 23
+
+def test_parameter_space_round_trip():
+    space = ParameterSpace(["a", "b", "n"], [0.001, -1, 1], [10, 1, 9], log=[True, False, False], integer=[False, False, True])
+    values = np.array([[0.001, -1, 1], [0.1, 0, 5], [10, 1, 9]])
+    unit = space.to_unit(values)
+    assert np.allclose(unit, [[0, 0, 0], [0.5, 0.5, 0.5], [1, 1, 1]])
+    assert np.allclose(space.from_unit(unit), values)
+    assert space.from_unit([[0, 0, 0.55]])[0, 2] == 5
+
+def test_nearest_matches_brute_force():
+    rng = np.random.default_rng(0)
+    points = rng.random((700, 3))
+    indices, distances = nearest(points, points, 4, exclude_self=True)
+    full = np.sqrt(((points[:, None, :] - points[None, :, :])**2).sum(axis=2))
+    np.fill_diagonal(full, np.inf)
+    assert np.array_equal(indices, np.argsort(full, axis=1)[:, :4])
+    assert np.allclose(distances, np.sort(full, axis=1)[:, :4])
@@ -1,35 +1,96 @@
-from torch.utils.data import Dataset
+from collections import OrderedDict
 import sqlite3
-import os
 import numpy as np
+try:
+    from torch.utils.data import Dataset
+except ImportError:
+    # get_labels and read_packed_index do not need torch, and DataLoader only needs
+    # __len__ and __getitem__
+    Dataset = object
+
+PACKED_INDEX_SUFFIX = ".runs"  # the run names of a packed array, one per line (see model_processing makepacked)
 
 def get_runs(database, filter_query = ""):
     connection = sqlite3.connect(database)
     cursor = connection.cursor()
     cursor.execute(f"SELECT model_run_id FROM model_run_metadata WHERE model_end_time IS NOT NULL {filter_query}")
-    return [r[0] for r in cursor.fetchall()]
+    runs = [r[0] for r in cursor.fetchall()]
+    connection.close()
+    return runs
+
+def get_labels(database, label_query):
+    """Runs the label query once, returning a dictionary of model_run_id to label.
+
+    The label query should select the model_run_id followed by the label column(s), e.g.
+    SELECT model_run_id, "output.topography.max" FROM model_run_outputs
+    """
+    connection = sqlite3.connect(database)
+    rows = connection.execute(label_query).fetchall()
+    connection.close()
+    return {row[0]: row[1] if len(row) == 2 else tuple(row[1:]) for row in rows}
+
+def read_packed_index(packed_path):
+    """Reads the run names of a packed array, in row order."""
+    with open(packed_path + PACKED_INDEX_SUFFIX) as index_file:
+        return [line.strip() for line in index_file if line.strip()]
 
 class LandlabBatchdataset(Dataset):
-    def __init__(self, database, dataset_dir, label_query, filter_query=None):
-        self.img_db = database
-        self.dataset_directory = dataset_dir
-        self.connection = sqlite3.connect(database)
-        self.cursor = connection.curosr()
-        self.label_query = label_query
-        if filter_query is not None:
-            self.filter_query = filter_query
-        else:
-            self.filter_query = ""
-        self.runs = get_runs(database, filter_query)
+    """A dataset of finished model runs for training.
+
+    The arrays of all runs are read from a single packed .npy file (made with
+    model_processing.py makepacked) through a read only memory map, and the labels of
+    every run are loaded with one query when the dataset is made, so no database
+    connection is used afterwards.  The memory map is opened lazily in each process,
+    which makes the dataset safe to use with multi-process DataLoader workers.
+
+    Attributes:
+        packed_path -- the path of the packed .npy file
+        runs -- the model run ids in the dataset
+        labels -- the label of each run, in the same order as runs
+        rows -- the row of each run in the packed array
+        cache_size -- the maximum number of samples kept in the LRU cache (0 disables it)
+    """
+    def __init__(self, database, packed_path, label_query, filter_query=None, cache_size=0):
+        """Creates the dataset.
+
+        Args:
+            database -- the path of the parameter database
+            packed_path -- the packed .npy file of run arrays
+            label_query -- a query selecting model_run_id and the label (see get_labels)
+            filter_query -- an additional condition on model_run_metadata for the runs to use
+            cache_size -- the maximum number of decoded samples to keep in memory
+        """
+        self.packed_path = packed_path
+        self.filter_query = filter_query if filter_query is not None else ""
+        finished = get_runs(database, self.filter_query)
+        labels = get_labels(database, label_query)
+        packed_rows = {run: row for row, run in enumerate(read_packed_index(packed_path))}
+        self.runs = [run for run in finished if run in packed_rows and run in labels]
+        self.labels = [labels[run] for run in self.runs]
+        self.rows = np.array([packed_rows[run] for run in self.runs], dtype=np.int64)
+        self.cache_size = cache_size
+        self._data = None
+        self._cache = OrderedDict()
+
+    def __getstate__(self):
+        # workers open their own memory map and start with an empty cache
+        state = self.__dict__.copy()
+        state["_data"] = None
+        state["_cache"] = OrderedDict()
+        return state
 
     def __len__(self):
-        return len(self.img_labels)
-
-    def __get__item(self, idx):
-        run_name = self.runs[idx]
-        data_path = os.path.join(self.dataset_directory, f"{run_name}.npz")
-        label_query = f"{self.label_query} WHERE model_run_id = {run_name}"
-        self.cursor.execute(label_query)
-        label = self.cursor.fetchone()[0]
-        data_array = np.load(data_path)
-        return data_array, label
+        return len(self.runs)
+
+    def __getitem__(self, idx):
+        if idx in self._cache:
+            self._cache.move_to_end(idx)
+            return self._cache[idx]
+        if self._data is None:
+            self._data = np.load(self.packed_path, mmap_mode="r")
+        sample = (np.array(self._data[self.rows[idx]]), self.labels[idx])
+        if self.cache_size > 0:
+            self._cache[idx] = sample
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return sample
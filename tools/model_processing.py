@@ -1,11 +1,12 @@
 import numpy as np
-import netCDF4
-import matplotlib.pyplot as plt
 import os
 import argparse
+import concurrent.futures
+import json
 import sqlite3
 import csv
-import xarray as xr
+# netCDF4 and matplotlib are imported where they are used, so tocsv (without --relief)
+# and the other commands that do not need them start quickly
 
 def hillshade(z, azimuth=315.0, angle_altitude=45.0):
     """Generate a hillshade image from DEM.
@@ -24,26 +25,130 @@ def hillshade(z, azimuth=315.0, angle_altitude=45.0):
     return 255 * (shaded + 1) / 2  # return result scaled 0 to 255
 
 def make_hillshade(path, out_dir):
-    ext = os.path.splitext(path)[-1]
-    if ext  == ".npz":
-        array = np.load(path)
-        elevation_array = array[[k for k in array.keys()][0]]
-    elif ext == ".npy":
-        elevation_array = np.load(path)
-    else:
-        nc_file = netCDF4.Dataset(path)
-        elevation_array = np.array(nc_file.variables['topographic__elevation'][:][0])
-    hsh = hillshade(elevation_array)
+    elevation_array = load_elevation(path)
     name = os.path.splitext(os.path.split(path)[-1])[0]
+    save_hillshade(elevation_array, name, out_dir)
+
+def save_hillshade(elevation_array, name, out_dir):
+    import matplotlib.pyplot as plt
+    hsh = hillshade(elevation_array)
     output = os.path.join(out_dir, "%s.png" % name)
     plt.imsave(output, hsh, cmap="gray")
 
+def read_run(path, fields=("topographic__elevation",)):
+    """Reads the elevation and the given fields of a run with a single open of its file.
+
+    .npz and .npy files only hold the elevation, which is returned for every field.
+    """
+    ext = os.path.splitext(path)[-1]
+    if ext in (".npz", ".npy"):
+        elevation_array = load_elevation(path)
+        return elevation_array, {field: elevation_array for field in fields}
+    import netCDF4
+    with netCDF4.Dataset(path) as nc_file:
+        elevation_array = np.array(nc_file.variables['topographic__elevation'][:][0])
+        field_arrays = {field: np.array(nc_file.variables[field][:]) for field in fields}
+    return elevation_array, field_arrays
+
+def process_run(path, out_dir, products, fields=("topographic__elevation",)):
+    """Makes the requested products of a single run from one read of its file.
+
+    Args:
+        path -- the path of the run's netcdf (or .npz/.npy) file
+        out_dir -- the directory the hillshade, npz and npy files are written to
+        products -- the products to make, any of PRODUCTS
+        fields -- the fields concatenated into the npy product
+    Returns a manifest entry: the run name, the products made and the relief if it was asked for.
+    """
+    name = os.path.splitext(os.path.split(path)[-1])[0]
+    elevation_array, field_arrays = read_run(path, fields if "npy" in products else ())
+    entry = {"run": name, "products": list(products)}
+    if "hillshade" in products:
+        save_hillshade(elevation_array, name, out_dir)
+    if "npz" in products:
+        np.savez_compressed(os.path.join(out_dir, "%s.npz" % name), **{name: elevation_array})
+    if "npy" in products:
+        np.save(os.path.join(out_dir, "%s.npy" % name), np.concatenate([field_arrays[field] for field in fields]))
+    if "relief" in products:
+        entry["relief"] = float(np.ptp(elevation_array))
+    return entry
+
+def _process_run_task(task):
+    return process_run(*task)
+
+PRODUCTS = ("hillshade", "npz", "npy", "relief")
+MANIFEST_NAME = "manifest.jsonl"
+
+def load_manifest(manifest_path):
+    """Reads a manifest, returning a dictionary of run name to the products (and relief) recorded for it."""
+    manifest = {}
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # a line cut short by an interrupted run
+                continue
+            record = manifest.setdefault(entry["run"], {"products": set()})
+            record["products"].update(entry["products"])
+            if "relief" in entry:
+                record["relief"] = entry["relief"]
+    return manifest
+
+def process_runs(input_directory, out_dir, products, validate_name, processes=1, fields=("topographic__elevation",), manifest_path=None):
+    """Makes the requested products for every run in a directory.
+
+    Runs are read once each, on a pool of processes if processes is above one.  Each finished
+    run is appended to the manifest (a json line per run), and runs whose products are already
+    recorded there are skipped, so a rerun only processes new outputs.
+    Returns the manifest, updated with the runs processed now.
+    """
+    manifest = load_manifest(manifest_path)
+    tasks = []
+    for file_name in sorted(os.listdir(input_directory)):
+        if validate_name(file_name):
+            name = os.path.splitext(file_name)[0]
+            missing = [p for p in products if p not in manifest.get(name, {"products": ()})["products"]]
+            if missing:
+                tasks.append((os.path.join(input_directory, file_name), out_dir, missing, tuple(fields)))
+    print("processing %d runs" % len(tasks))
+    manifest_file = open(manifest_path, 'a') if manifest_path is not None else None
+    pool = None
+    try:
+        if processes > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+            entries = pool.map(_process_run_task, tasks, chunksize=max(1, len(tasks) // (processes * 16)))
+        else:
+            entries = map(_process_run_task, tasks)
+        for entry in entries:
+            record = manifest.setdefault(entry["run"], {"products": set()})
+            record["products"].update(entry["products"])
+            if "relief" in entry:
+                record["relief"] = entry["relief"]
+            if manifest_file is not None:
+                manifest_file.write(json.dumps(entry) + "\n")
+                manifest_file.flush()
+    finally:
+        if pool is not None:
+            # the runs not started yet are dropped if processing failed
+            pool.shutdown(cancel_futures=True)
+        if manifest_file is not None:
+            manifest_file.close()
+    return manifest
+
+def default_manifest(args, out_dir):
+    if args.manifest is not None:
+        return args.manifest
+    return os.path.join(out_dir, MANIFEST_NAME)
+
 def process_hillshades(args, validate_name):
-    input_directory = args.id
-    output_directory = args.od
-    for file_path in os.listdir(input_directory):
-        if validate_name(file_path):
-            make_hillshade(os.path.join(input_directory, file_path), output_directory)
+    process_runs(args.id, args.od, ["hillshade"], validate_name, args.j, manifest_path=default_manifest(args, args.od))
+
+def process_products(args, validate_name):
+    products = [p for p in PRODUCTS if getattr(args, p)]
+    process_runs(args.id, args.od, products, validate_name, args.j, args.fields, default_manifest(args, args.od))
 
 def db_to_csv(args, validate_name):
     connection = sqlite3.connect(args.d)
@@ -53,7 +158,8 @@ def db_to_csv(args, validate_name):
     rows = result.fetchall()
     columns = args.c
     if args.relief:
-        reliefs = get_relief(args.id, validate_name)
+        # kept next to the csv, as the other commands keep theirs in the output directory
+        reliefs = get_relief(args.id, validate_name, args.j, default_manifest(args, os.path.dirname(os.path.abspath(args.o))))
         rows = [list(row) for row in rows]
         for row in rows:
                 row.append(reliefs[row[0]])
@@ -63,49 +169,49 @@ def db_to_csv(args, validate_name):
         writer.writerow(args.c)
         writer.writerows(rows)
 
-def get_relief(input_directory, validate_name):
-    reliefs = {}
-    for file_path in os.listdir(input_directory):
-        if validate_name(file_path):
-            path = os.path.join(input_directory, file_path)
-            ext = os.path.splitext(path)[-1]
-            if ext  == ".npz":
-                array = np.load(path)
-                elevation_array = array[[k for k in array.keys()][0]]
-            elif ext == ".npy":
-                elevation_array = np.load(path)
-            else:
-                nc_file = netCDF4.Dataset(path)
-                elevation_array = np.array(nc_file.variables['topographic__elevation'][:][0])
-            range = np.ptp(elevation_array)
-            name = os.path.splitext(os.path.split(file_path)[-1])[0]
-            reliefs[name] = range
-    return reliefs
+def get_relief(input_directory, validate_name, processes=1, manifest_path=None):
+    manifest = process_runs(input_directory, None, ["relief"], validate_name, processes, manifest_path=manifest_path)
+    return {name: record["relief"] for name, record in manifest.items() if "relief" in record}
 
 def generate_npy(args, validate_name):
-    input_directory = args.id
-    output_path = args.od
-    fields = args.fields
-    for file_name in os.listdir(input_directory):
-        if validate_name(file_name):
-            file_path = os.path.join(input_directory, file_name)
-            run_name = os.path.splitext(file_name)[0]
-            dataset = xr.open_dataset(file_path)
-            data_array = np.concatenate([np.array(dataset[field]) for field in fields])
-            npy_file_path = os.path.join(output_path, f"{run_name}.npy" % run_name)
-            np.save(npy_file_path, data_array)
+    process_runs(args.id, args.od, ["npy"], validate_name, args.j, args.fields, default_manifest(args, args.od))
 
 def generate_npz(args, validate_name):
-     input_directory = args.id
-     output_path = args.od
-     for file_name in os.listdir(input_directory):
-         if validate_name(file_name):
-             file_path = os.path.join(input_directory, file_name)
-             run_name = os.path.splitext(file_name)[0]
-             nc_file = netCDF4.Dataset(file_path)
-             elevation_array = np.array(nc_file.variables['topographic__elevation'][:][0])
-             npz_file_path = os.path.join(output_path, "%s.npz" % run_name)
-             np.savez_compressed(npz_file_path, **{run_name: elevation_array})
+    process_runs(args.id, args.od, ["npz"], validate_name, args.j, manifest_path=default_manifest(args, args.od))
+
+def load_elevation(path):
+    """Loads the elevation array of a run saved as .npz, .npy or netcdf."""
+    ext = os.path.splitext(path)[-1]
+    if ext == ".npz":
+        array = np.load(path)
+        return array[[k for k in array.keys()][0]]
+    elif ext == ".npy":
+        return np.load(path)
+    import netCDF4
+    nc_file = netCDF4.Dataset(path)
+    elevation_array = np.array(nc_file.variables['topographic__elevation'][:][0])
+    nc_file.close()
+    return elevation_array
+
+def generate_packed(args, validate_name):
+    """Packs the elevation of every run into one uncompressed .npy file for fast memory mapped reads.
+
+    The run names are written, in row order, to the same path with a ".runs" suffix
+    (see dataloader.LandlabBatchdataset).
+    """
+    input_directory = args.id
+    file_names = sorted(f for f in os.listdir(input_directory) if validate_name(f))
+    if not file_names:
+        print("no runs to pack in %s" % input_directory)
+        return
+    first = load_elevation(os.path.join(input_directory, file_names[0]))
+    packed = np.lib.format.open_memmap(args.o, mode="w+", dtype=first.dtype, shape=(len(file_names),) + first.shape)
+    for row, file_name in enumerate(file_names):
+        packed[row] = first if row == 0 else load_elevation(os.path.join(input_directory, file_name))
+    packed.flush()
+    del packed
+    with open(args.o + ".runs", 'w') as index_file:
+        index_file.writelines("%s\n" % os.path.splitext(file_name)[0] for file_name in file_names)
 
 def get_name_filter(filter, database, table):
     connection = sqlite3.connect(database)
@@ -123,6 +229,8 @@ def main():
     parser.add_argument("-d")
     parser.add_argument("-f")
     parser.add_argument("-t")
+    parser.add_argument("-j", type=int, default=1, help="number of processes")
+    parser.add_argument("--manifest", help="manifest of processed runs (default manifest.jsonl in the output directory)")
     subparsers = parser.add_subparsers()
     parse_hillshade = subparsers.add_parser("hillshade")
     parse_hillshade.set_defaults(func=process_hillshades)
@@ -145,14 +253,25 @@ def main():
     parse_npy.add_argument("-id")
     parse_npy.add_argument("-od")
     parse_npy.add_argument("--fields", type=str, nargs='+', default=["topographic__elevation"])
+    parse_products = subparsers.add_parser("products")
+    parse_products.set_defaults(func=process_products)
+    parse_products.add_argument("-id")
+    parse_products.add_argument("-od")
+    for product in PRODUCTS:
+        parse_products.add_argument("--%s" % product, action="store_true")
+    parse_products.add_argument("--fields", type=str, nargs='+', default=["topographic__elevation"])
+    parse_packed = subparsers.add_parser("makepacked")
+    parse_packed.set_defaults(func=generate_packed)
+    parse_packed.add_argument("-id")
+    parse_packed.add_argument("-o")
 
 
 
     args = parser.parse_args()
     if args.f is not None:
-        validate_name = get_name_filters(args.f, args.d, args.t)
+        validate_name = get_name_filter(args.f, args.d, args.t)
     else:
-        validate_name = lambda n: os.path.splitext(n)[1] in (".nc", ".npz", ".np")
+        validate_name = lambda n: os.path.splitext(n)[1] in (".nc", ".npz", ".npy")
     args.func(args, validate_name)
     
 if __name__ == '__main__':